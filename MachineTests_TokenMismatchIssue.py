@@ -12,36 +12,47 @@ the web adapter.
 20180810, CJuice
 """
 
-def main():
-    import configparser
+def main(credentials_path=None):
+    """
+    Run the token matrix and write its report.
+    :param credentials_path: path of the config file (default=None, Docs/credentials.cfg in the project folder)
+    :return: None
+    """
+    import csv
     import json
     import os
-    import requests
-    import urllib3
-    from urllib3.exceptions import InsecureRequestWarning
+    import sys
+    import time
+    from collections import Counter
+    from concurrent.futures import ThreadPoolExecutor
 
-    # Without disabled warnings, every request prints a red warning since we have chosen 'verify=False' when
-    #   making requests to secure services
-    urllib3.disable_warnings(InsecureRequestWarning)
-    project_root = os.path.dirname(__file__)
+    from ags_client import AGSClient
+    from ags_crawler import PROJECT_ROOT, Crawler, load_config
+    from ags_output import atomic_output_file
+    from ags_retry import RequestFailedException
+    from ags_tokens import TokenException, TokenManager
 
     # VARIABLES
-    credentials_path = os.path.join(project_root, r"Docs\credentials.cfg")
-    config = configparser.ConfigParser()
-    config.read(filenames=credentials_path)
+    config = load_config(credentials_path=credentials_path)
     SERVER_PORT_SECURE = config['ags_prod_machine_names']["secureport"]
     SERVER_MACHINE_NAMES = (config['ags_prod_machine_names']["machine1"],
                             config['ags_prod_machine_names']["machine2"],
                             config['ags_prod_machine_names']["machine3"],
                             config['ags_prod_machine_names']["machine4"])
-    SERVER_ROOT_URL = "https://{machine_name}:{port}"
-    SERVER_URL_GENERATE_TOKEN = "arcgis/admin/generateToken"
-    SERVER_URL_SERVICES = "arcgis/admin/services"
+    SERVER_ROOT_URL = config.get("token_matrix", "server_root_url", fallback="https://{machine_name}:{port}")
 
-    # Need credentials from config file
+    # The token x machine x folder matrix is run with this many requests in flight, and repeated to reproduce
+    #   intermittent mismatches under load. Results are written to <matrix_report>.csv and <matrix_report>.json
+    MATRIX_REPETITIONS = config.getint("token_matrix", "repetitions", fallback=1)
+    MATRIX_REPORT = os.path.join(PROJECT_ROOT, config.get("token_matrix", "report", fallback="TokenMatrixReport"))
+    MATRIX_WORKERS = config.getint("token_matrix", "workers", fallback=16)
 
-    username = config['ags_server_credentials']["username"]
-    password = config['ags_server_credentials']["password"]
+    # The crawl engine's pooled client, profiler, token manager, and bounded retries are reused in-process. Its
+    #   profile of the token, folders, and report requests is written to <matrix_report>.profile.json
+    crawler = Crawler(config=config)
+    client = crawler.client
+    profiler = crawler.profiler
+    token_manager = crawler.token_manager
 
     # CLASSES
     class Machine_Objects():
@@ -56,66 +67,58 @@ def main():
             """Print out a meaningful representation of the object"""
             return(f"{self.machine_name}-->\n\t{self.root_url}\n\t{self.services_url}\n\t{self.token}\n\t{self.folders_list}")
 
-    class Not_JSON_Exception(Exception):
-        """Raised when the url for the request is malformed for our purposes and the server returns html, not json"""
-        def __init__(self):
-            pass
-
     # FUNCTIONS
-    def create_params_for_request(token_action=None):
-        if token_action == None:
-            values = {'f': 'json'}
-        elif token_action == "getToken":
-            values = {'username': username, 'password': password, 'client': 'requestip', 'f': 'json'}
+    create_params_for_request = Crawler.create_params_for_request
+    clean_url_slashes = Crawler.clean_url_slashes
+
+    def run_matrix_cell(cell):
+        """Make a single report request for one matrix cell and record the outcome rather than retrying, since the
+        outcome itself is what the matrix is measuring"""
+        report_url = clean_url_slashes(os.path.join(cell["target_services_url"], cell["folder"], "report"))
+        report_request_params = create_params_for_request(token_action=cell["token"])
+        start = time.perf_counter()
+        try:
+            with profiler.measure(kind="report", machine=AGSClient.machine_key(report_url),
+                                  folder=cell["folder"].rstrip("/")):
+                response = client.post(url=report_url, data=report_request_params)
+                response_json = response.json()
+        except Exception as e:
+            result, message = "error", str(e)
         else:
-            values = {'token': token_action, 'f': 'json'}
-        return values
-
-    def get_value_from_response(serverURL, params, search_key):
-
-        # Handle mixed path slash characters between url syntax and os.path.join use of "\"
-        serverURL = clean_url_slashes(serverURL)
-        while True:
-            try:
-                # Jessie discovered "verify" option and set to False to bypass the ssl issue
-                response = requests.post(url=serverURL, data=params, verify=False)
-            except Exception as e:
-                print("Error in response from requests: {}".format(e))
-                exit()
+            if isinstance(response_json, dict) and "reports" in response_json:
+                result, message = "success", ""
+            elif TokenManager.is_token_rejected(response_json):
+                result, message = "mismatch", json.dumps(response_json)
             else:
-                try:
-                    if "html" in response.headers["Content-Type"]:
-                        raise Not_JSON_Exception
-                    response_json = response.json()
-                except json.decoder.JSONDecodeError as jde:
-                    print("Error decoding response to json: {}".format(jde))
-                    print(response)
-                    exit()
-                except Not_JSON_Exception as NJE:
-                    print("Appears to be html, not json. Problem lies with ...")
-                    print(response.url)
-                    print(response.headers)
-                    print(response.text)
-                    exit()
-
-                # In the response json, isolate the value of interest via the search key
-                try:
-                    value = response_json[search_key]
-
-                # When the search key is not found, throws KeyError. This is where the Client Mismatch error surfaces.
-                except KeyError as ke:
-                    print("KeyError: {}".format(ke))
-                    continue
-                except TypeError as te:
-                    print("TypeError: {}".format(te))
-                    print(response_json)
-                    continue
-                else:
-                    return value
-
-    def clean_url_slashes(url):
-        url = url.replace("\\", "/")
-        return url
+                result, message = "error", json.dumps(response_json)
+        return {"repetition": cell["repetition"],
+                "token_machine": cell["token_machine"],
+                "target_machine": cell["target_machine"],
+                "folder": cell["folder"],
+                "result": result,
+                "latency_seconds": round(time.perf_counter() - start, 4),
+                "message": message}
+
+    def write_matrix_report(results, report_path):
+        """Write the per cell results to csv and, with a summary per token machine and target machine, to json"""
+        fieldnames = ["repetition", "token_machine", "target_machine", "folder", "result", "latency_seconds", "message"]
+        with atomic_output_file(path=f"{report_path}.csv", newline='') as csv_file_handler:
+            writer = csv.DictWriter(csv_file_handler, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+
+        summary = {}
+        for result in results:
+            pair = summary.setdefault(f"{result['token_machine']} -> {result['target_machine']}",
+                                      {"success": 0, "mismatch": 0, "error": 0, "latencies": []})
+            pair[result["result"]] += 1
+            pair["latencies"].append(result["latency_seconds"])
+        for pair in summary.values():
+            latencies = sorted(pair.pop("latencies"))
+            pair["latency_median_seconds"] = latencies[len(latencies) // 2]
+            pair["latency_max_seconds"] = latencies[-1]
+        with atomic_output_file(path=f"{report_path}.json") as json_file_handler:
+            json.dump({"summary": summary, "cells": results}, json_file_handler, indent=4)
 
     # FUNCTIONALITY
     # Create combinations of "token generating server" to all other servers for checking tokens to machines acceptance
@@ -124,47 +127,70 @@ def main():
     for machine in SERVER_MACHINE_NAMES:
         root_server_url = SERVER_ROOT_URL.format(machine_name=machine, port=SERVER_PORT_SECURE)
 
-        generate_token_url = os.path.join(root_server_url, SERVER_URL_GENERATE_TOKEN)
-        token_params = create_params_for_request(token_action="getToken")
-        token = get_value_from_response(serverURL=generate_token_url, params=token_params, search_key="token")
-
-        request_params_result = create_params_for_request(token_action=token)
-        services_url = clean_url_slashes(os.path.join(root_server_url, SERVER_URL_SERVICES))
-        folders = get_value_from_response(serverURL=services_url, params=request_params_result, search_key="folders")
-
-        #Remove certain folders(System and Utilities per Jessie), and add entry for root folder
-        remove_folders = ["System", "Utilities"]
-        folders = list(set(folders) - set(remove_folders))
-        folders.append("")
-        folders.sort()
+        try:
+            token = token_manager.get_token(root_url=root_server_url)
+        except TokenException as te:
+            print("Error generating token: {}".format(te))
+            crawler.close()
+            sys.exit(1)
+
+        # The token is not refreshed, since a mismatch is the behavior under investigation.
+        try:
+            folders, services_url = crawler.list_folders(root_url=root_server_url, token=token, refresh_token=False)
+        except RequestFailedException as rfe:
+            print(f"Folders unavailable on {machine}: {rfe}")
+            crawler.close()
+            sys.exit(1)
 
         # Build machine objects to store the machine names, tokens, urls, etc.
         machine_obj = Machine_Objects(machine_name=machine, root_url=root_server_url, services_url=services_url, token=token, folders=folders)
         machine_objects_list.append(machine_obj)
         print(machine_obj)
 
-    # Step into each machine and get its token
+    # Build the matrix. Every machine's token is used against every machine, for every folder on that machine,
+    #   and the whole matrix is repeated to put the machines under the concurrent load where mismatches appear.
+    cells = []
+    for repetition in range(1, MATRIX_REPETITIONS + 1):
+        for outer_machine_object in machine_objects_list:
+            for inner_machine_object in machine_objects_list:
+                for folder in inner_machine_object.folders_list:
+                    if folder != "":
+                        folder += "/"
+                    cells.append({"repetition": repetition,
+                                  "token_machine": outer_machine_object.machine_name,
+                                  "token": outer_machine_object.token,
+                                  "target_machine": inner_machine_object.machine_name,
+                                  "target_services_url": inner_machine_object.services_url,
+                                  "folder": folder})
+
+    # Using the token from the outer machine, make requests for admin services, which require token use, to all
+    #   four machines at once. Looking for Client Mismatch issues.
+    print(f"\nMatrix: {len(cells)} requests, {MATRIX_REPETITIONS} repetition(s), {MATRIX_WORKERS} worker(s)")
+    matrix_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=MATRIX_WORKERS) as executor:
+        results = list(executor.map(run_matrix_cell, cells))
+    print(f"\tWall-clock: {time.perf_counter() - matrix_start:.2f}s")
+
+    outcome_counts = Counter(
+        (result["token_machine"], result["target_machine"], result["result"]) for result in results)
     for outer_machine_object in machine_objects_list:
         print(f"Outer Machine: {outer_machine_object.machine_name}")
-        focus_token = outer_machine_object.token
-
-        # Using the token from the outer machine, step into all four machines and make requests for admin services
-        #   which require token use. Looking for Client Mismatch issues.
         for inner_machine_object in machine_objects_list:
-            print(f"\tInner Machine: {inner_machine_object.machine_name}")
-            for folder in inner_machine_object.folders_list:
-                if folder != "":
-                    folder += "/"
-                reportUrl = os.path.join(inner_machine_object.services_url, folder, "report")
-                report_request_params = create_params_for_request(token_action=focus_token)
-
-                """In the next step, a return will only occur if the report key is found in the response. If the 
-                client mismatch error occurs with the token then the 'reports' key will not be in the response json and
-                an KeyError exception will be thrown"""
-                reports = get_value_from_response(serverURL=reportUrl, params=report_request_params,
-                                                  search_key="reports")
-                # print(f"\tReport: {reports}")
-            print("\tAll folders accessed")
+            counts = {outcome: outcome_counts[(outer_machine_object.machine_name, inner_machine_object.machine_name,
+                                               outcome)]
+                      for outcome in ("success", "mismatch", "error")}
+            print(f"\tInner Machine: {inner_machine_object.machine_name} - {counts['success']} success, "
+                  f"{counts['mismatch']} mismatch, {counts['error']} error")
+
+    write_matrix_report(results=results, report_path=MATRIX_REPORT)
+    print(f"\nMatrix report written to {MATRIX_REPORT}.csv and {MATRIX_REPORT}.json")
+
+    profiler.print_summary()
+    profiler.write(path=f"{MATRIX_REPORT}.profile.json")
+
+    print(f"\nTOKENS: {token_manager.generated_count} generated, {token_manager.reused_count} reused from cache")
+    client.print_connection_summary()
+    crawler.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
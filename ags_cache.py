@@ -0,0 +1,378 @@
+"""
+On-disk cache of responses from the ArcGIS Server machines, used for the layer lists of the MapServer services.
+
+A layer list rarely changes between runs. The cache keeps the value under the key of interest of each response, by
+service path, so any machine's answer can stand in for another's. Values are stored content-addressed: each distinct
+value is written once, to objects/<sha1 of the value>.json, and the services sharing it point at the same file. An
+index.json maps each key to its object, the validators the server sent with it, and when it was fetched, listed from
+least to most recently used. Once the objects exceed the size limit the least recently used keys are evicted.
+
+Within a run a key is requested at most once:
+    - a key cached with an ETag or Last-Modified is revalidated with a conditional request, and a 304 Not Modified
+      answer serves the cached value
+    - a key cached without validators is served without a request until it is older than the ttl, then fetched again
+    - concurrent lookups of the same key are coalesced into one request, whose result is shared by every caller
+    - once fetched or revalidated, a key is served from the cache for the rest of the run
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    layer_cache_directory   directory of the layer cache, relative to the project, empty for no cache (default none)
+    layer_cache_max_mb      size limit of the cached values in MiB (default 64)
+    layer_cache_ttl         seconds a value cached without validators is served without a request (default 86400)
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from ags_output import atomic_output_file
+
+INDEX_VERSION = 1
+
+
+class InFlightRequest:
+    """The request for a key being made on behalf of every caller looking the key up meanwhile."""
+    __slots__ = ("event", "value", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """Size-bounded, least recently used, content-addressed cache of response values on disk."""
+    CONFIG_SECTION = "crawl_settings"
+
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, ttl=86400.0):
+        """
+        Instantiate a ResponseCache, loading the index left by a previous run
+        :param directory: directory of the cache, created when missing
+        :param max_bytes: size limit of the cached values in bytes
+        :param ttl: seconds a value cached without validators is served without a request
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hit_count = 0
+        self.revalidated_count = 0
+        self.miss_count = 0
+        self.coalesced_count = 0
+        self.evicted_count = 0
+        self._entries = OrderedDict()
+        self._references = Counter()
+        self._object_sizes = {}
+        self._total_bytes = 0
+        self._validated = set()
+        self._in_flight = {}
+        self._dirty = False
+        self._write_failed = False
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        self._load()
+
+    @classmethod
+    def from_config(cls, config, root_path):
+        """
+        Create the layer cache using the [crawl_settings] values of a config.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :param root_path: project folder against which a relative layer_cache_directory is resolved
+        :return: ResponseCache, or None when no layer_cache_directory is configured
+        """
+        directory = config.get(cls.CONFIG_SECTION, "layer_cache_directory", fallback="")
+        if not directory:
+            return None
+        return cls(directory=os.path.join(root_path, directory),
+                   max_bytes=int(config.getfloat(cls.CONFIG_SECTION, "layer_cache_max_mb", fallback=64.0)
+                                 * 1024 * 1024),
+                   ttl=config.getfloat(cls.CONFIG_SECTION, "layer_cache_ttl", fallback=86400.0))
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, "index.json")
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, "objects", f"{digest}.json")
+
+    def _load(self):
+        """
+        Read the index left by a previous run, dropping keys whose object is missing and objects no key points at.
+        Temporary files, which another process may still be writing, are left alone. An unreadable index starts an
+        empty cache.
+        :return: None
+        """
+        entries = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r') as index_file_handler:
+                    index = json.load(index_file_handler)
+            except (OSError, ValueError) as e:
+                print(f"Layer cache index ignored, unable to read {self.index_path}: {e}")
+            else:
+                if index.get("version") == INDEX_VERSION:
+                    entries = index["entries"]
+        for key, entry in entries.items():
+            digest = entry["digest"]
+            if digest not in self._object_sizes:
+                try:
+                    self._object_sizes[digest] = os.path.getsize(self._object_path(digest=digest))
+                except OSError:
+                    continue
+                self._total_bytes += self._object_sizes[digest]
+            self._entries[key] = entry
+            self._references[digest] += 1
+        for file_name in os.listdir(os.path.join(self.directory, "objects")):
+            if file_name.endswith(".tmp"):
+                continue
+            if file_name[:-len(".json")] not in self._object_sizes:
+                os.remove(os.path.join(self.directory, "objects", file_name))
+
+    def _read_object(self, digest):
+        """
+        Read a cached value, checking it against its digest.
+        :param digest: sha1 hex digest of the value's json
+        :return: the value, or None when its file is missing or damaged
+        """
+        try:
+            with open(self._object_path(digest=digest), 'rb') as object_file_handler:
+                body = object_file_handler.read()
+        except OSError:
+            return None
+        if hashlib.sha1(body).hexdigest() != digest:
+            return None
+        return json.loads(body)
+
+    def _write_object(self, body, digest):
+        """
+        Write a value's json to its object file. A cache does not need the file to survive a crash, so it is replaced
+        atomically but not synced to disk.
+        :param body: bytes of the value's json
+        :param digest: sha1 hex digest of body
+        :return: None
+        """
+        file_descriptor, temp_path = tempfile.mkstemp(prefix=f".{digest}.", suffix=".tmp",
+                                                      dir=os.path.join(self.directory, "objects"))
+        try:
+            with os.fdopen(file_descriptor, 'wb') as object_file_handler:
+                object_file_handler.write(body)
+            os.replace(temp_path, self._object_path(digest=digest))
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _store(self, key, value, validators, fetched):
+        """
+        Cache a value for a key, evicting the least recently used keys once over the size limit. A value that cannot
+        be written, e.g. to a full disk or read-only directory, is left uncached, and the first such failure reported.
+        :param key: cache key
+        :param value: json compatible value
+        :param validators: dictionary of 'etag' and 'last_modified' sent by the server, either may be None
+        :param fetched: time the value was fetched in seconds since the epoch
+        :return: None
+        """
+        body = json.dumps(value, sort_keys=True).encode("utf-8")
+        digest = hashlib.sha1(body).hexdigest()
+        # The new reference is counted under the same lock as the check for the object, so no other key's release
+        #   can delete the object in between, and an unchanged value's object is not released along the way
+        with self._lock:
+            new_object = digest not in self._references
+            self._references[digest] += 1
+        if new_object:
+            try:
+                self._write_object(body=body, digest=digest)
+            except OSError as e:
+                # The value was fetched, so it is served uncached rather than failing the lookup. The key's older
+                #   value, if any, is dropped so that it is not served in place of the newer one.
+                with self._lock:
+                    self._release(entry={"digest": digest})
+                    self._release(entry=self._entries.pop(key, None))
+                    self._dirty = True
+                    report = not self._write_failed
+                    self._write_failed = True
+                if report:
+                    print(f"Layer cache not written, serving values uncached, unable to write to {self.directory}: "
+                          f"{e}")
+                return
+            except BaseException:
+                with self._lock:
+                    self._release(entry={"digest": digest})
+                raise
+        with self._lock:
+            if digest not in self._object_sizes:
+                self._object_sizes[digest] = len(body)
+                self._total_bytes += len(body)
+            self._release(entry=self._entries.pop(key, None))
+            self._entries[key] = {"digest": digest, "etag": validators.get("etag"),
+                                  "last_modified": validators.get("last_modified"), "fetched": fetched}
+            self._validated.add(key)
+            self._dirty = True
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted_entry = self._entries.popitem(last=False)
+                self._release(entry=evicted_entry)
+                self.evicted_count += 1
+
+    def _release(self, entry):
+        """
+        Drop a key's reference to its object, deleting the object once no key points at it. Caller must hold the
+        lock.
+        :param entry: index entry of the key, or None
+        :return: None
+        """
+        if entry is None:
+            return
+        self._references[entry["digest"]] -= 1
+        if self._references[entry["digest"]] <= 0:
+            del self._references[entry["digest"]]
+            self._total_bytes -= self._object_sizes.pop(entry["digest"], 0)
+            try:
+                os.remove(self._object_path(digest=entry["digest"]))
+            except OSError:
+                pass
+
+    def _use(self, key):
+        """
+        Look up a key's entry, marking it most recently used.
+        :param key: cache key
+        :return: copy of the index entry, or None when the key is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self._dirty = True
+            return dict(entry)
+
+    def fetch(self, key, request):
+        """
+        Look up a key, making the request when the cached value cannot be served as is. Concurrent lookups of a key
+        share a single request, and an exception raised by the request is raised to every caller.
+        :param key: cache key, e.g. the path of the service
+        :param request: function called with a dictionary of validators, empty for an unconditional request,
+            returning a tuple of (value, or None when the server answered not modified, dictionary of validators)
+        :return: the value
+        """
+        with self._lock:
+            waiting_on = self._in_flight.get(key)
+            if waiting_on is None:
+                in_flight = self._in_flight[key] = InFlightRequest()
+            else:
+                self.coalesced_count += 1
+        if waiting_on is not None:
+            waiting_on.event.wait()
+            if waiting_on.error is not None:
+                raise waiting_on.error
+            return waiting_on.value
+        try:
+            in_flight.value = self._lookup(key=key, request=request)
+            return in_flight.value
+        except BaseException as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.event.set()
+
+    def _lookup(self, key, request):
+        """
+        Serve a key from the cache, revalidate it, or fetch it, as described in the module.
+        :param key: cache key
+        :param request: function making the request, see fetch
+        :return: the value
+        """
+        now = time.time()
+        entry = self._use(key=key)
+        if entry is not None:
+            validators = {"etag": entry["etag"], "last_modified": entry["last_modified"]}
+            with self._lock:
+                validated = key in self._validated
+            if validated or (not any(validators.values()) and now - entry["fetched"] < self.ttl):
+                value = self._read_object(digest=entry["digest"])
+                if value is not None:
+                    with self._lock:
+                        self.hit_count += 1
+                    return value
+            elif any(validators.values()):
+                value, response_validators = request(validators)
+                if value is None:
+                    value = self._read_object(digest=entry["digest"])
+                    if value is not None:
+                        validators = {"etag": response_validators.get("etag") or entry["etag"],
+                                      "last_modified": response_validators.get("last_modified")
+                                      or entry["last_modified"]}
+                        with self._lock:
+                            self.revalidated_count += 1
+                            current_entry = self._entries.get(key)
+                            if current_entry is not None:
+                                current_entry.update(fetched=now, **validators)
+                                self._validated.add(key)
+                                self._dirty = True
+                        if current_entry is None:
+                            # Evicted by another key's store while the request was made
+                            self._store(key=key, value=value, validators=validators, fetched=now)
+                        return value
+                else:
+                    with self._lock:
+                        self.miss_count += 1
+                    self._store(key=key, value=value, validators=response_validators, fetched=now)
+                    return value
+        value, response_validators = request({})
+        with self._lock:
+            self.miss_count += 1
+        self._store(key=key, value=value, validators=response_validators, fetched=now)
+        return value
+
+    def reset(self):
+        """
+        Start a new run: every key is revalidated or checked against the ttl again on its next lookup, and the counts
+        restart, as at the start of each daemon cycle.
+        :return: None
+        """
+        with self._lock:
+            self._validated.clear()
+            self.hit_count = 0
+            self.revalidated_count = 0
+            self.miss_count = 0
+            self.coalesced_count = 0
+            self.evicted_count = 0
+
+    def save(self):
+        """
+        Write the index, replacing it atomically, when it has changed since it was read or last written. A failure to
+        write it is reported, not raised, and the next save tries again.
+        :return: None
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            index = {"version": INDEX_VERSION, "entries": dict(self._entries)}
+            self._dirty = False
+        try:
+            with atomic_output_file(path=self.index_path) as index_file_handler:
+                json.dump(index, index_file_handler)
+        except OSError as e:
+            print(f"Layer cache index not saved to {self.index_path}: {e}")
+            with self._lock:
+                self._dirty = True
+
+    def print_summary(self):
+        """
+        Print the hit, revalidation, miss, coalescing, and eviction counts, and the size of the cache.
+        :return: None
+        """
+        lookup_count = self.hit_count + self.revalidated_count + self.miss_count + self.coalesced_count
+        served_count = self.hit_count + self.revalidated_count + self.coalesced_count
+        hit_rate = served_count / lookup_count * 100 if lookup_count else 0.0
+        with self._lock:
+            key_count = len(self._entries)
+            object_count = len(self._object_sizes)
+            total_bytes = self._total_bytes
+        print(f"\nLAYER CACHE: {lookup_count} lookups, {hit_rate:.1f}% served without a full response")
+        print(f"\t{self.hit_count} hits, {self.revalidated_count} revalidated (304), {self.miss_count} misses, "
+              f"{self.coalesced_count} coalesced, {self.evicted_count} evicted")
+        print(f"\t{key_count} keys, {object_count} objects, {total_bytes / 1024:.1f} KiB in {self.directory}")
@@ -0,0 +1,175 @@
+"""
+Shared HTTP client for requests made to the ArcGIS Server machines.
+
+Each machine (scheme, host, and port) gets its own requests.Session with a pooled, keep-alive connection adapter so
+that repeated requests to the same machine reuse an open TCP/TLS connection instead of performing a new handshake
+every time. The client also reports how many requests were served over a reused connection.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    pool_size           maximum connections kept open per machine (default 10)
+    connect_timeout     seconds allowed to establish a connection (default 10)
+    read_timeout        seconds allowed between bytes of a response (default 60)
+    verify_tls          verify server certificates (default False, the machines are accessed by name)
+    ca_bundle           path to a CA bundle used for verification; implies verify_tls
+"""
+
+import threading
+from urllib.parse import urlsplit
+
+import requests
+# urllib3 is included in requests but to manage the InsecureRequestWarning it was also imported directly
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning
+
+
+class AGSClient:
+    """Owns one pooled, keep-alive session per machine and reports connection reuse."""
+    CONFIG_SECTION = "crawl_settings"
+
+    def __init__(self, pool_size=10, connect_timeout=10.0, read_timeout=60.0, verify=False):
+        """
+        Instantiate an AGSClient
+        :param pool_size: maximum number of connections kept open to a single machine
+        :param connect_timeout: seconds allowed to establish a connection
+        :param read_timeout: seconds allowed between bytes of a response
+        :param verify: False to skip certificate verification, True to verify, or a path to a CA bundle
+        """
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify = verify
+        self._response_hooks = []
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+        # Without disabled warnings, every request would print a red warning. This is because we have chosen
+        #   'verify=False' when making requests to secure services.
+        if verify is False:
+            urllib3.disable_warnings(InsecureRequestWarning)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a client using the [crawl_settings] values of a config, falling back to defaults when absent.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :return: AGSClient
+        """
+        section = cls.CONFIG_SECTION
+        ca_bundle = config.get(section, "ca_bundle", fallback="")
+        if ca_bundle:
+            verify = ca_bundle
+        else:
+            verify = config.getboolean(section, "verify_tls", fallback=False)
+        return cls(pool_size=config.getint(section, "pool_size", fallback=10),
+                   connect_timeout=config.getfloat(section, "connect_timeout", fallback=10.0),
+                   read_timeout=config.getfloat(section, "read_timeout", fallback=60.0),
+                   verify=verify)
+
+    @staticmethod
+    def machine_key(url):
+        """
+        Create the key that identifies the machine a url points at.
+        :param url: full url of a request
+        :return: string of scheme and network location, e.g. 'https://machine.mdgov.maryland.gov:6443'
+        """
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def session_for(self, url):
+        """
+        Return the session for the machine a url points at, creating it on first use.
+        :param url: full url of a request
+        :return: requests.Session
+        """
+        key = self.machine_key(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                # pool_block keeps extra worker threads waiting for an open connection rather than opening and then
+                #   discarding connections beyond the pool size
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                session.hooks["response"].extend(self._response_hooks)
+                self._sessions[key] = session
+        return session
+
+    def add_response_hook(self, hook):
+        """
+        Register a requests response hook, called with every response received from any machine.
+        :param hook: callable accepting a requests.Response
+        :return: None
+        """
+        with self._lock:
+            self._response_hooks.append(hook)
+            for session in self._sessions.values():
+                session.hooks["response"].append(hook)
+
+    def post(self, url, data=None, timeout=None, **kwargs):
+        """
+        Submit a POST request over the pooled session for the url's machine.
+        :param url: url to which to make a request
+        :param data: parameters to accompany the request
+        :param timeout: seconds, or (connect, read) tuple, overriding the client default
+        :return: requests.Response
+        """
+        return self.session_for(url).post(url=url, data=data, timeout=timeout or self.timeout, verify=self.verify,
+                                          **kwargs)
+
+    def get(self, url, params=None, timeout=None, **kwargs):
+        """
+        Submit a GET request over the pooled session for the url's machine.
+        :param url: url to which to make a request
+        :param params: query parameters to accompany the request
+        :param timeout: seconds, or (connect, read) tuple, overriding the client default
+        :return: requests.Response
+        """
+        return self.session_for(url).get(url=url, params=params, timeout=timeout or self.timeout, verify=self.verify,
+                                         **kwargs)
+
+    def connection_stats(self):
+        """
+        Count requests and opened connections per machine. Every request beyond the opened connections was served
+        over a reused connection and saved a TCP/TLS handshake.
+        :return: dictionary of machine key to dictionary of 'requests', 'connections', and 'reused' counts
+        """
+        stats = {}
+        with self._lock:
+            sessions = dict(self._sessions)
+        for key, session in sessions.items():
+            request_count = 0
+            connection_count = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for pool_key in pools.keys():
+                    pool = pools.get(pool_key)
+                    if pool is None:
+                        continue
+                    request_count += pool.num_requests
+                    connection_count += pool.num_connections
+            stats[key] = {"requests": request_count,
+                          "connections": connection_count,
+                          "reused": max(request_count - connection_count, 0)}
+        return stats
+
+    def print_connection_summary(self):
+        """
+        Print the connection reuse counts for every machine contacted.
+        :return: None
+        """
+        print("\nCONNECTIONS:")
+        for key, counts in sorted(self.connection_stats().items()):
+            print(f"\t{key}: {counts['requests']} requests, {counts['connections']} connections opened, "
+                  f"{counts['reused']} handshakes saved")
+
+    def close(self):
+        """
+        Close every session and its pooled connections.
+        :return: None
+        """
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
@@ -0,0 +1,1044 @@
+"""
+The crawl engine of archiveDataToJSON_MOD, importable so that other jobs can reuse it in-process.
+
+collect(config) runs one crawl and returns an iterator of the service records that archiveDataToJSON_MOD writes to
+GeodataServices.json, without writing any files. A Crawler holds what a crawl shares across requests: the pooled
+client, the token manager, the profiler, the retry policy, the router across machines, the rate limits of each
+machine, and the failures skipped. It can be used step by step, as archiveDataToJSON_MOD does to add incremental
+state, history, and daemon cycles, or to reuse only its requests, as the token matrix test does.
+
+A ServiceFilter narrows a crawl to some folders, service names, types, or statuses. Only the reports of the selected
+folders are requested, and only the selected services get a record and have their layers requested. merge_records
+folds the records of such a partial crawl into the output of an earlier full run.
+
+The asyncio engine, the response recorder, and the service probe are imported only when the settings call for them,
+so a light command, like listing the folders, does not pay for them.
+
+Settings are read from the [ags_server_credentials] and [ags_prod_machine_names] sections and the optional
+[crawl_settings] section of Docs/credentials.cfg. The crawl settings are described where each is read below and in
+the module of the part they configure.
+"""
+
+import configparser
+import fnmatch
+import hashlib
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from ags_cache import ResponseCache
+from ags_client import AGSClient
+from ags_profile import RequestProfiler
+from ags_ratelimit import RateLimiter
+from ags_reports import REPORTED_TYPES, create_layers_list, create_report_objects
+from ags_retry import (DEADLINE, NETWORK, UNKNOWN, RequestFailedException, RetryPolicy, fetch_json_conditional,
+                       fetch_json_items, fetch_json_value)
+from ags_routing import MachineRouter
+from ags_tokens import TokenException, TokenManager
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+REMOVED_FOLDERS = ("System", "Utilities")    # Not reported, per Jessie
+SERVER_URL_ADMIN_SERVICES = "arcgis/admin/services"
+STATUSES = ("STARTED", "STOPPED")
+
+
+def load_config(credentials_path=None):
+    """
+    Read the config file holding the credentials, machine names, and optional settings.
+    :param credentials_path: path of the config file (default=None, Docs/credentials.cfg in the project folder)
+    :return: configparser.ConfigParser
+    """
+    config = configparser.ConfigParser()    # Need sensitive information from config file
+    config.read(filenames=credentials_path or os.path.join(PROJECT_ROOT, "Docs", "credentials.cfg"))
+    return config
+
+
+def create_fingerprint(obj):
+    """
+    Create a stable fingerprint of a json compatible object.
+    :param obj: object to fingerprint
+    :return: hex digest string
+    """
+    return hashlib.sha1(json.dumps(obj, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def create_service_fingerprint(report):
+    """
+    Fingerprint the parts of a service report that end up in the output. Volatile values in the report, like
+    instance statistics, are left out so they do not force a refresh.
+    :param report: json object with information about the service
+    :return: hex digest string
+    """
+    return create_fingerprint({"serviceName": report.get("serviceName"),
+                               "type": report.get("type"),
+                               "realTimeState": report.get("status", {}).get("realTimeState"),
+                               "isCached": report.get("properties", {}).get("isCached"),
+                               "extensions": [(extension.get("typeName"), extension.get("enabled"))
+                                              for extension in report.get("extensions", [])]})
+
+
+def create_service_key(report):
+    """
+    Create the key under which a service is stored in the incremental state.
+    :param report: json object with information about the service
+    :return: string
+    """
+    return f"{report['serviceName']}.{report['type']}"
+
+
+def apply_probe_results(record, probe_results):
+    """
+    Add a service's probe fields, when it was probed, to its record.
+    :param record: output record of the service
+    :param probe_results: dictionary returned by Crawler.probe_all_services
+    :return: None
+    """
+    fields = probe_results.get((record["Folder"], record["ServiceName"], record["Type"]))
+    if fields is not None:
+        record.update(fields)
+
+
+def merge_records(existing_records, new_records, service_filter, reported_keys):
+    """
+    Merge the records of a partial crawl into the records of an earlier run. An existing record is replaced by the new
+    record of the same service, and dropped when it matches the filter but its service no longer appears in the report
+    of its refreshed folder. Every other existing record is kept as is. New services are added at the end of their
+    folder, keeping the records grouped by folder in sorted order.
+    :param existing_records: list of records read from the output of an earlier run
+    :param new_records: list of records built by the partial crawl
+    :param service_filter: ServiceFilter of the partial crawl
+    :param reported_keys: dictionary of refreshed folder name to the set of service keys in its report
+    :return: tuple of (list of merged records, count replaced, count added, count removed)
+    """
+    new_records_by_key = {(record["Folder"], record["ServiceName"], record["Type"]): record for record in new_records}
+    merged_records = []
+    replaced_count = 0
+    removed_count = 0
+    for record in existing_records:
+        key = (record["Folder"], record["ServiceName"], record["Type"])
+        if key in new_records_by_key:
+            merged_records.append(new_records_by_key.pop(key))
+            replaced_count += 1
+        elif (record["Folder"] in reported_keys
+              and f"{record['ServiceName']}.{record['Type']}" not in reported_keys[record["Folder"]]
+              and service_filter.matches_record(record=record)):
+            removed_count += 1
+        else:
+            merged_records.append(record)
+    added_count = len(new_records_by_key)
+    merged_records.extend(new_records_by_key.values())
+    # A stable sort, so the records within a folder keep their order
+    merged_records.sort(key=lambda record: record["Folder"])
+    return merged_records, replaced_count, added_count, removed_count
+
+
+class ServiceFilter:
+    """Selects the folders and services of a partial crawl. A criterion left empty matches everything."""
+
+    def __init__(self, folders=None, service_patterns=None, types=None, statuses=None):
+        """
+        Instantiate a ServiceFilter
+        :param folders: names of the folders to crawl, matched without regard to case (default=None, every folder)
+        :param service_patterns: shell style patterns of service names, e.g. 'Transportation_*', matched without
+            regard to case (default=None, every service)
+        :param types: service types, from ags_reports.REPORTED_TYPES, matched without regard to case
+            (default=None, every type)
+        :param statuses: realTimeState values, 'STARTED' or 'STOPPED', matched without regard to case against the
+            status in the records of the earlier run when there is one, see use_existing_records
+            (default=None, every status)
+        """
+        reported_types = {service_type.lower(): service_type for service_type in REPORTED_TYPES}
+        self.folders = list(folders or [])
+        self.service_patterns = [pattern.lower() for pattern in service_patterns or []]
+        self.types = {reported_types.get(service_type.lower(), service_type) for service_type in types or []}
+        self.statuses = {status.upper() for status in statuses or []}
+        unknown_types = self.types - set(REPORTED_TYPES)
+        if unknown_types:
+            raise ValueError(f"Unknown service type: {', '.join(sorted(unknown_types))}. "
+                             f"Expected one of {', '.join(REPORTED_TYPES)}")
+        unknown_statuses = self.statuses - set(STATUSES)
+        if unknown_statuses:
+            raise ValueError(f"Unknown status: {', '.join(sorted(unknown_statuses))}. "
+                             f"Expected one of {', '.join(STATUSES)}")
+        # (folder, service name, type) to the status recorded by the earlier run
+        self.existing_statuses = {}
+
+    def use_existing_records(self, records):
+        """
+        Select services by the status recorded in the output of an earlier run rather than their current status, so
+        that a service whose status changed since is refreshed, and its record replaced, rather than left as it was.
+        Services the earlier run did not record are selected by their current status.
+        :param records: list of records read from the output of an earlier run
+        :return: None
+        """
+        self.existing_statuses = {(record["Folder"], record["ServiceName"], record["Type"]): record["Status"]
+                                  for record in records}
+
+    def select_folders(self, folders):
+        """
+        Select the filter's folders from the folders listed by a machine.
+        :param folders: list of folder names listed by the machine
+        :return: list of the selected folder names, in the order listed
+        """
+        if not self.folders:
+            return list(folders)
+        listed_folders = {folder.lower(): folder for folder in folders}
+        unknown_folders = [folder for folder in self.folders if folder.lower() not in listed_folders]
+        if unknown_folders:
+            raise ValueError(f"No such folder: {', '.join(unknown_folders)}")
+        selected_folders = {listed_folders[folder.lower()] for folder in self.folders}
+        return [folder for folder in folders if folder in selected_folders]
+
+    def matches_service(self, service_name, service_type):
+        """
+        Decide whether a service is selected by its name and type.
+        :param service_name: name of the service
+        :param service_type: type of the service, e.g. 'MapServer'
+        :return: boolean
+        """
+        if self.types and service_type not in self.types:
+            return False
+        return not self.service_patterns or any(fnmatch.fnmatchcase(service_name.lower(), pattern)
+                                                for pattern in self.service_patterns)
+
+    def matches(self, report_object):
+        """
+        Decide whether a reported service is selected by its name, type, and status, as recorded by the earlier run
+        when it has a record there, otherwise as reported now.
+        :param report_object: ReportObject of the service
+        :return: boolean
+        """
+        status = self.existing_statuses.get((report_object.folder, report_object.service_name, report_object.type),
+                                            report_object.real_time_status)
+        if self.statuses and status not in self.statuses:
+            return False
+        return self.matches_service(service_name=report_object.service_name, service_type=report_object.type)
+
+    def matches_record(self, record):
+        """
+        Decide whether the record of an earlier run is selected by its name, type, and recorded status.
+        :param record: record dictionary, as written to GeodataServices.json
+        :return: boolean
+        """
+        if self.statuses and record["Status"] not in self.statuses:
+            return False
+        return self.matches_service(service_name=record["ServiceName"], service_type=record["Type"])
+
+
+class MachineObject:
+    """Created to store machine properties and values."""
+    __slots__ = ("machine_name", "root_url", "admin_services_url", "token", "folders_list")
+
+    def __init__(self, machine_name, root_url, admin_services_url, token, folders):
+        """
+        Instantiate the machine objects
+        :param machine_name: name of the server machine
+        :param root_url: root url for machine
+        :param admin_services_url: root url for machine plus /arcgis/admin/services
+        :param token: the token generated by the machine for secure access
+        :param folders: list of folders discovered during inspection of the services
+        """
+        self.machine_name = machine_name
+        self.root_url = root_url
+        self.admin_services_url = admin_services_url
+        self.token = token
+        self.folders_list = folders
+
+    def __str__(self):
+        """
+        Overriding the __str__ builtin to control the appearance of the machine object print-out for readability.
+        :return: string
+        """
+        return (f"{self.machine_name}-->\n\t{self.root_url}\n\t{self.admin_services_url}\n\t{self.token}"
+                f"\n\t{self.folders_list}")
+
+
+class Crawler:
+    """Requests the folder reports, layers, and probes of the services on the ArcGIS Server machines."""
+    CONFIG_SECTION = "crawl_settings"
+
+    def __init__(self, config, root_path=PROJECT_ROOT, service_filter=None):
+        """
+        Instantiate a Crawler
+        :param config: configparser.ConfigParser that has read the credentials file
+        :param root_path: folder that relative paths in the config are resolved against
+        :param service_filter: ServiceFilter selecting the services to build and request layers for
+            (default=None, every service)
+        """
+        section = Crawler.CONFIG_SECTION
+        self.server_machine_names = {0: config['ags_prod_machine_names']["machine1"],
+                                     1: config['ags_prod_machine_names']["machine2"],
+                                     2: config['ags_prod_machine_names']["machine3"],
+                                     3: config['ags_prod_machine_names']["machine4"]}
+        self.server_port_secure = config['ags_prod_machine_names']["secureport"]
+        self.server_root_url = config.get(section, "server_root_url",
+                                          fallback="https://{machine_name}.mdgov.maryland.gov:{port}")
+
+        # The engine is 'sync', running the crawl as thread pool stages, or 'async', running it as an asyncio task
+        #   graph. With either engine, the requests to each machine are held to its rate limiter's limits.
+        self.async_workers = config.getint(section, "async_workers", fallback=16)
+        self.engine = config.get(section, "engine", fallback="sync")
+        #   A worker count of 1 reproduces the original one-folder-at-a-time behavior.
+        self.folder_report_workers = config.getint(section, "folder_report_workers", fallback=8)
+        #   Layers reused from a previous run are refreshed once they are older than this.
+        self.incremental_max_age_hours = config.getfloat(section, "incremental_max_age_hours", fallback=24.0)
+        #   A layer lookup gets this many seconds in all, across its attempts and machines, so that one hung map
+        #   service cannot hold up the layer stage. Time spent waiting for a request slot before the first attempt
+        #   does not count.
+        self.layer_request_timeout = config.getfloat(section, "layer_request_timeout", fallback=30.0)
+        self.layer_workers = config.getint(section, "layer_workers", fallback=8)
+        #   Sharded mode spreads the report and layer requests across all machines instead of one random machine.
+        self.failure_cooldown = config.getfloat(section, "failure_cooldown", fallback=30.0)
+        self.routing = config.get(section, "routing", fallback="least_loaded")
+        self.sharded = config.getboolean(section, "sharded", fallback=False)
+        #   Streamed folder reports are parsed one service at a time as they download, each handed straight to the
+        #   folder processing, rather than decoding the whole response first.
+        self.stream_reports = config.getboolean(section, "stream_reports", fallback=False)
+        #   The probe stage times a request to every started service of the refreshed folders, adding the latency
+        #   and any error to its record.
+        self.probe = config.getboolean(section, "probe", fallback=False)
+        self.probe_workers = config.getint(section, "probe_workers", fallback=8)
+        #   A record directory saves the responses of the run for replay, and server_root_url can point the crawl
+        #   at the replay server, e.g. http://127.0.0.1:{port}
+        record_directory = config.get(section, "record_directory", fallback="")
+
+        # Times every request by machine, endpoint kind, folder, and service, and counts the bytes received.
+        self.profiler = RequestProfiler.from_config(config=config)
+        # One pooled, keep-alive session per machine. Certificate verification stays off by default, per Jessie's
+        #   design.
+        self.client = AGSClient.from_config(config=config)
+        self.client.add_response_hook(self.profiler.response_hook)
+        if record_directory:
+            from ags_replay import ResponseRecorder
+            self.recorder = ResponseRecorder(directory=os.path.join(root_path, record_directory))
+            self.client.add_response_hook(self.recorder.response_hook)
+        else:
+            self.recorder = None
+        # Failed requests are retried a limited number of times with backoff. Items still failing are recorded and
+        #   skipped.
+        self.retry_policy = RetryPolicy.from_config(config=config)
+        # Tokens are reused until shortly before they expire, and across runs when a token_cache_path is configured.
+        self.token_manager = TokenManager.from_config(config=config, client=self.client, root_path=root_path,
+                                                      profiler=self.profiler, retry_policy=self.retry_policy)
+        self.failures = []
+        # Limits on the requests in flight and started per second on each machine, shared by the report, layer, and
+        #   probe requests, and adapted to the machine's response times and errors. They carry over daemon cycles.
+        self.rate_limiter = RateLimiter.from_config(config=config)
+        self.client.add_response_hook(self.rate_limiter.response_hook)
+        # Probes of the started services, sharing the pooled client
+        if self.probe:
+            from ags_probe import ServiceProbe
+            self.service_probe = ServiceProbe.from_config(config=config, client=self.client)
+        else:
+            self.service_probe = None
+        # The layer lists of map services are cached across runs, when a layer_cache_directory is configured
+        self.layer_cache = ResponseCache.from_config(config=config, root_path=root_path)
+        # Folder name to the start time of the last crawl that retrieved its report
+        self.folder_refreshed = {}
+        self.service_filter = service_filter
+
+        # Set for each crawl by connect and crawl
+        self.machine = None
+        self.router = None
+        self.previous_state = {}
+        self.refreshed_time = None
+
+    @staticmethod
+    def create_params_for_request(token_action=None):
+        """
+        Create parameters to be submitted with the request.
+        :param token_action: route to be taken when creating the parameters
+        :return: dictionary of parameters
+        """
+        if token_action == None:
+            values = {'f': 'json'}
+        else:
+            values = {'token': token_action, 'f': 'json'}
+        return values
+
+    @staticmethod
+    def clean_url_slashes(url):
+        """
+        Standardize the slashes when use of os.path.join() with forward slashes in url's.
+        os.path.join() uses back slashes '\\' while http uses forward slashes '/'
+        :param url: url to be examined
+        :return: standardized url string
+        """
+        url = url.replace("\\", "/")
+        return url
+
+    @staticmethod
+    def create_random_int(upper_integer):
+        """
+        Create and return a random integer from 0 to one less than the upper range value.
+        :param upper_integer: upper integer of range to be used
+        :return: integer
+        """
+        options = upper_integer - 1
+        spot = random.randint(0, options)
+        return spot
+
+    def get_value_from_response(self, url, params, search_key, timeout=None, consume=None, refresh_token=True,
+                                validators=None, deadline=None):
+        """
+        Submit a request with parameters to a url and inspect the response json for the specified key of interest.
+        Failures are retried with backoff according to the retry policy, refreshing the token when it is rejected. A
+        request still failing raises RequestFailedException, left to the caller to report with what was requested.
+        :param url: url to which to make a request
+        :param params: parameters to accompany the request
+        :param search_key: the key of interest in the response json
+        :param timeout: seconds to wait on the server before giving up (default=None, client default)
+        :param consume: function to which the elements of the array under the key are streamed as they are parsed
+            (default=None, the response is decoded whole)
+        :param refresh_token: refresh a rejected token before retrying (default=True)
+        :param validators: dictionary of the validators of a cached copy, empty for none, to make a conditional GET
+            request (default=None, an unconditional POST request)
+        :param deadline: time.monotonic() by which the request must be answered, attempts included (default=None)
+        :return: content of json if key present in response, or the value returned by consume, or for a conditional
+            request the tuple returned by fetch_json_conditional
+        """
+        # To deal with mixed path characters between url syntax and os.path.join use of "\"
+        url = self.clean_url_slashes(url)
+        if refresh_token:
+            token_manager = self.token_manager
+        else:
+            token_manager = None
+
+        # FROM ORIGINAL DESIGN HANDLING CLIENT MISMATCH ERROR CONCERNING TOKEN RECOGNITION
+        # To deal with the client mismatch error we were encountering, we used a 'While' to make repeated requests as
+        #   a bypass. The retry policy now does this with a limit on attempts, a pause between them, and a fresh token.
+        if consume is not None:
+            return fetch_json_items(client=self.client,
+                                    url=url,
+                                    params=params,
+                                    search_key=search_key,
+                                    consume=consume,
+                                    retry_policy=self.retry_policy,
+                                    token_manager=token_manager,
+                                    timeout=timeout,
+                                    deadline=deadline)
+        if validators is not None:
+            return fetch_json_conditional(client=self.client,
+                                          url=url,
+                                          params=params,
+                                          search_key=search_key,
+                                          retry_policy=self.retry_policy,
+                                          validators=validators,
+                                          token_manager=token_manager,
+                                          timeout=timeout,
+                                          deadline=deadline)
+        return fetch_json_value(client=self.client,
+                                url=url,
+                                params=params,
+                                search_key=search_key,
+                                retry_policy=self.retry_policy,
+                                token_manager=token_manager,
+                                timeout=timeout,
+                                deadline=deadline)
+
+    def list_folders(self, root_url, token, refresh_token=True):
+        """
+        Request the folders of the services directory of a machine.
+        :param root_url: root url of the machine
+        :param token: token for the machine
+        :param refresh_token: refresh a rejected token before retrying (default=True)
+        :return: tuple of (sorted list of folder names, with "" for the root folder, admin services url)
+        """
+        request_params_result = self.create_params_for_request(token_action=token)
+        admin_services_full_url = self.clean_url_slashes(os.path.join(root_url, SERVER_URL_ADMIN_SERVICES))
+        with self.profiler.measure(kind="folders", machine=root_url):
+            folders = self.get_value_from_response(url=admin_services_full_url,
+                                                   params=request_params_result,
+                                                   search_key="folders",
+                                                   refresh_token=refresh_token)
+
+        #   Remove certain folders (System and Utilities per Jessie), and append entry for root folder
+        folders = list(set(folders) - set(REMOVED_FOLDERS))
+        folders.append("")
+        folders.sort()
+        return folders, admin_services_full_url
+
+    def connect(self):
+        """
+        Select a machine at random, get its token, route requests across the machines, and list the folders.
+        :return: MachineObject for the selected machine
+        """
+        #   Select a machine at random to which to make a request.
+        self.machine = self.server_machine_names[self.create_random_int(upper_integer=len(self.server_machine_names))]
+        print(f"MACHINE: {self.machine}")
+
+        #   Get a token, reusing a cached one when it is not about to expire
+        root_server_url = self.server_root_url.format(machine_name=self.machine, port=self.server_port_secure)
+        token = self.token_manager.get_token(root_url=root_server_url)
+
+        #   Requests are routed across every machine in sharded mode, otherwise only to the selected machine
+        if self.sharded:
+            router_root_urls = [self.server_root_url.format(machine_name=machine_name, port=self.server_port_secure)
+                                for machine_name in self.server_machine_names.values()]
+            print(f"SHARDED ACROSS: {', '.join(self.server_machine_names.values())}")
+        else:
+            router_root_urls = [root_server_url]
+        self.router = MachineRouter(root_urls=router_root_urls, strategy=self.routing,
+                                    failure_cooldown=self.failure_cooldown)
+
+        #   Make a request for secure services using the token
+        folders, admin_services_full_url = self.list_folders(root_url=root_server_url, token=token)
+
+        #   Create a machine object for the selected ArcGIS Server machine.
+        return MachineObject(machine_name=self.machine,
+                             root_url=root_server_url,
+                             admin_services_url=admin_services_full_url,
+                             token=token,
+                             folders=folders)
+
+    def get_value_from_machines(self, path, search_key, kind, folder=None, service=None, use_token=True, timeout=None,
+                                consume=None, validators=None, time_limit=None):
+        """
+        Make a request to the machine chosen by the router, failing over to the remaining machines when one errors.
+        The request counts toward the chosen machine's load while it waits for a slot from the machine's rate limiter.
+        Each machine's attempt is timed by the profiler.
+        :param path: url path below the machine root, e.g. 'arcgis/admin/services/Folder/report'
+        :param search_key: the key of interest in the response json
+        :param kind: endpoint kind recorded in the profile, e.g. 'report'
+        :param folder: folder recorded in the profile (default=None)
+        :param service: service recorded in the profile (default=None)
+        :param use_token: send the chosen machine's token with the request (default=True)
+        :param timeout: seconds to wait on the server before giving up (default=None, client default)
+        :param consume: function to which the elements of the array under the key are streamed (default=None)
+        :param validators: validators of a cached copy for a conditional request, see get_value_from_response
+            (default=None)
+        :param time_limit: seconds in which the request must be answered, across its attempts and machines, counted
+            from when the first machine's slot is held, so that time queued behind other requests does not count. No
+            further machine is tried once it has passed (default=None, no limit)
+        :return: content of json if key present in response, or the value returned by consume, or for a conditional
+            request the tuple returned by fetch_json_conditional
+        """
+        tried = set()
+        failure = None
+        attempts = 0
+        deadline = None
+        root_url = self.router.choose(exclude=tried)
+        while root_url is not None:
+            tried.add(root_url)
+            with self.rate_limiter.slot(root_url=root_url, kind=kind) as outcome:
+                if time_limit is not None and deadline is None:
+                    deadline = time.monotonic() + time_limit
+                if deadline is not None and time.monotonic() >= deadline:
+                    failure = RequestFailedException(url=path, error_class=DEADLINE, attempts=0,
+                                                     message="The deadline passed while waiting for a request slot")
+                    self.router.cancel(root_url=root_url)
+                    break
+                start = time.perf_counter()
+                try:
+                    if use_token:
+                        params = self.create_params_for_request(
+                            token_action=self.token_manager.get_token(root_url=root_url))
+                    else:
+                        params = self.create_params_for_request()
+                    with self.profiler.measure(kind=kind, machine=root_url, folder=folder, service=service):
+                        value = self.get_value_from_response(url=f"{root_url}/{path}",
+                                                             params=params,
+                                                             search_key=search_key,
+                                                             timeout=timeout,
+                                                             consume=consume,
+                                                             validators=validators,
+                                                             deadline=deadline)
+                except (RequestFailedException, TokenException) as e:
+                    self.router.end(root_url=root_url, seconds=time.perf_counter() - start, succeeded=False)
+                    outcome["unanswered"] = getattr(e, "error_class", None) == NETWORK
+                    failure = e
+                    attempts += getattr(e, "attempts", 1)
+                except Exception:
+                    # Not a failure to fail over from, e.g. a malformed report raising in consume, but the machine
+                    #   must not keep counting the request as in flight
+                    self.router.end(root_url=root_url, seconds=time.perf_counter() - start, succeeded=False)
+                    raise
+                else:
+                    self.router.end(root_url=root_url, seconds=time.perf_counter() - start, succeeded=True)
+                    return value
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            root_url = self.router.choose(exclude=tried)
+        # The class of the last failure, unknown when no machine could be tried
+        raise RequestFailedException(url=path,
+                                     error_class=getattr(failure, "error_class", None) or UNKNOWN,
+                                     attempts=attempts,
+                                     message=f"No machine of {len(tried)} tried succeeded. Last error: {failure}")
+
+    def fetch_folder_report(self, folder):
+        """
+        Request the service reports for a single folder and time the round trip. When streaming, the folder's entries
+        are built as the reports arrive and returned in place of the reports.
+        :param folder: the folder in the services directory
+        :return: tuple of (list of service reports, or when streaming the result of build_folder_entries, or None
+            when the request failed, seconds spent on the request)
+        """
+        if self.stream_reports:
+            consume = self.create_folder_consumer(folder=folder)
+        else:
+            consume = None
+        start = time.perf_counter()
+        try:
+            reports = self.get_value_from_machines(path=f"{SERVER_URL_ADMIN_SERVICES}/{folder}/report",
+                                                   search_key="reports",
+                                                   kind="report",
+                                                   folder=folder,
+                                                   consume=consume)
+        except RequestFailedException as rfe:
+            print(f"Reports unavailable for folder {folder}, skipping it: {rfe}")
+            self.failures.append({"item": f"folder {folder}", "error": str(rfe)})
+            reports = None
+        else:
+            self.folder_refreshed[folder] = self.refreshed_time
+        return reports, time.perf_counter() - start
+
+    def fetch_folder_reports(self, folders, workers):
+        """
+        Request the service reports for the given folders, in parallel when more than one worker is allowed. Results
+        are keyed by folder so that the caller controls the order in which folders are written.
+        :param folders: list of folders to request, without the root folder
+        :param workers: maximum number of report requests in flight at one time
+        :return: dictionary of folder name to list of service reports, or to the folder's result when streaming
+        """
+        stage_start = time.perf_counter()
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self.fetch_folder_report, folders))
+        else:
+            results = [self.fetch_folder_report(folder=folder) for folder in folders]
+        stage_seconds = time.perf_counter() - stage_start
+
+        # The summed request time is what a strictly serial run would have spent waiting on the network.
+        request_seconds = sum(elapsed for _, elapsed in results)
+        print(f"\nFOLDER REPORTS: {len(folders)} requests, {workers} worker(s)")
+        print(f"\tWall-clock: {stage_seconds:.2f}s, summed request time: {request_seconds:.2f}s, "
+              f"saved: {max(request_seconds - stage_seconds, 0.0):.2f}s")
+        return {folder: reports for folder, (reports, _) in zip(folders, results)}
+
+    def fetch_layers(self, report_object):
+        """
+        Request the layers of a started MapServer service and store them on the report object. With a layer cache,
+        the layers are looked up there by the service's path, and requested only when the cache cannot serve them.
+        A failed or timed out request marks only this service's layers as "NA" rather than ending the run. The lookup
+        is given layer_request_timeout seconds in all from when it holds a request slot, so a hung service is not
+        retried on every machine, and a service queued behind the others is not timed out by their requests.
+        :param report_object: ReportObject for a started MapServer service
+        :return: None
+        """
+        # Any machine can answer for the service, so only the path of the machine url is used
+        layers_path = urlsplit(report_object.rest_service_url_machine).path.lstrip("/")
+
+        def request_layers(validators=None):
+            return self.get_value_from_machines(path=layers_path,
+                                                search_key="layers",
+                                                kind="layers",
+                                                folder=report_object.folder,
+                                                service=report_object.service_name,
+                                                use_token=False,
+                                                validators=validators,
+                                                time_limit=self.layer_request_timeout)
+        try:
+            if self.layer_cache is not None:
+                layers = self.layer_cache.fetch(key=layers_path, request=request_layers)
+            else:
+                layers = request_layers()
+        except RequestFailedException as rfe:
+            print(f"Layers unavailable for {report_object.folder}/{report_object.service_name}: {rfe}")
+            self.failures.append({"item": f"layers {report_object.folder}/{report_object.service_name}",
+                                  "error": str(rfe)})
+            report_object.layers = "NA"
+        else:
+            report_object.layers = create_layers_list(layers=layers)
+
+    def fetch_all_layers(self, report_objects, workers):
+        """
+        Request the layers for many MapServer services, in parallel when more than one worker is allowed.
+        :param report_objects: list of ReportObjects for started MapServer services
+        :param workers: maximum number of layer requests in flight at one time
+        :return: None
+        """
+        stage_start = time.perf_counter()
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self.fetch_layers, report_objects))
+        else:
+            for report_object in report_objects:
+                self.fetch_layers(report_object=report_object)
+        print(f"\nLAYERS: {len(report_objects)} requests, {workers} worker(s)")
+        print(f"\tWall-clock: {time.perf_counter() - stage_start:.2f}s")
+
+    def probe_service(self, target):
+        """
+        Probe a started service on the machine chosen by the router, within the machine's rate limits. A probe is a
+        single attempt, so there is no failover to another machine.
+        :param target: tuple of (folder, service name, service type)
+        :return: dictionary of probe fields for the service's record
+        """
+        folder, service_name, service_type = target
+        root_url = self.router.choose()
+        with self.rate_limiter.slot(root_url=root_url, kind="probe") as outcome:
+            start = time.perf_counter()
+            unreachable = True
+            try:
+                with self.profiler.measure(kind="probe", machine=root_url, folder=folder, service=service_name):
+                    fields, unreachable = self.service_probe.probe(
+                        service_url=f"{root_url}/arcgis/rest/services/{folder}/{service_name}/{service_type}",
+                        service_type=service_type)
+            finally:
+                # The machine must not keep counting the probe as in flight, however it ended
+                self.router.end(root_url=root_url, seconds=time.perf_counter() - start, succeeded=not unreachable)
+            outcome["unanswered"] = unreachable
+        return fields
+
+    def probe_all_services(self, targets, workers):
+        """
+        Probe many started services, in parallel when more than one worker is allowed.
+        :param targets: list of (folder, service name, service type) tuples
+        :param workers: maximum number of probes in flight at one time
+        :return: dictionary of (folder, service name, service type) to dictionary of probe fields
+        """
+        stage_start = time.perf_counter()
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(self.probe_service, targets))
+        else:
+            results = [self.probe_service(target=target) for target in targets]
+        print(f"\nPROBES: {len(targets)} requests, {workers} worker(s)")
+        print(f"\tWall-clock: {time.perf_counter() - stage_start:.2f}s")
+        return dict(zip(targets, results))
+
+    @staticmethod
+    def create_probe_targets(folders, folder_entries, folders_state):
+        """
+        List the started services of the given folders, from the entries of rebuilt folders and the records of
+        reused ones.
+        :param folders: list of folders to probe
+        :param folder_entries: dictionary of folder name to the entries of a rebuilt folder
+        :param folders_state: dictionary of folder name to the state of a reused folder
+        :return: list of (folder, service name, service type) tuples
+        """
+        targets = []
+        for folder in folders:
+            if folder in folder_entries:
+                for entry in folder_entries[folder]:
+                    report_object = entry["report_object"]
+                    if report_object is not None and report_object.real_time_status == "STARTED":
+                        targets.append((report_object.folder, report_object.service_name, report_object.type))
+            elif folder in folders_state:
+                for service_state in folders_state[folder]["services"].values():
+                    record = service_state["record"]
+                    if record is not None and record["Status"] == "STARTED":
+                        targets.append((record["Folder"], record["ServiceName"], record["Type"]))
+        return targets
+
+    def is_service_reusable(self, service_state, fingerprint):
+        """
+        Decide whether a service's state from the previous run can stand in for rebuilding it. The report must be
+        unchanged, and started map services must have layers that were fetched successfully and recently enough.
+        :param service_state: the service's state from the previous run, or None
+        :param fingerprint: fingerprint of the service's current report
+        :return: boolean
+        """
+        if service_state is None or service_state["fingerprint"] != fingerprint:
+            return False
+        record = service_state["record"]
+        if record is None or record["Type"] != "MapServer" or record["Status"] != "STARTED":
+            return True
+        if record["layers"] == "NA" or service_state["layers_refreshed"] is None:
+            return False
+        return time.time() - service_state["layers_refreshed"] < self.incremental_max_age_hours * 3600
+
+    def build_folder_entries(self, folder, reports, previous_folder_state, machine_name, refreshed_time):
+        """
+        Build a report object for each service of interest in a folder. Started map services reuse the previous run's
+        layers when their report is unchanged, the rest are returned so their layers can be requested. The reports are
+        read once, in order, so they can be handed over while still arriving from a streamed response.
+        :param folder: name of the folder in the services directory, never the root folder
+        :param reports: iterable of service reports for the folder
+        :param previous_folder_state: the folder's state from the previous run, empty when there is none
+        :param machine_name: the name of the ags server machine currently being interrogated for information
+        :param refreshed_time: time recorded for layers requested during this run
+        :return: tuple of (list of entries, or None when the previous run's folder is reused unchanged,
+            list of report objects needing layers, count of layer lists reused)
+        """
+        previous_services = previous_folder_state.get("services", {})
+        service_fingerprints = {}
+        layers_pending = []
+        layers_reused_count = 0
+
+        # Inspect service reports
+        entries = []
+        for report, report_object in create_report_objects(reports=reports,
+                                                           folder=folder,
+                                                           machine_name=machine_name,
+                                                           port=self.server_port_secure):
+            service_key = create_service_key(report)
+            service_fingerprints[service_key] = create_service_fingerprint(report)
+            entry = {"key": service_key,
+                     "fingerprint": service_fingerprints[service_key],
+                     "layers_refreshed": None,
+                     "report_object": None}
+            entries.append(entry)
+            if report_object is None:
+                continue
+            if self.service_filter is not None and not self.service_filter.matches(report_object=report_object):
+                # Left out of a partial crawl, so no record is built and no layers are requested
+                continue
+
+            # Started map services reuse the previous run's layers when their report is unchanged, otherwise they
+            #   are filled in by the layer stage.
+            if report_object.type == "MapServer" and report_object.real_time_status == "STARTED":
+                previous_service_state = previous_services.get(service_key)
+                if self.is_service_reusable(service_state=previous_service_state, fingerprint=entry["fingerprint"]):
+                    report_object.layers = previous_service_state["record"]["layers"]
+                    entry["layers_refreshed"] = previous_service_state["layers_refreshed"]
+                    layers_reused_count += 1
+                else:
+                    entry["layers_refreshed"] = refreshed_time
+                    layers_pending.append(report_object)
+            entry["report_object"] = report_object
+
+        # An unchanged folder whose services are all still reusable is taken as is from the previous run
+        folder_fingerprint = create_fingerprint(service_fingerprints)
+        if (previous_folder_state.get("fingerprint") == folder_fingerprint
+                and all(self.is_service_reusable(service_state=previous_services.get(service_key),
+                                                 fingerprint=fingerprint)
+                        for service_key, fingerprint in service_fingerprints.items())):
+            print(f"\tFolder {folder} unchanged since previous run")
+            return None, [], 0
+        return entries, layers_pending, layers_reused_count
+
+    def create_folder_consumer(self, folder):
+        """
+        Create the function that builds a folder's entries from its reports while they are streamed in.
+        :param folder: the folder in the services directory
+        :return: function accepting an iterator of service reports and returning the result of build_folder_entries
+        """
+        def consume(reports):
+            return self.build_folder_entries(folder=folder,
+                                             reports=reports,
+                                             previous_folder_state=self.previous_state.get(folder, {}),
+                                             machine_name=self.machine,
+                                             refreshed_time=self.refreshed_time)
+        return consume
+
+    @staticmethod
+    def create_failed_folder_result(folder, previous_state):
+        """
+        Stand in for a folder whose report could not be retrieved. The previous run's records are carried forward
+        when there are any, otherwise the folder is left out of the output.
+        :param folder: the folder in the services directory
+        :param previous_state: dictionary of folder name to the folder's state from the previous run
+        :return: tuple in the form returned by build_folder_entries, or None to leave the folder out
+        """
+        if folder in previous_state:
+            print(f"\tUsing the previous run's records for folder {folder}")
+            return None, [], 0
+        return None
+
+    async def crawl_async(self, machine_object, folders, previous_state, refreshed_time, workers):
+        """
+        Run the crawl as an asyncio task graph. Each folder is a task that requests its report and, as soon as the
+        report arrives, starts the layer requests for its started map services. The blocking requests run on a
+        thread pool of the given size, sharing the pooled client, tokens, and router of the synchronous engine.
+        :param machine_object: MachineObject for the machine being interrogated
+        :param folders: list of folders to crawl, without the root folder
+        :param previous_state: dictionary of folder name to the folder's state from the previous run
+        :param refreshed_time: time recorded for layers requested during this run
+        :param workers: maximum number of requests in flight at one time, across all machines
+        :return: dictionary of folder name to the tuple returned by build_folder_entries, for folders with results
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(max_workers=workers))
+
+        async def crawl_folder(folder):
+            reports, _ = await loop.run_in_executor(None, self.fetch_folder_report, folder)
+            print(f"\nFOLDER: {folder}")
+            if reports is None:
+                return self.create_failed_folder_result(folder=folder, previous_state=previous_state)
+            if self.stream_reports:
+                # The entries were built while the reports streamed in
+                result = reports
+            else:
+                result = self.build_folder_entries(folder=folder,
+                                                   reports=reports,
+                                                   previous_folder_state=previous_state.get(folder, {}),
+                                                   machine_name=machine_object.machine_name,
+                                                   refreshed_time=refreshed_time)
+            await asyncio.gather(*(loop.run_in_executor(None, self.fetch_layers, report_object)
+                                   for report_object in result[1]))
+            return result
+
+        stage_start = time.perf_counter()
+        results = await asyncio.gather(*(crawl_folder(folder) for folder in folders))
+        folder_results = {folder: result for folder, result in zip(folders, results) if result is not None}
+        print(f"\nASYNC ENGINE: {len(folders)} folder reports, "
+              f"{sum(len(result[1]) for result in folder_results.values())} layer requests, {workers} worker(s)")
+        print(f"\tWall-clock: {time.perf_counter() - stage_start:.2f}s")
+        return folder_results
+
+    def crawl(self, machine_object, folders, previous_state, refreshed_time):
+        """
+        Build a report object for each service of interest in the given folders and request the layers of started
+        map services. The async engine starts a folder's layer requests as soon as its report arrives. The synchronous
+        engine runs each step as a stage across all folders.
+        :param machine_object: MachineObject returned by connect
+        :param folders: list of folders to crawl, without the root folder
+        :param previous_state: dictionary of folder name to the folder's state from the previous run, empty for none
+        :param refreshed_time: start time of the run, recorded for the folders and layers it refreshes
+        :return: dictionary of folder name to the tuple returned by build_folder_entries, for folders with results
+        """
+        self.previous_state = previous_state
+        self.refreshed_time = refreshed_time
+        if self.engine == "async":
+            import asyncio
+            folder_results = asyncio.run(self.crawl_async(machine_object=machine_object,
+                                                          folders=folders,
+                                                          previous_state=previous_state,
+                                                          refreshed_time=refreshed_time,
+                                                          workers=self.async_workers))
+            if self.layer_cache is not None:
+                self.layer_cache.save()
+            return folder_results
+
+        #   Collect the folder reports up front so the network waits overlap. Output order follows folders_list.
+        folder_reports = self.fetch_folder_reports(folders=folders, workers=self.folder_report_workers)
+
+        #   Loop on the found folders and build a report object for each service of interest. MapServer layers are
+        #   requested afterward, in their own stage, so that one slow map service does not hold up the folder loop.
+        folder_results = {}
+        folder_iteration_count = 0
+        for folder in machine_object.folders_list:
+            print(f"\nFOLDER: {folder} - {folder_iteration_count + 1} of {len(machine_object.folders_list)}")
+
+            # Determine if the current iteration is examining the root folder. If is, do nothing
+            folder_iteration_count += 1
+            if folder == "" or folder == "/":   # Unclear why Jessie included 'folder == "/"' but am preserving
+                continue
+            if folder not in folder_reports:
+                print("\tNot refreshed this run")
+                continue
+            if folder_reports[folder] is None:
+                failed_folder_result = self.create_failed_folder_result(folder=folder, previous_state=previous_state)
+                if failed_folder_result is not None:
+                    folder_results[folder] = failed_folder_result
+                continue
+            if self.stream_reports:
+                # The entries were built while the reports streamed in
+                folder_results[folder] = folder_reports[folder]
+                continue
+            folder_results[folder] = self.build_folder_entries(folder=folder,
+                                                               reports=folder_reports[folder],
+                                                               previous_folder_state=previous_state.get(folder, {}),
+                                                               machine_name=self.machine,
+                                                               refreshed_time=refreshed_time)
+
+        #   Handle map server layers. Functionality unique to Map Server.
+        self.fetch_all_layers(report_objects=[report_object
+                                              for _, layers_pending, _ in folder_results.values()
+                                              for report_object in layers_pending],
+                              workers=self.layer_workers)
+        if self.layer_cache is not None:
+            self.layer_cache.save()
+        return folder_results
+
+    @staticmethod
+    def create_folder_state(entries, previous_folder_state):
+        """
+        Create the records of a rebuilt folder and the state remembered for the next run.
+        :param entries: list of entries returned by build_folder_entries
+        :param previous_folder_state: the folder's state from the previous run, empty when there is none
+        :return: tuple of (folder state with the record of each service, count of services whose layers changed)
+        """
+        previous_services = previous_folder_state.get("services", {})
+        services_state = {}
+        layers_changed_count = 0
+        for entry in entries:
+            record = None
+            layers_fingerprint = None
+            if entry["report_object"] is not None:
+                record = entry["report_object"].create_record()
+            if record is not None and "layers" in record:
+                layers_fingerprint = create_fingerprint(record["layers"])
+                previous_layers_fingerprint = previous_services.get(entry["key"], {}).get("layers_fingerprint")
+                if previous_layers_fingerprint not in (None, layers_fingerprint):
+                    layers_changed_count += 1
+            services_state[entry["key"]] = {"fingerprint": entry["fingerprint"],
+                                            "layers_fingerprint": layers_fingerprint,
+                                            "layers_refreshed": entry["layers_refreshed"],
+                                            "record": record}
+        services_fingerprints = {key: state["fingerprint"] for key, state in services_state.items()}
+        return {"fingerprint": create_fingerprint(services_fingerprints), "services": services_state}, \
+            layers_changed_count
+
+    def print_summary(self, profile_path=None):
+        """
+        Print the routing, rate limits, request profile, layer cache, recording, failures, tokens, and connections of
+        the crawl.
+        :param profile_path: path to write the request profile to (default=None, not written)
+        :return: None
+        """
+        self.router.print_summary()
+        self.rate_limiter.print_summary()
+        self.profiler.print_summary()
+        if profile_path:
+            self.profiler.write(path=profile_path)
+        if self.layer_cache is not None:
+            self.layer_cache.print_summary()
+        if self.recorder is not None:
+            print(f"\nRECORDED: {self.recorder.recorded_count} responses to {self.recorder.directory}")
+        if self.failures:
+            print(f"\nFAILURES: {len(self.failures)} item(s) skipped")
+            for failure in self.failures:
+                print(f"\t{failure['item']}: {failure['error']}")
+        print(f"\nTOKENS: {self.token_manager.generated_count} generated, "
+              f"{self.token_manager.reused_count} reused from cache")
+        self.client.print_connection_summary()
+
+    def close(self):
+        if self.layer_cache is not None:
+            self.layer_cache.save()
+        self.client.close()
+
+
+def collect(config, service_filter=None, root_path=PROJECT_ROOT):
+    """
+    Run one crawl and yield the record of every reported service, folder by folder in sorted order, as written to
+    GeodataServices.json. No output, state, or profile files are written.
+    :param config: configparser.ConfigParser that has read the credentials file, see load_config
+    :param service_filter: ServiceFilter selecting the folders and services to crawl (default=None, every service)
+    :param root_path: folder that relative paths in the config are resolved against (default=the project folder)
+    :return: iterator of record dictionaries
+    """
+    crawler = Crawler(config=config, root_path=root_path, service_filter=service_filter)
+    try:
+        machine_object = crawler.connect()
+        report_folders = [folder for folder in machine_object.folders_list if folder not in ("", "/")]
+        if service_filter is not None:
+            report_folders = service_filter.select_folders(folders=report_folders)
+        folder_results = crawler.crawl(machine_object=machine_object,
+                                       folders=report_folders,
+                                       previous_state={},
+                                       refreshed_time=time.time())
+        folder_entries = {folder: entries for folder, (entries, _, _) in folder_results.items()}
+        if crawler.probe:
+            probe_targets = crawler.create_probe_targets(folders=report_folders, folder_entries=folder_entries,
+                                                         folders_state={})
+            probe_results = crawler.probe_all_services(targets=probe_targets, workers=crawler.probe_workers)
+        else:
+            probe_results = {}
+        for folder in machine_object.folders_list:
+            if folder not in folder_entries:
+                continue
+            folder_state, _ = crawler.create_folder_state(entries=folder_entries[folder], previous_folder_state={})
+            for service_state in folder_state["services"].values():
+                record = service_state["record"]
+                if record is not None:
+                    apply_probe_results(record=record, probe_results=probe_results)
+                    yield record
+    finally:
+        crawler.close()
@@ -0,0 +1,292 @@
+"""
+Daemon mode support: per-folder refresh scheduling and a local HTTP endpoint serving the latest snapshot.
+
+In daemon mode archiveDataToJSON_MOD stays resident and crawls in cycles, keeping its pooled sessions, cached tokens,
+and the previous cycle's records in memory. Each cycle lists the folders again and requests the reports of only the
+folders that are due, carrying the records of the others forward, so busy folders can refresh more often than static
+ones. A folder whose report fails is retried after the shortest interval, doubled for every failure in a row up to its
+own interval. The output files are still written every cycle, and the current snapshot is also served from memory.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    daemon              stay resident and refresh on a schedule (default False, a single run)
+    daemon_interval     seconds between refreshes of a folder without its own interval (default 900)
+    daemon_host         address of the snapshot endpoint (default 127.0.0.1)
+    daemon_port         port of the snapshot endpoint, 0 for no endpoint (default 8085)
+
+Per-folder intervals, in seconds, are read from the optional [daemon_folder_intervals] section, e.g.
+    [daemon_folder_intervals]
+    Transportation = 300
+    Imagery = 86400
+
+The endpoint answers GET / and GET /GeodataServices.json with the snapshot, gzip encoded when the client accepts it,
+and GET /status with the cycle count, refresh times, and failures of the last cycle.
+"""
+
+import gzip
+import hashlib
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from ags_http import KeepAliveRequestHandler
+
+
+class FolderSchedule:
+    """Refresh intervals of the folders and the time each was last refreshed."""
+    CONFIG_SECTION = "crawl_settings"
+    INTERVALS_SECTION = "daemon_folder_intervals"
+
+    def __init__(self, default_interval=900.0, folder_intervals=None):
+        """
+        Instantiate a FolderSchedule
+        :param default_interval: seconds between refreshes of a folder without its own interval
+        :param folder_intervals: dictionary of folder name to seconds between its refreshes
+        """
+        self.default_interval = default_interval
+        self.folder_intervals = dict(folder_intervals or {})
+        self.last_refreshed = {}
+        # Folders whose report failed, to the failures in a row and the time of the next attempt
+        self.failure_counts = {}
+        self.retry_times = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a schedule using the daemon values of a config, falling back to defaults when absent.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :return: FolderSchedule
+        """
+        folder_intervals = {}
+        if config.has_section(cls.INTERVALS_SECTION):
+            # Options are lowercased by configparser, so folders are matched without regard to case
+            folder_intervals = {folder: float(seconds) for folder, seconds in config.items(cls.INTERVALS_SECTION)}
+        return cls(default_interval=config.getfloat(cls.CONFIG_SECTION, "daemon_interval", fallback=900.0),
+                   folder_intervals=folder_intervals)
+
+    def interval(self, folder):
+        """
+        Seconds between refreshes of a folder.
+        :param folder: folder name
+        :return: float
+        """
+        return self.folder_intervals.get(folder.lower(), self.default_interval)
+
+    def shortest_interval(self):
+        """
+        Shortest interval of any folder.
+        :return: float
+        """
+        return min([self.default_interval] + list(self.folder_intervals.values()))
+
+    def is_due(self, folder, now):
+        """
+        Decide whether a folder needs refreshing. A folder whose report failed is due at its retry time, and a folder
+        never refreshed is otherwise always due.
+        :param folder: folder name
+        :param now: current time in seconds since the epoch
+        :return: boolean
+        """
+        with self._lock:
+            last_refreshed = self.last_refreshed.get(folder)
+            retry_time = self.retry_times.get(folder)
+        if retry_time is not None:
+            return now >= retry_time
+        return last_refreshed is None or now - last_refreshed >= self.interval(folder)
+
+    def mark_refreshed(self, folder, refreshed_time):
+        """
+        Record that a folder's report was retrieved.
+        :param folder: folder name
+        :param refreshed_time: time of the refresh in seconds since the epoch
+        :return: None
+        """
+        with self._lock:
+            self.last_refreshed[folder] = refreshed_time
+            self.failure_counts.pop(folder, None)
+            self.retry_times.pop(folder, None)
+
+    def mark_failed(self, folder, failed_time):
+        """
+        Record that a folder's report could not be retrieved. The folder is retried after the shortest interval,
+        doubled for every failure in a row up to the folder's own interval, rather than every cycle until its
+        machine recovers.
+        :param folder: folder name
+        :param failed_time: time of the failure in seconds since the epoch
+        :return: None
+        """
+        with self._lock:
+            failure_count = self.failure_counts.get(folder, 0) + 1
+            self.failure_counts[folder] = failure_count
+            retry_delay = min(self.shortest_interval() * 2 ** min(failure_count - 1, 16), self.interval(folder))
+            self.retry_times[folder] = failed_time + retry_delay
+
+    def next_due(self, folders, cycle_started):
+        """
+        Time at which the next of the folders becomes due. A folder whose report failed is due at its retry time, and
+        a folder with no refresh or failure recorded one interval after the start of the cycle.
+        :param folders: list of folder names
+        :param cycle_started: start time of the cycle just run
+        :return: time in seconds since the epoch
+        """
+        with self._lock:
+            return min((self.retry_times.get(folder, self.last_refreshed.get(folder, cycle_started)
+                                             + self.interval(folder))
+                        for folder in folders),
+                       default=cycle_started + self.default_interval)
+
+
+class Snapshot:
+    """The latest output of the crawl, held in memory for the snapshot endpoint."""
+
+    def __init__(self):
+        self.body = None
+        self.gzip_body = None
+        self.etag = None
+        self.status = {"cycles": 0}
+        self._lock = threading.Lock()
+
+    def update(self, body, status):
+        """
+        Replace the snapshot. The gzip copy and entity tag are computed once here, not per request.
+        :param body: bytes of the json array of service records
+        :param status: dictionary describing the cycle that produced the body
+        :return: None
+        """
+        gzip_body = gzip.compress(body, compresslevel=6)
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        with self._lock:
+            self.body = body
+            self.gzip_body = gzip_body
+            self.etag = etag
+            self.status = status
+
+    def set_status(self, status):
+        """
+        Replace the status alone, for a cycle that did not produce output.
+        :param status: dictionary describing the cycle
+        :return: None
+        """
+        with self._lock:
+            self.status = status
+
+    def get(self):
+        """
+        Consistent view of the snapshot.
+        :return: tuple of (body bytes or None, gzip body bytes or None, entity tag or None, status dictionary)
+        """
+        with self._lock:
+            return self.body, self.gzip_body, self.etag, self.status
+
+
+class SnapshotServer:
+    """Local HTTP endpoint serving a Snapshot from memory."""
+    SNAPSHOT_PATHS = ("", "GeodataServices.json")
+
+    def __init__(self, snapshot, host="127.0.0.1", port=8085):
+        """
+        Instantiate a SnapshotServer
+        :param snapshot: Snapshot to serve
+        :param host: address to listen on
+        :param port: port to listen on, 0 for any free port
+        """
+        self.snapshot = snapshot
+        self._thread = None
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _create_handler(self):
+        """
+        Create the request handler class bound to this server.
+        :return: KeepAliveRequestHandler subclass
+        """
+        snapshot = self.snapshot
+
+        class SnapshotRequestHandler(KeepAliveRequestHandler):
+
+            def do_GET(self):
+                body, gzip_body, etag, status = snapshot.get()
+                path = urlsplit(self.path).path.strip("/")
+                if path == "status":
+                    self._reply(status=200, body=json.dumps(status).encode("utf-8"))
+                elif path not in SnapshotServer.SNAPSHOT_PATHS:
+                    self._reply(status=404, body=b'{"error": "not found"}')
+                elif body is None:
+                    self._reply(status=503, body=b'{"error": "no snapshot yet"}', headers={"Retry-After": "10"})
+                elif self.headers.get("If-None-Match") == etag:
+                    self._reply(status=304, body=b"", headers={"ETag": etag})
+                elif "gzip" in self.headers.get("Accept-Encoding", ""):
+                    self._reply(status=200, body=gzip_body, headers={"ETag": etag, "Content-Encoding": "gzip",
+                                                                     "Vary": "Accept-Encoding"})
+                else:
+                    self._reply(status=200, body=body, headers={"ETag": etag, "Vary": "Accept-Encoding"})
+
+            def _reply(self, status, body, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", "no-cache")
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                if status != 304:
+                    self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return SnapshotRequestHandler
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket.
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def create_status(cycle_count, cycle_started, cycle_seconds, refreshed_folders, folder_count, next_cycle, failures,
+                  error=None):
+    """
+    Create the status served at /status.
+    :param cycle_count: number of cycles run
+    :param cycle_started: start time of the last cycle in seconds since the epoch
+    :param cycle_seconds: duration of the last cycle
+    :param refreshed_folders: list of the folders refreshed in the last cycle
+    :param folder_count: number of folders in the snapshot
+    :param next_cycle: time of the next cycle in seconds since the epoch
+    :param failures: list of failure dictionaries of the last cycle
+    :param error: message when the last cycle ended without output (default=None)
+    :return: dictionary
+    """
+    status = {"cycles": cycle_count,
+              "cycle_started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(cycle_started)),
+              "cycle_seconds": round(cycle_seconds, 3),
+              "folders": folder_count,
+              "refreshed_folders": refreshed_folders,
+              "next_cycle": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(next_cycle)),
+              "failures": failures}
+    if error is not None:
+        status["error"] = error
+    return status
@@ -0,0 +1,387 @@
+"""
+Append-only history of the service records written by each run, kept in a local SQLite database.
+
+Every run adds a row to 'runs' and, for each service of the folders whose reports were retrieved, an observation of
+its realTimeState, extension flags, and layer count. Observations are keyed by run and indexed by service, and the
+distinct combinations of flags are stored once in 'flag_sets', so a run costs a few bytes per service. Each run is
+compared with the latest observation of every service and the differences are appended to 'events' as 'added',
+'started', 'stopped', and 'removed'. Services in folders that were not retrieved, because their report failed or, in
+daemon mode, they were not due, keep their latest observation and are never reported removed.
+
+The events are a run length encoding of each service's status, so uptime over any time range is computed from them
+alone, weighted by time, without reading the observations or any earlier json output.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    history_file        SQLite database of the run history, relative to the output directory
+                        (default none, no history kept)
+    history_timeout     seconds to wait on a lock held by another reader or writer of the database (default 5)
+
+The history is recorded after the output files are published, and a database that is locked or otherwise fails is
+reported and skipped, so the history can never hold back the output.
+
+Queries can be run on their own, for example:
+    python ags_history.py GeodataServices.history.sqlite --uptime --days 7
+    python ags_history.py GeodataServices.history.sqlite --events --days 1 --service Transportation/Roads/MapServer
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+ADDED = "added"
+STARTED = "started"
+STOPPED = "stopped"
+REMOVED = "removed"
+STARTED_STATE = "STARTED"
+REMOVED_STATE = "REMOVED"
+FLAG_FIELDS = ("Cached", "FeatureService", "kml", "wms", "wfs", "wcs", "wmts")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    service_count INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+CREATE TABLE IF NOT EXISTS services (
+    service_id INTEGER PRIMARY KEY,
+    service_key TEXT NOT NULL UNIQUE,
+    folder TEXT NOT NULL,
+    service_name TEXT NOT NULL,
+    type TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS flag_sets (
+    flag_set_id INTEGER PRIMARY KEY,
+    cached TEXT, feature_service TEXT, kml TEXT, wms TEXT, wfs TEXT, wcs TEXT, wmts TEXT,
+    UNIQUE (cached, feature_service, kml, wms, wfs, wcs, wmts));
+CREATE TABLE IF NOT EXISTS observations (
+    run_id INTEGER NOT NULL,
+    service_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    flag_set_id INTEGER,
+    layer_count INTEGER,
+    PRIMARY KEY (run_id, service_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS observations_service ON observations (service_id, run_id);
+CREATE TABLE IF NOT EXISTS events (
+    event_id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL,
+    observed REAL NOT NULL,
+    service_id INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    previous_status TEXT,
+    status TEXT);
+CREATE INDEX IF NOT EXISTS events_service ON events (service_id, observed);
+CREATE INDEX IF NOT EXISTS events_observed ON events (observed);
+"""
+
+# Each event opens a span lasting until the service's next event. Spans after a removal are not counted.
+UPTIME_QUERY = """
+WITH spans AS (
+    SELECT service_id, event, status, observed AS started,
+           COALESCE(LEAD(observed) OVER (PARTITION BY service_id ORDER BY observed, event_id), :now) AS ended
+    FROM events
+    WHERE observed < :end {service_filter})
+SELECT services.service_key,
+       SUM(CASE WHEN spans.status = :started_state THEN MIN(ended, :end) - MAX(started, :start) ELSE 0 END),
+       SUM(MIN(ended, :end) - MAX(started, :start))
+FROM spans JOIN services USING (service_id)
+WHERE spans.event != :removed AND ended > :start
+GROUP BY spans.service_id
+ORDER BY services.service_key
+"""
+
+
+def create_service_key(record):
+    """
+    Identify a service across runs by its folder, name, and type.
+    :param record: output record of the service
+    :return: string
+    """
+    return f"{record['Folder']}/{record['ServiceName']}/{record['Type']}"
+
+
+class HistoryStore:
+    """SQLite store of the run history, with the change events between runs and uptime queries."""
+    CONFIG_SECTION = "crawl_settings"
+
+    def __init__(self, path, timeout=5.0):
+        """
+        Instantiate a HistoryStore, creating the database when it does not exist.
+        :param path: path of the SQLite database
+        :param timeout: seconds to wait on a lock held by another connection, such as a dashboard query, before
+            raising sqlite3.OperationalError
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=timeout)
+        self._connection.executescript(SCHEMA)
+        self._load_ids()
+        self._latest = None
+
+    def _load_ids(self):
+        """
+        Read the ids of the services and flag sets already stored.
+        :return: None
+        """
+        self._service_ids = dict(self._connection.execute("SELECT service_key, service_id FROM services"))
+        self._flag_set_ids = {tuple(row[1:]): row[0] for row in self._connection.execute(
+            "SELECT flag_set_id, cached, feature_service, kml, wms, wfs, wcs, wmts FROM flag_sets")}
+
+    @classmethod
+    def from_config(cls, config, output_directory):
+        """
+        Create a store using the [crawl_settings] values of a config. The history is optional, so a database that
+        cannot be opened is reported and the run goes on without it.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :param output_directory: directory the history file is relative to
+        :return: HistoryStore, or None when no history_file is configured or it cannot be opened
+        """
+        history_file = config.get(cls.CONFIG_SECTION, "history_file", fallback="")
+        if not history_file:
+            return None
+        path = os.path.join(output_directory, history_file)
+        try:
+            return cls(path=path, timeout=config.getfloat(cls.CONFIG_SECTION, "history_timeout", fallback=5.0))
+        except sqlite3.Error as e:
+            print(f"History not kept, unable to open {path}: {e}")
+            return None
+
+    def _load_latest(self):
+        """
+        Latest observed status and folder of every service, read once and then kept up to date in memory.
+        :return: dictionary of service id to (folder, status)
+        """
+        if self._latest is None:
+            self._latest = {service_id: (folder, status) for service_id, folder, status in self._connection.execute(
+                "SELECT observations.service_id, services.folder, observations.status "
+                "FROM observations "
+                "JOIN (SELECT service_id, MAX(run_id) AS run_id FROM observations GROUP BY service_id) latest "
+                "USING (service_id, run_id) "
+                "JOIN services USING (service_id)")}
+        return self._latest
+
+    def _get_service_id(self, service_key, record):
+        service_id = self._service_ids.get(service_key)
+        if service_id is None:
+            service_id = self._connection.execute(
+                "INSERT INTO services (service_key, folder, service_name, type) VALUES (?, ?, ?, ?)",
+                (service_key, record["Folder"], record["ServiceName"], record["Type"])).lastrowid
+            self._service_ids[service_key] = service_id
+        return service_id
+
+    def _get_flag_set_id(self, flags):
+        flag_set_id = self._flag_set_ids.get(flags)
+        if flag_set_id is None:
+            flag_set_id = self._connection.execute(
+                "INSERT INTO flag_sets (cached, feature_service, kml, wms, wfs, wcs, wmts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", flags).lastrowid
+            self._flag_set_ids[flags] = flag_set_id
+        return flag_set_id
+
+    def record_run(self, records, started, observed_folders):
+        """
+        Append a run's observations and the events that differ from the latest observations, in one transaction.
+        :param records: iterable of output records
+        :param started: start time of the run in seconds since the epoch
+        :param observed_folders: folders whose reports were retrieved by the run. Records of other folders are not
+            observed, and only services of these folders can be removed.
+        :return: list of event dictionaries with 'service_key', 'event', 'previous_status', and 'status'
+        """
+        observed_folders = {folder.replace("/", "") for folder in observed_folders}
+        latest = self._load_latest()
+        service_keys = {service_id: service_key for service_key, service_id in self._service_ids.items()}
+        service_folders = {service_id: folder for service_id, (folder, _) in latest.items()}
+        try:
+            events = self._insert_run(records=records, started=started, observed_folders=observed_folders,
+                                      latest=latest, service_keys=service_keys, service_folders=service_folders)
+        except sqlite3.Error:
+            # The transaction was rolled back, taking any services and flag sets it added with it
+            self._load_ids()
+            raise
+        return [{"service_key": service_keys[service_id], "event": event, "previous_status": previous_status,
+                 "status": status}
+                for service_id, event, previous_status, status in events]
+
+    def _insert_run(self, records, started, observed_folders, latest, service_keys, service_folders):
+        """
+        Insert a run, its observations, and its events in one transaction, and bring the latest observations up to
+        date once it is committed.
+        :param records: iterable of output records
+        :param started: start time of the run in seconds since the epoch
+        :param observed_folders: set of the folder names, as written to the records, observed by the run
+        :param latest: dictionary returned by _load_latest
+        :param service_keys: dictionary of service id to service key, added to for new services
+        :param service_folders: dictionary of service id to folder, updated from the records
+        :return: list of (service id, event, previous status, status) tuples
+        """
+        with self._connection:
+            observations = {}
+            for record in records:
+                if record["Folder"] not in observed_folders:
+                    continue
+                service_key = create_service_key(record)
+                service_id = self._get_service_id(service_key=service_key, record=record)
+                service_keys[service_id] = service_key
+                service_folders[service_id] = record["Folder"]
+                layers = record.get("layers")
+                observations[service_id] = (record["Status"],
+                                            self._get_flag_set_id(tuple(record.get(field) for field in FLAG_FIELDS)),
+                                            # "NA" when the layer lookup failed
+                                            len(layers) if isinstance(layers, list) else None)
+            run_id = self._connection.execute("INSERT INTO runs (started, service_count) VALUES (?, ?)",
+                                              (started, len(observations))).lastrowid
+            events = []
+            for service_id, (status, _, _) in observations.items():
+                previous_status = latest.get(service_id, (None, REMOVED_STATE))[1]
+                if previous_status == REMOVED_STATE:
+                    events.append((service_id, ADDED, None, status))
+                elif status == STARTED_STATE and previous_status != STARTED_STATE:
+                    events.append((service_id, STARTED, previous_status, status))
+                elif status != STARTED_STATE and previous_status == STARTED_STATE:
+                    events.append((service_id, STOPPED, previous_status, status))
+            for service_id, (folder, status) in latest.items():
+                if folder in observed_folders and status != REMOVED_STATE and service_id not in observations:
+                    observations[service_id] = (REMOVED_STATE, None, None)
+                    events.append((service_id, REMOVED, status, None))
+            self._connection.executemany("INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?)",
+                                         [(run_id, service_id) + observation
+                                          for service_id, observation in observations.items()])
+            self._connection.executemany(
+                "INSERT INTO events (run_id, observed, service_id, event, previous_status, status) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(run_id, started) + event for event in events])
+        for service_id, observation in observations.items():
+            latest[service_id] = (service_folders[service_id], observation[0])
+        return events
+
+    def uptime(self, start, end=None, service_key=None):
+        """
+        Fraction of the time each service was STARTED between two times, from its events.
+        :param start: start of the range in seconds since the epoch
+        :param end: end of the range in seconds since the epoch (default=None, now)
+        :param service_key: limit the query to one service (default=None, every service)
+        :return: dictionary of service key to dictionary of 'uptime' fraction and 'observed_seconds'
+        """
+        now = time.time()
+        parameters = {"start": start, "end": now if end is None else end, "now": now,
+                      "started_state": STARTED_STATE, "removed": REMOVED}
+        service_filter = ""
+        if service_key is not None:
+            parameters["service_id"] = self._service_ids.get(service_key, -1)
+            service_filter = "AND service_id = :service_id"
+        uptimes = {}
+        for key, started_seconds, observed_seconds in self._connection.execute(
+                UPTIME_QUERY.format(service_filter=service_filter), parameters):
+            if observed_seconds:
+                uptimes[key] = {"uptime": started_seconds / observed_seconds, "observed_seconds": observed_seconds}
+        return uptimes
+
+    def events(self, start=None, end=None, service_key=None):
+        """
+        Change events between two times, oldest first.
+        :param start: start of the range in seconds since the epoch (default=None, the first event)
+        :param end: end of the range in seconds since the epoch (default=None, now)
+        :param service_key: limit the query to one service (default=None, every service)
+        :return: list of event dictionaries with 'observed', 'service_key', 'event', 'previous_status', and 'status'
+        """
+        conditions = ["observed >= ?", "observed < ?"]
+        parameters = [start or 0.0, time.time() if end is None else end]
+        if service_key is not None:
+            conditions.append("service_id = ?")
+            parameters.append(self._service_ids.get(service_key, -1))
+        rows = self._connection.execute(
+            "SELECT observed, service_key, event, previous_status, status FROM events JOIN services USING (service_id) "
+            f"WHERE {' AND '.join(conditions)} ORDER BY observed, event_id", parameters)
+        return [{"observed": observed, "service_key": key, "event": event, "previous_status": previous_status,
+                 "status": status}
+                for observed, key, event, previous_status, status in rows]
+
+    def run_count(self):
+        """
+        Number of runs recorded.
+        :return: integer
+        """
+        return self._connection.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class HistoryWriter:
+    """Collects the records of a run as they are written, like the output writers, and records them on close."""
+
+    def __init__(self, store, started, observed_folders):
+        """
+        Instantiate a HistoryWriter
+        :param store: HistoryStore
+        :param started: start time of the run in seconds since the epoch
+        :param observed_folders: folders whose reports were retrieved by the run
+        """
+        self.store = store
+        self.started = started
+        self.observed_folders = observed_folders
+        self.record_count = 0
+        self.events = None
+        self._records = []
+
+    def write(self, record):
+        self._records.append(record)
+        self.record_count += 1
+
+    def close(self):
+        """
+        Record the run. Call once the output files are published. A database error, such as a lock held by another
+        connection past the timeout, is reported and the run is left unrecorded, with events left None.
+        :return: None
+        """
+        try:
+            self.events = self.store.record_run(records=self._records, started=self.started,
+                                                observed_folders=self.observed_folders)
+        except sqlite3.Error as e:
+            print(f"History not recorded to {self.store.path}: {e}")
+        self._records = []
+
+
+def print_events(events, limit=25):
+    """
+    Print the count of each kind of event and the first events.
+    :param events: list of event dictionaries
+    :param limit: most events listed
+    :return: None
+    """
+    counts = {kind: sum(1 for event in events if event["event"] == kind) for kind in (ADDED, STARTED, STOPPED, REMOVED)}
+    print(f"\nHISTORY: {len(events)} change event(s), "
+          + ", ".join(f"{count} {kind}" for kind, count in counts.items()))
+    for event in events[:limit]:
+        print(f"\t{event['event']}: {event['service_key']} ({event['previous_status']} -> {event['status']})")
+    if len(events) > limit:
+        print(f"\t... {len(events) - limit} more")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the run history of the services.")
+    parser.add_argument("history", help="SQLite history database")
+    parser.add_argument("--days", type=float, default=7.0, help="length of the range ending now, in days")
+    parser.add_argument("--service", default=None, help="service key, Folder/ServiceName/Type")
+    parser.add_argument("--uptime", action="store_true", help="print the uptime of each service")
+    parser.add_argument("--events", action="store_true", help="print the change events")
+    args = parser.parse_args()
+
+    start = time.time() - args.days * 86400
+    with HistoryStore(path=args.history) as store:
+        print(f"{store.run_count()} runs recorded")
+        if args.events:
+            for event in store.events(start=start, service_key=args.service):
+                print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(event['observed']))} {event['event']:>8} "
+                      f"{event['service_key']} ({event['previous_status']} -> {event['status']})")
+        if args.uptime or not args.events:
+            for service_key, uptime in store.uptime(start=start, service_key=args.service).items():
+                print(f"{uptime['uptime'] * 100:>7.2f}% {service_key} over {uptime['observed_seconds'] / 3600:.1f}h")
+
+
+if __name__ == "__main__":
+    main()
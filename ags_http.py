@@ -0,0 +1,16 @@
+"""
+Base of the local HTTP endpoints that serve json: the daemon's snapshot endpoint and the replay server.
+"""
+
+from http.server import BaseHTTPRequestHandler
+
+
+class KeepAliveRequestHandler(BaseHTTPRequestHandler):
+    """Request handler keeping connections alive across requests, without logging each request."""
+    protocol_version = "HTTP/1.1"
+    # The headers and body go out as separate writes. With Nagle's algorithm, each response after the first on a
+    #   keep-alive connection would wait on the client's delayed ACK, some 40 ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
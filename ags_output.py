@@ -0,0 +1,179 @@
+"""
+Writers for the service records produced by archiveDataToJSON_MOD.
+
+Records are written one at a time as they are produced, so the whole catalog never has to be held as json text.
+JSONArrayWriter always produces a valid json array, however many records (including none) are written, which removes
+the need for the caller to work out where commas belong. NDJSONWriter writes one compact record per line.
+
+Output files are published atomically with atomic_output_file. Records go to a temporary file in the same directory,
+which is flushed to disk and then renamed over the published file, so the dashboard only ever sees the previous
+complete file or the new complete file. A gzip copy can be published alongside for web servers that serve
+precompressed files.
+"""
+
+import contextlib
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+COMPACT_SEPARATORS = (",", ":")
+
+
+class JSONArrayWriter:
+    """Streams records into a file as the elements of a single json array."""
+
+    def __init__(self, file_handler, indent=None):
+        """
+        Instantiate a JSONArrayWriter and open the array
+        :param file_handler: text file object opened for writing
+        :param indent: json pretty indent dimension, None for compact output
+        """
+        self.file_handler = file_handler
+        self.indent = indent
+        self.record_count = 0
+        if indent is None:
+            self._separators = COMPACT_SEPARATORS
+        else:
+            self._separators = None
+        self.file_handler.write("[")
+
+    def write(self, record):
+        """
+        Write one record as the next element of the array.
+        :param record: json compatible dictionary
+        :return: None
+        """
+        if self.record_count > 0:
+            self.file_handler.write(",")
+        self.file_handler.write(json.dumps(obj=record, indent=self.indent, separators=self._separators))
+        self.record_count += 1
+
+    def close(self):
+        """
+        Close the array. The file itself is left for the caller to close.
+        :return: None
+        """
+        self.file_handler.write("]")
+
+
+class NDJSONWriter:
+    """Streams records into a file as newline delimited json, one compact record per line."""
+
+    def __init__(self, file_handler):
+        """
+        Instantiate a NDJSONWriter
+        :param file_handler: text file object opened for writing
+        """
+        self.file_handler = file_handler
+        self.record_count = 0
+
+    def write(self, record):
+        """
+        Write one record as a line.
+        :param record: json compatible dictionary
+        :return: None
+        """
+        self.file_handler.write(json.dumps(obj=record, separators=COMPACT_SEPARATORS))
+        self.file_handler.write("\n")
+        self.record_count += 1
+
+    def close(self):
+        """
+        Nothing is needed to finish newline delimited json. Present so both writers are used the same way.
+        :return: None
+        """
+        pass
+
+
+def _published_mode(path):
+    """
+    Determine the permissions for a published file. An existing file keeps its permissions, a new file gets the usual
+    permissions for the process umask. Temporary files are created readable by the owner only, so this is needed for
+    the web server to read the result.
+    :param path: path of the published file
+    :return: integer permission bits
+    """
+    if os.path.exists(path):
+        return os.stat(path).st_mode & 0o777
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def _fsync_directory(directory):
+    """
+    Flush a directory entry to disk so a rename survives a crash. Not supported on Windows, where it is skipped.
+    :param directory: path of the directory
+    :return: None
+    """
+    try:
+        directory_descriptor = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(directory_descriptor)
+    except OSError:
+        pass
+    finally:
+        os.close(directory_descriptor)
+
+
+def _write_gzip_copy(source_path, path):
+    """
+    Compress a finished file into a temporary gzip file next to the published path.
+    :param source_path: path of the uncompressed file
+    :param path: path the gzip copy will be published to
+    :return: path of the temporary gzip file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file_handler:
+            # mtime of 0 keeps the compressed bytes identical for identical content
+            with gzip.GzipFile(fileobj=temp_file_handler, mode='wb', mtime=0) as gzip_file_handler:
+                with open(source_path, 'rb') as source_file_handler:
+                    shutil.copyfileobj(source_file_handler, gzip_file_handler)
+            temp_file_handler.flush()
+            os.fsync(temp_file_handler.fileno())
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+@contextlib.contextmanager
+def atomic_output_file(path, gzip_copy=False, newline=None):
+    """
+    Open a temporary text file that replaces the file at path only when the block completes. If the block raises, or
+    the run exits partway through, the temporary file is removed and the published file is left untouched.
+    :param path: path of the file to publish
+    :param gzip_copy: also publish a gzip compressed copy at path + '.gz' (default=False)
+    :param newline: newline argument of open, '' for a file written by the csv module (default=None, universal)
+    :return: text file object opened for writing
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    file_descriptor, temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    temp_paths = [temp_path]
+    try:
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8', newline=newline) as temp_file_handler:
+            yield temp_file_handler
+            temp_file_handler.flush()
+            os.fsync(temp_file_handler.fileno())
+
+        mode = _published_mode(path=path)
+        os.chmod(temp_path, mode)
+        if gzip_copy:
+            gzip_path = f"{path}.gz"
+            gzip_temp_path = _write_gzip_copy(source_path=temp_path, path=gzip_path)
+            temp_paths.append(gzip_temp_path)
+            os.chmod(gzip_temp_path, mode)
+            os.replace(gzip_temp_path, gzip_path)
+        os.replace(temp_path, path)
+        _fsync_directory(directory=directory)
+    except BaseException:
+        for leftover_path in temp_paths:
+            if os.path.exists(leftover_path):
+                os.remove(leftover_path)
+        raise
@@ -0,0 +1,169 @@
+"""
+Health probes of the started services, measuring how long each takes to answer on its machine.
+
+The admin report only gives a service's realTimeState, so a STARTED MapServer that takes 20s to respond looks healthy.
+A ServiceProbe sends one lightweight request to the service's rest endpoint, the service info (?f=json), and times it.
+Optionally a small export is drawn as well: a 64x64 export of a MapServer, or exportImage of an ImageServer, over the
+full extent given in the service info. A probe is a single attempt, not retried, because the time and failure of that
+attempt are what is being measured.
+
+Each probed record gains:
+    ProbeSeconds        seconds to receive the service info, None when the request failed
+    ProbeError          description of the failure, None when the service answered
+    ProbeExportSeconds  seconds to draw the export, when exports are probed for the service type
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    probe               probe every started service of the refreshed folders (default False)
+    probe_export        also draw a small export of map and image services (default False)
+    probe_timeout       seconds a probe waits on the service (default 10)
+    probe_workers       maximum number of probes in flight at one time (default 8)
+    probe_file          json file of the per-folder rollup, relative to the output directory, empty to skip writing
+                        (default GeodataServices.probe.json)
+"""
+
+import json
+import time
+
+import requests
+
+from ags_output import atomic_output_file
+from ags_profile import percentile
+
+EXPORT_OPERATIONS = {"MapServer": "export", "ImageServer": "exportImage"}
+EXPORT_SIZE = "64,64"
+
+
+class ServiceProbe:
+    """Times the service info, and optionally a small export, of a service."""
+    CONFIG_SECTION = "crawl_settings"
+
+    def __init__(self, client, timeout=10.0, export=False):
+        """
+        Instantiate a ServiceProbe
+        :param client: AGSClient used for the requests
+        :param timeout: seconds a probe waits on the service
+        :param export: also draw a small export of map and image services
+        """
+        self.client = client
+        self.timeout = timeout
+        self.export = export
+
+    @classmethod
+    def from_config(cls, config, client):
+        """
+        Create a probe using the [crawl_settings] values of a config, falling back to defaults when absent.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :param client: AGSClient used for the requests
+        :return: ServiceProbe
+        """
+        return cls(client=client,
+                   timeout=config.getfloat(cls.CONFIG_SECTION, "probe_timeout", fallback=10.0),
+                   export=config.getboolean(cls.CONFIG_SECTION, "probe_export", fallback=False))
+
+    def _request(self, url, params):
+        """
+        Make one timed GET request and check that the service answered with json free of an error.
+        :param url: url of the request
+        :param params: dictionary of parameters
+        :return: tuple of (seconds, decoded json or None, error message or None, True when the machine was unreachable)
+        """
+        start = time.perf_counter()
+        try:
+            response = self.client.get(url, params=params, timeout=self.timeout)
+            seconds = time.perf_counter() - start
+        except requests.exceptions.RequestException as re:
+            return None, None, f"{type(re).__name__}: {re}", True
+        if response.status_code != 200:
+            return seconds, None, f"HTTP {response.status_code}", False
+        try:
+            response_json = response.json()
+        except ValueError:
+            return seconds, None, "Response is not json", False
+        if isinstance(response_json, dict) and "error" in response_json:
+            error = response_json["error"]
+            if isinstance(error, dict):
+                error = f"{error.get('code')} {error.get('message')}"
+            return seconds, None, f"Service error: {error}", False
+        return seconds, response_json, None, False
+
+    def probe(self, service_url, service_type):
+        """
+        Probe one service. Any failure is recorded in the ProbeError field rather than raised.
+        :param service_url: rest url of the service on a machine
+        :param service_type: type of the service, e.g. 'MapServer'
+        :return: tuple of (dictionary of probe fields for the record, True when the machine was unreachable)
+        """
+        fields = {"ProbeSeconds": None, "ProbeError": None}
+        unreachable = False
+        try:
+            seconds, info, error, unreachable = self._request(url=service_url, params={"f": "json"})
+            # A slow error answer is still timed, only a request that got no response has no time
+            fields.update(ProbeSeconds=None if seconds is None else round(seconds, 3), ProbeError=error)
+            operation = EXPORT_OPERATIONS.get(service_type)
+            if self.export and operation is not None and info is not None:
+                extent = info.get("fullExtent") or info.get("initialExtent") or info.get("extent")
+                if extent:
+                    params = {"f": "json",
+                              "bbox": f"{extent['xmin']},{extent['ymin']},{extent['xmax']},{extent['ymax']}",
+                              "bboxSR": json.dumps(extent.get("spatialReference", {})),
+                              "size": EXPORT_SIZE}
+                    export_seconds, _, export_error, unreachable = self._request(url=f"{service_url}/{operation}",
+                                                                                 params=params)
+                    fields["ProbeExportSeconds"] = None if export_seconds is None else round(export_seconds, 3)
+                    if export_error:
+                        fields["ProbeError"] = f"{operation}: {export_error}"
+        except Exception as e:
+            # A malformed info payload, e.g. an extent without its bounds, or any other unexpected failure fails only
+            #   this probe
+            fields["ProbeError"] = f"Probe failed: {type(e).__name__}: {e}"
+        return fields, unreachable
+
+
+def create_probe_rollup(probe_results):
+    """
+    Summarize the probes of each folder.
+    :param probe_results: dictionary of (folder, service name, type) to dictionary of probe fields
+    :return: dictionary of folder name to dictionary of 'probed', 'errors', 'p50', 'p95', and 'max' seconds
+    """
+    folders = {}
+    for (folder, _, _), fields in probe_results.items():
+        folders.setdefault(folder, []).append(fields)
+    rollup = {}
+    for folder, folder_fields in sorted(folders.items()):
+        seconds = [fields["ProbeSeconds"] for fields in folder_fields if fields["ProbeSeconds"] is not None]
+        rollup[folder] = {"probed": len(folder_fields),
+                          "errors": sum(1 for fields in folder_fields if fields["ProbeError"] is not None),
+                          "p50": percentile(seconds, 0.5),
+                          "p95": percentile(seconds, 0.95),
+                          "max": max(seconds, default=None)}
+    return rollup
+
+
+def print_probe_summary(rollup, slow_seconds=5.0):
+    """
+    Print the probe rollup of each folder.
+    :param rollup: dictionary returned by create_probe_rollup
+    :param slow_seconds: folders whose p95 reaches this many seconds are flagged
+    :return: None
+    """
+    print(f"\nPROBE: {sum(folder['probed'] for folder in rollup.values())} services probed, "
+          f"{sum(folder['errors'] for folder in rollup.values())} errors")
+    for folder, stats in rollup.items():
+        if stats["p50"] is None:
+            timing = "no responses"
+        else:
+            timing = f"p50 {stats['p50']:.3f}s, p95 {stats['p95']:.3f}s, max {stats['max']:.3f}s"
+        flag = " SLOW" if stats["p95"] is not None and stats["p95"] >= slow_seconds else ""
+        print(f"\t{folder}: {stats['probed']} probed ({stats['errors']} errors), {timing}{flag}")
+
+
+def write_probe_rollup(path, rollup, started):
+    """
+    Write the per-folder rollup to a json file, replacing it atomically.
+    :param path: path of the rollup file
+    :param rollup: dictionary returned by create_probe_rollup
+    :param started: start time of the run in seconds since the epoch
+    :return: None
+    """
+    with atomic_output_file(path=path) as rollup_file_handler:
+        json.dump({"started": started, "folders": rollup}, rollup_file_handler, indent=4)
@@ -0,0 +1,224 @@
+"""
+Timing of the requests made to the ArcGIS Server machines.
+
+Each request is measured and tagged by machine, endpoint kind (token, folders, report, layers, probe), folder, and
+service. The bytes of each response body read from the connection, before gzip or deflate decoding, are counted by a
+response hook on the AGSClient and credited to the request being measured on the same thread. The body of a streamed
+response is counted when its measurement ends, as it is read in the meantime. urllib3 does not count the body of a
+chunked response, so such responses are counted as unmeasured rather than sized. At the end of a run the profile is
+summarized as p50/p95/max response times per endpoint kind, the slowest services, and bytes on the wire, and written
+to a json file so the numbers can be tracked across runs.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    profile_file        json file for the run profile, relative to the project, empty to skip writing
+                        (default GeodataServices.profile.json)
+    profile_slowest     number of slowest services listed in the summary (default 10)
+"""
+
+import contextlib
+import json
+import math
+import threading
+import time
+
+from ags_output import atomic_output_file
+
+KINDS = ("token", "folders", "report", "layers", "probe")
+
+
+def wire_size(response):
+    """
+    Bytes of a response's body read so far from the connection, before content decoding.
+    :param response: requests.Response
+    :return: int, or None for a chunked body, which urllib3 does not count
+    """
+    wire_bytes = response.raw.tell()
+    if wire_bytes == 0 and "chunked" in response.headers.get("Transfer-Encoding", "").lower():
+        return None
+    return wire_bytes
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of a list of numbers.
+    :param values: list of numbers
+    :param fraction: percentile as a fraction, e.g. 0.95
+    :return: number, or None when there are no values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def format_unmeasured(count):
+    """
+    Note of the responses left out of a byte count.
+    :param count: number of unmeasured responses
+    :return: string, empty when there are none
+    """
+    return f" (+{count} chunked responses unmeasured)" if count else ""
+
+
+class RequestProfiler:
+    """Collects a timed sample for every measured request and summarizes them."""
+    CONFIG_SECTION = "crawl_settings"
+
+    def __init__(self, slowest_count=10):
+        """
+        Instantiate a RequestProfiler
+        :param slowest_count: number of slowest services listed in the summary
+        """
+        self.slowest_count = slowest_count
+        self.started = time.time()
+        self._samples = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a profiler using the [crawl_settings] values of a config, falling back to defaults when absent.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :return: RequestProfiler
+        """
+        return cls(slowest_count=config.getint(cls.CONFIG_SECTION, "profile_slowest", fallback=10))
+
+    def _stack(self):
+        """
+        Samples being measured on the current thread, innermost last, each with its list of streamed responses.
+        :return: list of (sample, list of requests.Response) tuples
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextlib.contextmanager
+    def measure(self, kind, machine, folder=None, service=None):
+        """
+        Time the requests made inside the block as one sample. A block that raises is recorded as failed.
+        :param kind: endpoint kind, one of 'token', 'folders', 'report', 'layers', 'probe'
+        :param machine: root url of the machine the request is sent to
+        :param folder: folder of the request, when there is one
+        :param service: service of the request, when there is one
+        :return: dictionary of the sample being measured
+        """
+        sample = {"kind": kind, "machine": machine, "folder": folder, "service": service,
+                  "started": time.time(), "seconds": None, "wire_bytes": 0, "unmeasured": 0, "succeeded": False}
+        streamed_responses = []
+        stack = self._stack()
+        stack.append((sample, streamed_responses))
+        start = time.perf_counter()
+        try:
+            yield sample
+            sample["succeeded"] = True
+        finally:
+            sample["seconds"] = time.perf_counter() - start
+            stack.pop()
+            for response in streamed_responses:
+                self._count(sample=sample, response=response)
+            with self._lock:
+                self._samples.append(sample)
+
+    def response_hook(self, response, *args, **kwargs):
+        """
+        requests response hook that credits the wire size of a response body to the sample measured on this thread.
+        :param response: requests.Response
+        :return: None
+        """
+        stack = self._stack()
+        if not stack:
+            return
+        sample, streamed_responses = stack[-1]
+        if kwargs.get("stream"):
+            # Reading the body here would defeat the streaming
+            streamed_responses.append(response)
+        else:
+            # requests reads the body right after the hooks anyway. Until it is read, nothing has come over the wire
+            response.content
+            self._count(sample=sample, response=response)
+
+    @staticmethod
+    def _count(sample, response):
+        """
+        Add the wire size of a response body to a sample, or count the response as unmeasured.
+        :param sample: dictionary of the sample being measured
+        :param response: requests.Response
+        :return: None
+        """
+        wire_bytes = wire_size(response=response)
+        if wire_bytes is None:
+            sample["unmeasured"] += 1
+        else:
+            sample["wire_bytes"] += wire_bytes
+
+    def reset(self):
+        """
+        Discard the samples recorded so far and restart the profile, as at the start of each daemon cycle.
+        :return: None
+        """
+        with self._lock:
+            self._samples = []
+            self.started = time.time()
+
+    def samples(self):
+        """
+        Copy of every sample recorded so far.
+        :return: list of dictionaries
+        """
+        with self._lock:
+            return list(self._samples)
+
+    def create_summary(self):
+        """
+        Summarize the samples per endpoint kind and list the slowest services.
+        :return: dictionary of 'kinds', 'slowest', 'wire_bytes', and 'unmeasured'
+        """
+        samples = self.samples()
+        kinds = {}
+        for kind in KINDS + tuple(sorted({sample["kind"] for sample in samples} - set(KINDS))):
+            seconds = [sample["seconds"] for sample in samples if sample["kind"] == kind]
+            if not seconds:
+                continue
+            kinds[kind] = {"requests": len(seconds),
+                           "failed": sum(1 for sample in samples if sample["kind"] == kind and not sample["succeeded"]),
+                           "p50": percentile(seconds, 0.5),
+                           "p95": percentile(seconds, 0.95),
+                           "max": max(seconds),
+                           "wire_bytes": sum(sample["wire_bytes"] for sample in samples if sample["kind"] == kind),
+                           "unmeasured": sum(sample["unmeasured"] for sample in samples if sample["kind"] == kind)}
+        service_samples = [sample for sample in samples if sample["service"] is not None]
+        slowest = sorted(service_samples, key=lambda sample: sample["seconds"], reverse=True)[:self.slowest_count]
+        return {"kinds": kinds, "slowest": slowest, "wire_bytes": sum(sample["wire_bytes"] for sample in samples),
+                "unmeasured": sum(sample["unmeasured"] for sample in samples)}
+
+    def print_summary(self):
+        """
+        Print response times per endpoint kind, the slowest services, and bytes on the wire.
+        :return: None
+        """
+        summary = self.create_summary()
+        print(f"\nPROFILE: {sum(kind['requests'] for kind in summary['kinds'].values())} requests, "
+              f"{summary['wire_bytes'] / 1024:.1f} KiB on the wire{format_unmeasured(summary['unmeasured'])}")
+        for kind, stats in summary["kinds"].items():
+            print(f"\t{kind}: {stats['requests']} requests ({stats['failed']} failed), p50 {stats['p50']:.3f}s, "
+                  f"p95 {stats['p95']:.3f}s, max {stats['max']:.3f}s, {stats['wire_bytes'] / 1024:.1f} KiB on the wire"
+                  f"{format_unmeasured(stats['unmeasured'])}")
+        if summary["slowest"]:
+            print("\tSlowest services:")
+            for sample in summary["slowest"]:
+                print(f"\t\t{sample['seconds']:.3f}s {sample['kind']} {sample['folder']}/{sample['service']} "
+                      f"on {sample['machine']}")
+
+    def write(self, path):
+        """
+        Write the summary and every sample to a json file, replacing it atomically.
+        :param path: path of the profile file
+        :return: None
+        """
+        profile = {"started": self.started, "finished": time.time(), "summary": self.create_summary(),
+                   "samples": self.samples()}
+        with atomic_output_file(path=path) as profile_file_handler:
+            json.dump(profile, profile_file_handler, indent=4)
@@ -0,0 +1,345 @@
+"""
+Adaptive limits on the request traffic sent to each ArcGIS Server machine.
+
+The crawl runs concurrently against the same production machines it reports on, so every request, whether for a
+folder report, a layer list, or a probe, first takes a slot from the limiter of the machine it is sent to. A machine's
+limiter enforces two limits:
+    - a concurrency limit, the number of requests in flight to the machine at one time
+    - a token bucket, the number of requests started per second, with bursts of up to the concurrency limit
+
+Both limits adapt to how the machine is coping (additive increase, multiplicative decrease). A machine starts at one
+request in flight, and the concurrency limit doubles with every round of requests until the first sign of congestion
+or the ceiling, so the usual response times are learned before the machine is loaded. Every response received while
+a slot is held is observed, by a response hook on the AGSClient, so each attempt of a retried request is judged on
+its own, and neither the pauses between attempts nor the generation of a token count toward its time. The time is
+the response time of the machine, up to the headers of the response. Signs of congestion are:
+    - an HTTP 5xx or 429 answer, or an html error page in place of json
+    - a request that got no response at all
+    - a response much slower than usual: than the same url's usual response time, once it has been requested before,
+      otherwise than the 90th percentile of the recent responses of the same endpoint kind on the machine, so that
+      the report of a folder larger than most is not taken for congestion
+A rejected token, a missing key, or any other answer the machine gave in good time is not congestion. On congestion
+both limits are multiplied by the backoff factor, at most once per response time so that the requests already in
+flight do not collapse them. Every response in the usual time raises the concurrency limit by one per round of
+requests at the current limit, and the rate by as many requests per second, up to the ceilings. The crawl so runs as
+fast as the machines comfortably allow, and backs off when one slows down.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    host_concurrency        most requests in flight to one machine at a time (default 8)
+    host_rate_limit         most requests started per second on one machine (default 50)
+    host_min_rate           requests per second a machine is never backed off below, at least 0.01 (default 1)
+    adaptive_limits         adapt the limits to the response times and errors (default True, False keeps the ceilings)
+    latency_tolerance       multiple of the usual response time above which a response is slow (default 4)
+    limit_backoff           factor the limits are multiplied by on congestion (default 0.5)
+"""
+
+import contextlib
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+from ags_profile import percentile
+from ags_tokens import TokenManager
+
+
+class MachineLimiter:
+    """Concurrency limit and token bucket of one machine, adapted to its response times and errors."""
+    BASELINE_SMOOTHING = 0.01   # Weight of a slower response time in the usual response time of a url
+    RECENT_COUNT = 50           # Recent response times per endpoint kind, of which the 90th percentile is taken
+    SLOW_FLOOR_SECONDS = 0.25   # Responses faster than this are never slow, whatever the usual response time
+    RATE_FLOOR = 0.01           # Requests per second no rate is set below, as a rate of 0 would never refill
+
+    def __init__(self, max_concurrency=8, max_rate=50.0, min_rate=1.0, adaptive=True, latency_tolerance=4.0,
+                 backoff=0.5):
+        """
+        Instantiate a MachineLimiter, starting at one request in flight and the ceiling rate
+        :param max_concurrency: most requests in flight at one time
+        :param max_rate: most requests started per second
+        :param min_rate: requests per second the rate is never backed off below, at least RATE_FLOOR
+        :param adaptive: adapt the limits to response times and errors, False keeps them at the ceilings
+        :param latency_tolerance: multiple of the usual response time above which a response is slow
+        :param backoff: factor, 0 to 1, the limits are multiplied by on congestion
+        """
+        self.max_concurrency = max_concurrency
+        self.max_rate = max(max_rate, MachineLimiter.RATE_FLOOR)
+        self.min_rate = min(max(min_rate, MachineLimiter.RATE_FLOOR), self.max_rate)
+        self.adaptive = adaptive
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.concurrency_limit = 1.0 if adaptive else float(max_concurrency)
+        self.rate = float(self.max_rate)
+        self.slow_start = adaptive
+        self.lowest_concurrency_limit = float(max_concurrency)
+        self.lowest_rate = self.rate
+        self.in_flight = 0
+        self.requests = 0
+        self.slow_count = 0
+        self.error_count = 0
+        self.backoff_count = 0
+        self.waited_count = 0
+        self.waited_seconds = 0.0
+        self._tokens = self.concurrency_limit
+        self._refilled = time.monotonic()
+        self._baselines = {}
+        self._recent = {}
+        self._hold_until = 0.0
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        """
+        Add the tokens earned since the last refill, up to a burst of the concurrency limit. Caller must hold the
+        lock.
+        :param now: time.monotonic()
+        :return: None
+        """
+        self._tokens = min(self._tokens + (now - self._refilled) * self.rate, max(self.concurrency_limit, 1.0))
+        self._refilled = now
+
+    def acquire(self):
+        """
+        Wait until a request may be sent: fewer requests are in flight than the concurrency limit and the bucket
+        holds a token.
+        :return: None
+        """
+        start = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now=now)
+                if self.in_flight < int(self.concurrency_limit):
+                    if self._tokens >= 1.0:
+                        break
+                    timeout = (1.0 - self._tokens) / self.rate
+                else:
+                    # Woken by a release
+                    timeout = None
+                self._condition.wait(timeout=timeout)
+            self._tokens -= 1.0
+            self.in_flight += 1
+            self.requests += 1
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self.waited_count += 1
+                self.waited_seconds += waited
+
+    def release(self):
+        """
+        Free a request's slot.
+        :return: None
+        """
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _is_slow(self, kind, path, seconds):
+        """
+        Compare a response time with the usual response time of its url, or of its endpoint kind for a url not
+        requested before, and learn from it. Caller must hold the lock.
+        :param kind: endpoint kind of the request
+        :param path: url path of the request
+        :param seconds: response time
+        :return: boolean
+        """
+        recent = self._recent.setdefault(kind, deque(maxlen=MachineLimiter.RECENT_COUNT))
+        baseline = self._baselines.get(path)
+        if baseline is not None:
+            usual = baseline
+        elif recent:
+            usual = percentile(list(recent), 0.9)
+        else:
+            usual = None
+        recent.append(seconds)
+        if baseline is None or seconds < baseline:
+            self._baselines[path] = seconds
+        else:
+            # Rises slowly, so that congestion does not become the usual, but a lasting change does
+            self._baselines[path] += MachineLimiter.BASELINE_SMOOTHING * (seconds - baseline)
+        return (usual is not None and seconds > MachineLimiter.SLOW_FLOOR_SECONDS
+                and seconds > usual * self.latency_tolerance)
+
+    def observe(self, kind, path=None, seconds=None, congested=False):
+        """
+        Adapt the limits to one attempt of a request.
+        :param kind: endpoint kind of the request, e.g. 'report'
+        :param path: url path of the request, None when no response was received (default=None)
+        :param seconds: response time, None when no response was received (default=None)
+        :param congested: whether the answer, or the lack of one, is a sign of congestion (default=False)
+        :return: None
+        """
+        with self._condition:
+            if congested:
+                self.error_count += 1
+            elif seconds is not None and self._is_slow(kind=kind, path=path, seconds=seconds):
+                self.slow_count += 1
+                congested = True
+            if not self.adaptive:
+                return
+            if congested:
+                self._decrease(seconds=seconds or 0.0)
+            else:
+                if self.slow_start:
+                    increase = 1.0
+                else:
+                    increase = 1.0 / self.concurrency_limit
+                self.concurrency_limit = min(self.concurrency_limit + increase, float(self.max_concurrency))
+                self.rate = min(self.rate + 1.0 / self.concurrency_limit, float(self.max_rate))
+            self._condition.notify_all()
+
+    def _decrease(self, seconds):
+        """
+        Multiply the limits by the backoff factor, unless they were already cut within the last response time, since
+        the requests in flight were sent before that cut. Caller must hold the lock.
+        :param seconds: response time of the congested request, 0 when there was no response
+        :return: None
+        """
+        now = time.monotonic()
+        if now < self._hold_until:
+            return
+        self._hold_until = now + seconds
+        self.slow_start = False
+        self.concurrency_limit = max(self.concurrency_limit * self.backoff, 1.0)
+        self.rate = max(self.rate * self.backoff, self.min_rate)
+        self._tokens = min(self._tokens, self.concurrency_limit)
+        self.lowest_concurrency_limit = min(self.lowest_concurrency_limit, self.concurrency_limit)
+        self.lowest_rate = min(self.lowest_rate, self.rate)
+        self.backoff_count += 1
+
+    def reset_counts(self):
+        """
+        Restart the counts, keeping the limits and usual response times learned so far.
+        :return: None
+        """
+        with self._condition:
+            self.lowest_concurrency_limit = self.concurrency_limit
+            self.lowest_rate = self.rate
+            self.requests = 0
+            self.slow_count = 0
+            self.error_count = 0
+            self.backoff_count = 0
+            self.waited_count = 0
+            self.waited_seconds = 0.0
+
+
+class RateLimiter:
+    """The MachineLimiter of every machine requests are sent to, created on a machine's first request."""
+    CONFIG_SECTION = "crawl_settings"
+
+    def __init__(self, max_concurrency=8, max_rate=50.0, min_rate=1.0, adaptive=True, latency_tolerance=4.0,
+                 backoff=0.5):
+        """
+        Instantiate a RateLimiter, see MachineLimiter for the parameters given to every machine's limiter
+        """
+        self.machine_settings = {"max_concurrency": max_concurrency, "max_rate": max_rate, "min_rate": min_rate,
+                                 "adaptive": adaptive, "latency_tolerance": latency_tolerance, "backoff": backoff}
+        self._machines = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a rate limiter using the [crawl_settings] values of a config, falling back to defaults when absent.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :return: RateLimiter
+        """
+        section = cls.CONFIG_SECTION
+        return cls(max_concurrency=config.getint(section, "host_concurrency", fallback=8),
+                   max_rate=config.getfloat(section, "host_rate_limit", fallback=50.0),
+                   min_rate=config.getfloat(section, "host_min_rate", fallback=1.0),
+                   adaptive=config.getboolean(section, "adaptive_limits", fallback=True),
+                   latency_tolerance=config.getfloat(section, "latency_tolerance", fallback=4.0),
+                   backoff=config.getfloat(section, "limit_backoff", fallback=0.5))
+
+    def machine(self, root_url):
+        """
+        Limiter of a machine, created on first use.
+        :param root_url: root url of the machine
+        :return: MachineLimiter
+        """
+        with self._lock:
+            limiter = self._machines.get(root_url)
+            if limiter is None:
+                limiter = self._machines[root_url] = MachineLimiter(**self.machine_settings)
+            return limiter
+
+    def _stack(self):
+        """
+        Slots held on the current thread, innermost last.
+        :return: list of (MachineLimiter, endpoint kind) tuples
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextlib.contextmanager
+    def slot(self, root_url, kind):
+        """
+        Hold a request slot on a machine for the block. The responses received in the block are observed by
+        response_hook. A block whose request got no response at all reports it by setting the 'unanswered' key of
+        the yielded dictionary.
+        :param root_url: root url of the machine
+        :param kind: endpoint kind of the request, e.g. 'report'
+        :return: dictionary of the outcome of the request
+        """
+        limiter = self.machine(root_url=root_url)
+        limiter.acquire()
+        outcome = {"unanswered": False}
+        stack = self._stack()
+        stack.append((limiter, kind))
+        try:
+            yield outcome
+        finally:
+            stack.pop()
+            limiter.release()
+            if outcome["unanswered"]:
+                limiter.observe(kind=kind, congested=True)
+
+    def response_hook(self, response, *args, **kwargs):
+        """
+        requests response hook that adapts the limits of the slot held on this thread to a response, skipping
+        generateToken.
+        :param response: requests.Response
+        :return: None
+        """
+        stack = self._stack()
+        if not stack:
+            return
+        limiter, kind = stack[-1]
+        path = urlsplit(response.url).path.strip("/")
+        if path == TokenManager.GENERATE_TOKEN_PATH:
+            return
+        congested = (response.status_code >= 500 or response.status_code == 429
+                     or "html" in response.headers.get("Content-Type", ""))
+        limiter.observe(kind=kind, path=path, seconds=response.elapsed.total_seconds(), congested=congested)
+
+    def reset_counts(self):
+        """
+        Restart the counts of every machine, as at the start of each daemon cycle. The limits carry over.
+        :return: None
+        """
+        with self._lock:
+            limiters = list(self._machines.values())
+        for limiter in limiters:
+            limiter.reset_counts()
+
+    def print_summary(self):
+        """
+        Print the current and lowest limits, backoffs, and time spent waiting for a slot on every machine.
+        :return: None
+        """
+        with self._lock:
+            limiters = dict(self._machines)
+        adaptive = "adaptive" if self.machine_settings["adaptive"] else "fixed"
+        print(f"\nRATE LIMITS: {adaptive}, at most {self.machine_settings['max_concurrency']} in flight and "
+              f"{self.machine_settings['max_rate']:g} requests/s per machine")
+        for root_url, limiter in limiters.items():
+            if limiter.backoff_count:
+                lowest = f" (lowest {limiter.lowest_concurrency_limit:.1f} and {limiter.lowest_rate:.1f}/s)"
+            else:
+                lowest = ""
+            print(f"\t{root_url}: {limiter.requests} requests, {limiter.backoff_count} backoffs "
+                  f"({limiter.slow_count} slow, {limiter.error_count} errors), "
+                  f"now {limiter.concurrency_limit:.1f} in flight and {limiter.rate:.1f}/s{lowest}, "
+                  f"waited {limiter.waited_seconds:.2f}s over {limiter.waited_count} requests")
@@ -0,0 +1,348 @@
+"""
+Recording and replay of ArcGIS Server responses, for measuring the crawler without the production machines.
+
+Recording: a ResponseRecorder is registered as a response hook on the AGSClient and saves every services, folder
+report, and MapServer layers response to its own json file, keyed by the request path and parameters. Tokens,
+passwords, and generateToken responses are never written. Recording leaves streamed responses streamed: their body is
+copied as the crawler reads it and written when it has been read in full, so a body abandoned partway is not recorded.
+
+Replay: a ReplayServer is a local stand-in for the machines that answers from a directory of recordings. It generates
+tokens itself, can add latency and inject html errors or token rejections at configurable rates, and can scale the
+recorded catalog up to a target number of services by serving copies of the recorded folders under new names.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    record_directory    directory in which to record the responses of a crawl, relative to the project
+                        (default none, not recorded)
+
+The replay server can also be run on its own, for example:
+    python ags_replay.py benchmarks/recordings --port 6080 --latency 0.02 --services 1000
+and the crawler pointed at it with server_root_url = http://127.0.0.1:{port} and secureport = 6080.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from ags_http import KeepAliveRequestHandler
+from ags_output import atomic_output_file
+
+GENERATE_TOKEN_PATH = "arcgis/admin/generateToken"
+IGNORED_PARAMS = ("client", "password", "token", "username")   # Secret, or varying between runs and machines
+SERVICES_PATH = "arcgis/admin/services"
+
+
+def create_recording_key(path, params):
+    """
+    Create the key under which a response is recorded and looked up.
+    :param path: url path of the request, e.g. 'arcgis/admin/services/Folder/report'
+    :param params: list of (name, value) request parameters
+    :return: hex digest string
+    """
+    kept_params = sorted((name, value) for name, value in params if name not in IGNORED_PARAMS)
+    return hashlib.sha1(json.dumps([path.strip("/"), kept_params]).encode("utf-8")).hexdigest()
+
+
+class ResponseRecorder:
+    """Saves the responses received by an AGSClient to a directory of json files."""
+
+    def __init__(self, directory):
+        """
+        Instantiate a ResponseRecorder
+        :param directory: directory in which recordings are written, created when absent
+        """
+        self.directory = directory
+        self.recorded_count = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def response_hook(self, response, *args, **kwargs):
+        """
+        requests response hook that records a response, skipping generateToken and 304 Not Modified. A streamed
+        response is recorded once the caller has read its body to the end, from a copy of the chunks as they are read.
+        :param response: requests.Response
+        :return: None
+        """
+        path = urlsplit(response.request.url).path.strip("/")
+        if path == GENERATE_TOKEN_PATH or response.status_code == 304:
+            # A 304 answer to a cache revalidation has no body to replay
+            return
+        params = parse_qsl(urlsplit(response.request.url).query)
+        body = response.request.body
+        if body:
+            if isinstance(body, bytes):
+                body = body.decode("utf-8")
+            params += parse_qsl(body)
+        key = create_recording_key(path=path, params=params)
+        recording = {"path": path,
+                     "params": sorted((name, value) for name, value in params if name not in IGNORED_PARAMS),
+                     "status": response.status_code,
+                     "content_type": response.headers.get("Content-Type", "")}
+        if not kwargs.get("stream"):
+            self._write(key=key, recording=dict(recording, body=response.text))
+            return
+        # Reading response.text here would read the whole body before the caller could parse any of it
+        iter_content = response.iter_content
+
+        def recording_iter_content(*args, **kwargs):
+            chunks = []
+            for chunk in iter_content(*args, **kwargs):
+                chunks.append(chunk)
+                yield chunk
+            if chunks and isinstance(chunks[0], str):
+                body_text = "".join(chunks)
+            else:
+                body_text = b"".join(chunks).decode(response.encoding or "utf-8", errors="replace")
+            self._write(key=key, recording=dict(recording, body=body_text))
+
+        response.iter_content = recording_iter_content
+
+    def _write(self, key, recording):
+        """
+        Write a recording to its file, replacing it atomically.
+        :param key: recording key, see create_recording_key
+        :param recording: dictionary of 'path', 'params', 'status', 'content_type', and 'body'
+        :return: None
+        """
+        with atomic_output_file(path=os.path.join(self.directory, f"{key}.json")) as recording_file_handler:
+            json.dump(recording, recording_file_handler)
+        with self._lock:
+            self.recorded_count += 1
+
+
+class ReplayCatalog:
+    """Recorded responses, optionally scaled up by serving copies of the recorded folders."""
+    COPY_SEPARATOR = "_copy"
+
+    def __init__(self, recordings):
+        """
+        Instantiate a ReplayCatalog
+        :param recordings: dictionary of recording key to recording
+        """
+        self.recordings = recordings
+        self.folder_aliases = {}
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Read every recording in a directory.
+        :param directory: directory written by a ResponseRecorder
+        :return: ReplayCatalog
+        """
+        recordings = {}
+        for file_name in sorted(os.listdir(directory)):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(directory, file_name), 'r', encoding='utf-8') as recording_file_handler:
+                recording = json.load(recording_file_handler)
+            recordings[create_recording_key(path=recording["path"], params=recording["params"])] = recording
+        return cls(recordings=recordings)
+
+    def lookup(self, path, params):
+        """
+        Find the recorded response for a request. Paths into a copied folder are answered from the original folder.
+        :param path: url path of the request
+        :param params: list of (name, value) request parameters
+        :return: recording dictionary, or None when nothing was recorded for the request
+        """
+        path = "/".join(self.folder_aliases.get(segment, segment) for segment in path.strip("/").split("/"))
+        recording = self.recordings.get(create_recording_key(path=path, params=params))
+        if recording is not None and path == SERVICES_PATH and self.folder_aliases:
+            services = json.loads(recording["body"])
+            services["folders"] = services.get("folders", []) + sorted(self.folder_aliases)
+            recording = dict(recording, body=json.dumps(services))
+        return recording
+
+    def folder_service_counts(self):
+        """
+        Count the services in every recorded folder report.
+        :return: dictionary of folder name to number of services
+        """
+        counts = {}
+        for recording in self.recordings.values():
+            parts = recording["path"].split("/")
+            if len(parts) == 5 and recording["path"].startswith(SERVICES_PATH) and parts[4] == "report":
+                try:
+                    counts[parts[3]] = len(json.loads(recording["body"])["reports"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return counts
+
+    def scale(self, service_count):
+        """
+        Add copies of the recorded folders, in turn, until the catalog holds at least service_count services.
+        :param service_count: target number of services
+        :return: number of services in the scaled catalog
+        """
+        counts = {folder: count for folder, count in self.folder_service_counts().items() if count > 0}
+        self.folder_aliases = {}
+        total = sum(counts.values())
+        copy_number = 2
+        while counts and total < service_count:
+            for folder, count in sorted(counts.items()):
+                if total >= service_count:
+                    break
+                self.folder_aliases[f"{folder}{ReplayCatalog.COPY_SEPARATOR}{copy_number}"] = folder
+                total += count
+            copy_number += 1
+        return total
+
+
+class ReplayServer:
+    """Local HTTP stand-in for the ArcGIS Server machines, answering from a ReplayCatalog."""
+
+    def __init__(self, catalog, host="127.0.0.1", port=0, latency=0.0, latency_jitter=0.0, error_rate=0.0,
+                 mismatch_rate=0.0, seed=None):
+        """
+        Instantiate a ReplayServer
+        :param catalog: ReplayCatalog of recorded responses
+        :param host: address to listen on
+        :param port: port to listen on, 0 for any free port
+        :param latency: seconds added before every response
+        :param latency_jitter: upper limit of random seconds added on top of the latency
+        :param error_rate: fraction of responses replaced by an html error page
+        :param mismatch_rate: fraction of token protected responses replaced by a token rejection
+        :param seed: seed for the random injected errors and jitter, None for unseeded
+        """
+        self.catalog = catalog
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.mismatch_rate = mismatch_rate
+        self.request_count = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._server = ThreadingHTTPServer((host, port), self._create_handler())
+        self._server.daemon_threads = True
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def _draw(self):
+        """
+        Draw the random values for one response.
+        :return: tuple of (jitter seconds, error draw, mismatch draw)
+        """
+        with self._lock:
+            self.request_count += 1
+            return self._random.random() * self.latency_jitter, self._random.random(), self._random.random()
+
+    def respond(self, path, params):
+        """
+        Create the response to a request.
+        :param path: url path of the request
+        :param params: list of (name, value) request parameters
+        :return: tuple of (status, content type, body bytes)
+        """
+        jitter, error_draw, mismatch_draw = self._draw()
+        if self.latency or jitter:
+            time.sleep(self.latency + jitter)
+        path = path.strip("/")
+        if error_draw < self.error_rate:
+            return 503, "text/html", b"<html><body>Injected error</body></html>"
+        if path == GENERATE_TOKEN_PATH:
+            token = {"token": f"replay-{self.request_count}", "expires": int((time.time() + 3600) * 1000)}
+            return 200, "application/json", json.dumps(token).encode("utf-8")
+        if path.startswith("arcgis/admin") and mismatch_draw < self.mismatch_rate:
+            rejection = {"status": "error", "messages": ["Client Mismatch"], "code": 498}
+            return 200, "application/json", json.dumps(rejection).encode("utf-8")
+        recording = self.catalog.lookup(path=path, params=params)
+        if recording is None:
+            return 404, "text/html", b"<html><body>Not recorded</body></html>"
+        return recording["status"], recording["content_type"], recording["body"].encode("utf-8")
+
+    def _create_handler(self):
+        """
+        Create the request handler class bound to this server.
+        :return: KeepAliveRequestHandler subclass
+        """
+        replay_server = self
+
+        class ReplayRequestHandler(KeepAliveRequestHandler):
+
+            def do_GET(self):
+                self._reply(params=parse_qsl(urlsplit(self.path).query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+                self._reply(params=parse_qsl(urlsplit(self.path).query) + parse_qsl(body))
+
+            def _reply(self, params):
+                status, content_type, body = replay_server.respond(path=urlsplit(self.path).path, params=params)
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return ReplayRequestHandler
+
+    def start(self):
+        """
+        Serve requests on a background thread.
+        :return: None
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def serve_forever(self):
+        """
+        Serve requests on the current thread until interrupted.
+        :return: None
+        """
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        """
+        Stop serving and close the listening socket.
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded ArcGIS Server responses.")
+    parser.add_argument("recordings", help="directory of recordings")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="random seconds added on top")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of html error responses")
+    parser.add_argument("--mismatch-rate", type=float, default=0.0, help="fraction of token rejections")
+    parser.add_argument("--services", type=int, default=0, help="scale the catalog to at least this many services")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    catalog = ReplayCatalog.load(directory=args.recordings)
+    service_count = catalog.scale(service_count=args.services)
+    server = ReplayServer(catalog=catalog, host=args.host, port=args.port, latency=args.latency,
+                          latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                          mismatch_rate=args.mismatch_rate, seed=args.seed)
+    print(f"Replaying {len(catalog.recordings)} recordings, {service_count} services, on port {server.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
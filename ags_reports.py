@@ -0,0 +1,176 @@
+"""
+Service report processing for archiveDataToJSON_MOD.
+
+The admin report of each service is turned into a ReportObject carrying the values written to the output: status,
+map cache, the FeatureServer, KML, WMS, WFS, WCS, and WMTS extension flags, and the layers of map services. Kept apart
+from the network code so the processing can be run directly on report payloads, as the scale benchmarks do.
+"""
+
+GEODATA_ALIAS = "Geodata Data"
+GROUPED_TYPES_LIST = ("GeometryServer", "SearchServer", "GlobeServer", "GPServer", "GeocodeServer", "GeoDataServer")
+REPORTED_TYPES = GROUPED_TYPES_LIST + ("MapServer", "ImageServer")
+
+
+class ReportObject:
+    """Reports are summaries of services within folders. Slotted, as a large catalog holds one per service."""
+    __slots__ = ("folder", "type", "service_name", "rest_service_url_machine", "rest_service_url_geodata",
+                 "real_time_status", "cached", "feature_service", "kml", "wms", "wfs", "wcs", "wmts", "layers")
+    GEODATA_ROOT = "https://geodata.md.gov/imap/rest/services"
+    REST_URL_BEGINNING = "https://{machine_name}.mdgov.maryland.gov:{port}/arcgis/rest/services"
+    # Extension typeName to the attribute holding its 'enabled' flag
+    EXTENSION_FLAGS = {"FeatureServer": "feature_service",
+                       "KmlServer": "kml",
+                       "WMSServer": "wms",
+                       "WFSServer": "wfs",
+                       "WCSServer": "wcs",
+                       "WMTSServer": "wmts"}
+
+    def __init__(self, report, folder, machine_name, port, url_roots=None):
+        """
+        Instantiate an ReportObject. Only the values written to the output are kept, not the report itself.
+        :param report: json object with information about the services
+        :param folder: the folder in the services directory
+        :param machine_name: the name of the ags server machine currently being interrogated for information
+        :param port: secure port of the ags server machines
+        :param url_roots: tuple from create_url_roots for this folder, machine, and port, to share between the
+            services of a folder (default=None, created here)
+        """
+        if url_roots is None:
+            url_roots = ReportObject.create_url_roots(folder=folder, machine_name=machine_name, port=port)
+        self.folder = url_roots[0]
+        self.type = report["type"]
+        self.service_name = report["serviceName"]
+
+        # The url with geodata.md.gov, and the url with the machine name for use from a web server to bypass the
+        #   web adaptor
+        ending = f"{self.service_name}/{self.type}"
+        self.rest_service_url_geodata = f"{url_roots[1]}/{ending}"
+        self.rest_service_url_machine = f"{url_roots[2]}/{ending}"
+        self.real_time_status = report["status"]["realTimeState"]
+        self.cached = "NA"
+        self.feature_service = "NA"
+        self.kml = "NA"
+        self.wms = "NA"
+        self.wfs = "NA"
+        self.wcs = "NA"
+        self.wmts = "NA"
+        self.layers = "NA"
+        extension_index = self.create_extension_index(extensions=report["extensions"])
+        for type_name, attribute in ReportObject.EXTENSION_FLAGS.items():
+            extension = extension_index.get(type_name)
+            if extension is not None:
+                setattr(self, attribute, str(extension["enabled"]))
+
+    @staticmethod
+    def create_url_roots(folder, machine_name, port):
+        """
+        Create the parts of the service urls shared by every service in a folder.
+        :param folder: the folder in the services directory
+        :param machine_name: the name of the ags server machine currently being interrogated for information
+        :param port: secure port of the ags server machines
+        :return: tuple of (folder name as written, geodata.md.gov folder url, machine folder url)
+        """
+        folder = folder.replace("/", "")
+        beginning = ReportObject.REST_URL_BEGINNING.format(machine_name=machine_name, port=port)
+        return folder, f"{ReportObject.GEODATA_ROOT}/{folder}", f"{beginning}/{folder}"
+
+    @staticmethod
+    def create_extension_index(extensions):
+        """
+        Index a service's extensions by typeName in a single pass. When a typeName repeats, the first is kept.
+        :param extensions: list of extension dictionaries from the service report
+        :return: dictionary of typeName to extension dictionary
+        """
+        index = {}
+        for extension in extensions:
+            index.setdefault(extension["typeName"], extension)
+        return index
+
+    def create_base_dictionary(self):
+        """
+        Creates a dictionary of attributes for json.dumps() consumption.
+        This base dictionary is common to all service types.
+        :return:
+        """
+        data = {"ServiceName": self.service_name,
+                "Server": GEODATA_ALIAS,
+                "Folder": self.folder,
+                "URL": self.rest_service_url_geodata,
+                "Type": self.type,
+                "Status": self.real_time_status,
+                "Cached": self.cached,
+                "FeatureService": self.feature_service,
+                "kml": self.kml,
+                "wms": self.wms,
+                "wfs": self.wfs,
+                "wcs": self.wcs,
+                "wmts": self.wmts}
+        return data
+
+    def create_record(self):
+        """
+        Create the output dictionary for the service. MapServer services also carry their layers.
+        :return: dictionary
+        """
+        data = self.create_base_dictionary()
+        if self.type == "MapServer":
+            data["layers"] = self.layers
+        return data
+
+
+def create_layers_list(layers):
+    """
+    Create the list of layer id's and names that is written for a MapServer service.
+    :param layers: list of layer dictionaries from the MapServer rest endpoint
+    :return: list of dictionaries
+    """
+    layers_list = []
+    try:
+        for layer in layers:
+            layers_list.append({"id": str(layer["id"]), "name": layer["name"]})
+    except Exception as e:
+        print(f'No layers. {e}')
+    return layers_list
+
+
+def create_report_object(report, folder, machine_name, port, url_roots=None):
+    """
+    Create the report object for a service of interest, with its extension flags, and fill in the map cache of map
+    services. Map services get an empty layer list, which the caller replaces with the layers of started services.
+    :param report: json object with information about the service
+    :param folder: the folder in the services directory, as written to the output
+    :param machine_name: the name of the ags server machine currently being interrogated for information
+    :param port: secure port of the ags server machines
+    :param url_roots: tuple from ReportObject.create_url_roots shared by the folder's services (default=None)
+    :return: ReportObject, or None for service types not written to the output
+    """
+    if report["type"] not in REPORTED_TYPES:
+        # Service types not of interest are not written to the output
+        return None
+    report_object = ReportObject(report=report, folder=folder, machine_name=machine_name, port=port,
+                                 url_roots=url_roots)
+    if report_object.type == "MapServer":
+
+        # Check for Map Cache
+        report_object.cached = report["properties"]["isCached"]
+
+        # Stopped map services report an empty layer list
+        report_object.layers = []
+    return report_object
+
+
+def create_report_objects(reports, folder, machine_name, port):
+    """
+    Create the report objects for every service in a folder's reports, sharing the folder's url roots. The reports
+    are read one at a time as the pairs are consumed, so they can still be arriving from a streamed response.
+    :param reports: iterable of service reports for the folder
+    :param folder: the folder in the services directory, as written to the output
+    :param machine_name: the name of the ags server machine currently being interrogated for information
+    :param port: secure port of the ags server machines
+    :return: generator of (report, ReportObject, or None for service types not written) tuples, in the order of
+        reports
+    """
+    url_roots = ReportObject.create_url_roots(folder=folder, machine_name=machine_name, port=port)
+    for report in reports:
+        yield report, create_report_object(report=report, folder=folder, machine_name=machine_name, port=port,
+                                           url_roots=url_roots)
@@ -0,0 +1,332 @@
+"""
+Bounded retry of requests to the ArcGIS Server machines.
+
+A failed request is classified and retried with exponential backoff and jitter, up to a number of attempts set per
+class of failure:
+    network         the request itself failed (connection refused, reset, timed out)
+    not_json        the machine answered with html, or with a body that is not json
+    token_rejected  the key of interest is missing because the token was not accepted (Client Mismatch)
+    missing_key     the key of interest is missing for any other reason
+A rejected token is refreshed before the next attempt when a TokenManager is supplied. Once the attempts for a class
+are used up a RequestFailedException is raised, leaving the caller to record and skip the failed item.
+
+A request can also be given a deadline, a time.monotonic() value by which it must be answered, attempts and pauses
+included. Each attempt then waits on the server no longer than the time left, and no attempt is made that could not
+start before the deadline.
+
+fetch_json_items is the streaming counterpart of fetch_json_value, for a json array too large to decode at once. The
+elements are handed to a consuming function as they are parsed from the response. When an attempt fails partway
+through, the consuming function is called again from the start on the next attempt, so it must not keep anything from
+an earlier call.
+
+fetch_json_conditional is the cache revalidating counterpart of fetch_json_value. It makes a GET request carrying the
+validators of a cached copy, so the machine can answer 304 Not Modified in place of the body.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    retry_attempts_network, retry_attempts_not_json, retry_attempts_token_rejected, retry_attempts_missing_key
+                        attempts per class of failure, including the first (defaults 4, 2, 3, 2)
+    retry_base_delay    seconds before the first retry, doubled for each retry after (default 0.5)
+    retry_max_delay     upper limit of seconds between attempts (default 10)
+    retry_jitter        fraction of each delay that is randomized (default 0.5)
+"""
+
+import random
+import time
+
+from ags_client import AGSClient
+from ags_stream import JSONArrayStream
+from ags_tokens import TokenException, TokenManager
+
+DEADLINE = "deadline"
+MISSING_KEY = "missing_key"
+NETWORK = "network"
+NOT_JSON = "not_json"
+TOKEN_REJECTED = "token_rejected"
+UNKNOWN = "unknown"
+
+
+class NotJSONException(Exception):
+    """Raised when the url for the request is malformed for our purposes and the server returns html, not json"""
+
+
+class RequestFailedException(Exception):
+    """Raised when a request has failed on every attempt the retry policy allows"""
+    def __init__(self, url, error_class, attempts, message):
+        """
+        Instantiate a RequestFailedException
+        :param url: url of the failed request
+        :param error_class: class of the last failure, e.g. 'network'
+        :param attempts: number of attempts made
+        :param message: description of the last failure
+        """
+        super().__init__(f"{url} failed after {attempts} attempt(s) ({error_class}): {message}")
+        self.url = url
+        self.error_class = error_class
+        self.attempts = attempts
+
+
+class RetryPolicy:
+    """Decides whether, and after how long, a failed request is attempted again."""
+    CONFIG_SECTION = "crawl_settings"
+    DEFAULT_ATTEMPTS = {NETWORK: 4, NOT_JSON: 2, TOKEN_REJECTED: 3, MISSING_KEY: 2}
+
+    def __init__(self, attempts=None, base_delay=0.5, max_delay=10.0, jitter=0.5):
+        """
+        Instantiate a RetryPolicy
+        :param attempts: dictionary of failure class to maximum attempts, including the first, defaults when None
+        :param base_delay: seconds before the first retry, doubled for each retry after
+        :param max_delay: upper limit of seconds between attempts
+        :param jitter: fraction, 0 to 1, of each delay that is randomized so that workers do not retry in step
+        """
+        self.attempts = dict(RetryPolicy.DEFAULT_ATTEMPTS)
+        self.attempts.update(attempts or {})
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a retry policy using the [crawl_settings] values of a config, falling back to defaults when absent.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :return: RetryPolicy
+        """
+        section = cls.CONFIG_SECTION
+        attempts = {error_class: config.getint(section, f"retry_attempts_{error_class}", fallback=default)
+                    for error_class, default in RetryPolicy.DEFAULT_ATTEMPTS.items()}
+        return cls(attempts=attempts,
+                   base_delay=config.getfloat(section, "retry_base_delay", fallback=0.5),
+                   max_delay=config.getfloat(section, "retry_max_delay", fallback=10.0),
+                   jitter=config.getfloat(section, "retry_jitter", fallback=0.5))
+
+    def limited_to(self, error_classes):
+        """
+        Create a copy of the policy that makes a single attempt for any class of failure but the given ones.
+        :param error_classes: classes of failure still retried, e.g. (NETWORK, NOT_JSON)
+        :return: RetryPolicy
+        """
+        attempts = {error_class: (count if error_class in error_classes else 1)
+                    for error_class, count in self.attempts.items()}
+        return RetryPolicy(attempts=attempts, base_delay=self.base_delay, max_delay=self.max_delay, jitter=self.jitter)
+
+    def should_retry(self, error_class, attempt):
+        """
+        Decide whether another attempt is allowed.
+        :param error_class: class of the failure
+        :param attempt: number of the attempt that just failed, starting at 1
+        :return: boolean
+        """
+        return attempt < self.attempts.get(error_class, 1)
+
+    def delay(self, attempt):
+        """
+        Calculate the pause before the next attempt.
+        :param attempt: number of the attempt that just failed, starting at 1
+        :return: seconds
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+
+def classify_missing_key(params, response_json):
+    """
+    Classify a response lacking the key of interest.
+    :param params: parameters that accompanied the request
+    :param response_json: decoded json of the response
+    :return: TOKEN_REJECTED when the token sent was not accepted, otherwise MISSING_KEY
+    """
+    if "token" in params and TokenManager.is_token_rejected(response_json):
+        return TOKEN_REJECTED
+    return MISSING_KEY
+
+
+def attempt_timeout(timeout, deadline):
+    """
+    Calculate the seconds an attempt may wait on the server.
+    :param timeout: seconds to wait on the server, None for the client default
+    :param deadline: time.monotonic() by which the request must be answered, None for no deadline
+    :return: seconds, or None for the client default
+    """
+    if deadline is None:
+        return timeout
+    remaining = max(deadline - time.monotonic(), 0.001)
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+def prepare_retry(url, params, error_class, message, attempt, retry_policy, token_manager, deadline=None):
+    """
+    Raise when no further attempt is allowed, otherwise replace a rejected token and pause before the next attempt.
+    :param url: url of the request
+    :param params: parameters that accompanied the request
+    :param error_class: class of the failure
+    :param message: description of the failure
+    :param attempt: number of the attempt that just failed, starting at 1
+    :param retry_policy: RetryPolicy deciding on further attempts
+    :param token_manager: TokenManager used to replace a rejected token, None to retry with the same token
+    :param deadline: time.monotonic() by which the request must be answered, None for no deadline
+    :return: parameters for the next attempt
+    """
+    if not retry_policy.should_retry(error_class=error_class, attempt=attempt):
+        raise RequestFailedException(url=url, error_class=error_class, attempts=attempt, message=message)
+    delay = retry_policy.delay(attempt=attempt)
+    if deadline is not None and time.monotonic() + delay >= deadline:
+        raise RequestFailedException(url=url, error_class=error_class, attempts=attempt,
+                                     message=f"{message} (no time left before the deadline to retry)")
+    if error_class == TOKEN_REJECTED and token_manager is not None:
+        try:
+            token = token_manager.refresh(root_url=AGSClient.machine_key(url), rejected_token=params["token"])
+        except TokenException as te:
+            raise RequestFailedException(url=url, error_class=error_class, attempts=attempt, message=str(te))
+        params = dict(params, token=token)
+    time.sleep(delay)
+    return params
+
+
+def fetch_json_value(client, url, params, search_key, retry_policy, token_manager=None, timeout=None, deadline=None,
+                     full_response=False):
+    """
+    Submit a request with parameters to a url and return the value of the key of interest in the response json,
+    retrying failures according to the retry policy.
+    :param client: AGSClient used to make the request
+    :param url: url to which to make a request
+    :param params: parameters to accompany the request
+    :param search_key: the key of interest in the response json
+    :param retry_policy: RetryPolicy deciding on further attempts
+    :param token_manager: TokenManager used to replace a rejected token, None to retry with the same token
+    :param timeout: seconds to wait on each attempt, None for the client default
+    :param deadline: time.monotonic() by which the request must be answered, None for no deadline
+    :param full_response: return the whole response json once it holds the key, e.g. a token with its expiry
+        (default=False)
+    :return: content of json if key present in response, or the response json when full_response
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = client.post(url=url, data=params, timeout=attempt_timeout(timeout=timeout, deadline=deadline))
+            if "html" in response.headers.get("Content-Type", ""):
+                raise NotJSONException(f"Appears to be html, not json: {response.text[:200]}")
+            response_json = response.json()
+        except NotJSONException as nje:
+            error_class, message = NOT_JSON, str(nje)
+        except ValueError as ve:
+            error_class, message = NOT_JSON, f"Error decoding response to json: {ve}"
+        except Exception as e:
+            error_class, message = NETWORK, f"Error in response from requests: {e}"
+        else:
+            try:
+                value = response_json[search_key]
+            except (KeyError, TypeError) as e:
+                error_class = classify_missing_key(params=params, response_json=response_json)
+                message = f"{type(e).__name__}: {e} {response_json}"
+            else:
+                return response_json if full_response else value
+        params = prepare_retry(url=url, params=params, error_class=error_class, message=message, attempt=attempt,
+                               retry_policy=retry_policy, token_manager=token_manager, deadline=deadline)
+
+
+def fetch_json_conditional(client, url, params, search_key, retry_policy, validators=None, token_manager=None,
+                           timeout=None, deadline=None):
+    """
+    Submit a GET request with parameters to a url, sending the validators of a cached copy as If-None-Match and
+    If-Modified-Since, and return the value of the key of interest unless the machine answers not modified. Failures
+    are retried according to the retry policy.
+    :param client: AGSClient used to make the request
+    :param url: url to which to make a request
+    :param params: parameters to accompany the request
+    :param search_key: the key of interest in the response json
+    :param retry_policy: RetryPolicy deciding on further attempts
+    :param validators: dictionary of the cached copy's 'etag' and 'last_modified', empty or None for an unconditional
+        request
+    :param token_manager: TokenManager used to replace a rejected token, None to retry with the same token
+    :param timeout: seconds to wait on each attempt, None for the client default
+    :param deadline: time.monotonic() by which the request must be answered, None for no deadline
+    :return: tuple of (content of json if key present in response, or None when not modified, dictionary of the
+        response's 'etag' and 'last_modified')
+    """
+    validators = validators or {}
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            response = client.get(url=url, params=params, timeout=attempt_timeout(timeout=timeout, deadline=deadline),
+                                  headers=headers)
+            response_validators = {"etag": response.headers.get("ETag"),
+                                   "last_modified": response.headers.get("Last-Modified")}
+            if response.status_code == 304 and headers:
+                return None, response_validators
+            if "html" in response.headers.get("Content-Type", ""):
+                raise NotJSONException(f"Appears to be html, not json: {response.text[:200]}")
+            response_json = response.json()
+        except NotJSONException as nje:
+            error_class, message = NOT_JSON, str(nje)
+        except ValueError as ve:
+            error_class, message = NOT_JSON, f"Error decoding response to json: {ve}"
+        except Exception as e:
+            error_class, message = NETWORK, f"Error in response from requests: {e}"
+        else:
+            try:
+                return response_json[search_key], response_validators
+            except (KeyError, TypeError) as e:
+                error_class = classify_missing_key(params=params, response_json=response_json)
+                message = f"{type(e).__name__}: {e} {response_json}"
+        params = prepare_retry(url=url, params=params, error_class=error_class, message=message, attempt=attempt,
+                               retry_policy=retry_policy, token_manager=token_manager, deadline=deadline)
+
+
+def fetch_json_items(client, url, params, search_key, consume, retry_policy, token_manager=None, timeout=None,
+                     deadline=None):
+    """
+    Submit a request with parameters to a url and stream the elements of the json array under the key of interest
+    into a consuming function as they are parsed, retrying failures according to the retry policy.
+    :param client: AGSClient used to make the request
+    :param url: url to which to make a request
+    :param params: parameters to accompany the request
+    :param search_key: the key of the array of interest in the response json
+    :param consume: function called with an iterator of the array's elements, called afresh on every attempt
+    :param retry_policy: RetryPolicy deciding on further attempts
+    :param token_manager: TokenManager used to replace a rejected token, None to retry with the same token
+    :param timeout: seconds to wait on each attempt, None for the client default
+    :param deadline: time.monotonic() by which the request must be answered, None for no deadline
+    :return: the value returned by consume
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        stream = None
+        try:
+            with client.post(url=url, data=params, timeout=attempt_timeout(timeout=timeout, deadline=deadline),
+                             stream=True) as response:
+                if "html" in response.headers.get("Content-Type", ""):
+                    raise NotJSONException(f"Appears to be html, not json: {response.text[:200]}")
+                stream = JSONArrayStream.from_response(response=response, key=search_key)
+                if stream.find_key():
+                    items = stream.items()
+                    result = consume(items)
+                    # Whatever the consuming function left unread is parsed, so a truncated document is not missed
+                    for _ in items:
+                        pass
+                    stream.finish()
+                    return result
+        except NotJSONException as nje:
+            error_class, message = NOT_JSON, str(nje)
+        except Exception as e:
+            if stream is not None and stream.error is not e:
+                # Raised by the consuming function rather than by the request or the parse
+                raise
+            if isinstance(e, ValueError):
+                error_class, message = NOT_JSON, f"Error decoding response to json: {e}"
+            else:
+                error_class, message = NETWORK, f"Error in response from requests: {e}"
+        else:
+            error_class = classify_missing_key(params=params, response_json=stream.others)
+            message = f"KeyError: '{search_key}' {stream.others}"
+        params = prepare_retry(url=url, params=params, error_class=error_class, message=message, attempt=attempt,
+                               retry_policy=retry_policy, token_manager=token_manager, deadline=deadline)
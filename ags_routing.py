@@ -0,0 +1,123 @@
+"""
+Routing of requests across the ArcGIS Server machines.
+
+Rather than sending every request to one randomly chosen machine, a MachineRouter picks a machine for each request.
+The least_loaded strategy picks the machine with the fewest requests in flight. The latency strategy weights that
+load by each machine's recent response time, so a slow machine is given less of the work. A request counts as in
+flight on its machine from the moment the machine is chosen, including while it waits on the machine's rate limiter,
+so the requests queued behind a throttled machine count as its load and new work goes elsewhere. A machine that fails
+a request is set aside for a cooldown period, and the caller fails over to another machine.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    sharded             spread requests across all four machines (default False, one random machine)
+    routing             least_loaded or latency (default least_loaded)
+    failure_cooldown    seconds a failed machine is avoided (default 30)
+"""
+
+import threading
+import time
+
+
+class MachineRouter:
+    """Chooses the machine for each request and tracks load, latency, and failures per machine."""
+    LATENCY_SMOOTHING = 0.3     # Weight of the newest response time in the moving average
+    STRATEGIES = ("least_loaded", "latency")
+
+    def __init__(self, root_urls, strategy="least_loaded", failure_cooldown=30.0):
+        """
+        Instantiate a MachineRouter
+        :param root_urls: root urls of the machines requests may be sent to
+        :param strategy: 'least_loaded' or 'latency'
+        :param failure_cooldown: seconds a machine is avoided after a failed request
+        """
+        if strategy not in MachineRouter.STRATEGIES:
+            raise ValueError(f"Unknown routing strategy '{strategy}', expected one of {MachineRouter.STRATEGIES}")
+        self.strategy = strategy
+        self.failure_cooldown = failure_cooldown
+        self._machines = {root_url: {"in_flight": 0, "requests": 0, "failures": 0, "latency": None, "down_until": 0.0}
+                          for root_url in root_urls}
+        self._lock = threading.Lock()
+
+    @property
+    def root_urls(self):
+        return list(self._machines)
+
+    def _score(self, root_url):
+        """
+        Score a machine for the next request, lower is better. Caller must hold the lock.
+        :param root_url: root url of the machine
+        :return: tuple used for sorting
+        """
+        machine = self._machines[root_url]
+        if self.strategy == "latency":
+            # Machines without a measurement yet are tried first so every machine gets measured
+            latency = machine["latency"] or 0.0
+            return latency * (machine["in_flight"] + 1), machine["requests"]
+        return machine["in_flight"], machine["requests"]
+
+    def choose(self, exclude=()):
+        """
+        Choose the machine for the next request and count the request as in flight on it. Machines cooling down after
+        a failure are used only when no other machine is left. Every machine chosen must be followed by end, or by
+        cancel when no request is made.
+        :param exclude: root urls already tried for this request
+        :return: root url, or None when every machine has been excluded
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [root_url for root_url in self._machines if root_url not in exclude]
+            healthy = [root_url for root_url in candidates if self._machines[root_url]["down_until"] <= now]
+            if healthy:
+                candidates = healthy
+            if not candidates:
+                return None
+            root_url = min(candidates, key=self._score)
+            self._machines[root_url]["in_flight"] += 1
+            self._machines[root_url]["requests"] += 1
+            return root_url
+
+    def cancel(self, root_url):
+        """
+        Record that no request was made to a chosen machine after all.
+        :param root_url: root url of the machine
+        :return: None
+        """
+        with self._lock:
+            self._machines[root_url]["in_flight"] -= 1
+            self._machines[root_url]["requests"] -= 1
+
+    def end(self, root_url, seconds, succeeded):
+        """
+        Record that a request to a machine has finished.
+        :param root_url: root url of the machine
+        :param seconds: time taken by the request
+        :param succeeded: False sets the machine aside for the failure cooldown
+        :return: None
+        """
+        with self._lock:
+            machine = self._machines[root_url]
+            machine["in_flight"] -= 1
+            if succeeded:
+                if machine["latency"] is None:
+                    machine["latency"] = seconds
+                else:
+                    machine["latency"] += MachineRouter.LATENCY_SMOOTHING * (seconds - machine["latency"])
+            else:
+                machine["failures"] += 1
+                machine["down_until"] = time.time() + self.failure_cooldown
+
+    def print_summary(self):
+        """
+        Print the requests, failures, and average response time of every machine.
+        :return: None
+        """
+        print(f"\nROUTING: {self.strategy}")
+        with self._lock:
+            machines = {root_url: dict(machine) for root_url, machine in self._machines.items()}
+        for root_url, machine in machines.items():
+            if machine["latency"] is None:
+                latency = "n/a"
+            else:
+                latency = f"{machine['latency']:.3f}s"
+            print(f"\t{root_url}: {machine['requests']} requests, {machine['failures']} failures, "
+                  f"recent response time {latency}")
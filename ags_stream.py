@@ -0,0 +1,176 @@
+"""
+Streaming parse of a json array held under a key of a response's top level object.
+
+A folder 'report' response is a single object whose 'reports' array can be very large. JSONArrayStream reads the
+response body chunk by chunk and decodes one array element at a time with json.JSONDecoder.raw_decode, so the raw
+body and the fully decoded document never have to be held, and each element can be processed as soon as it arrives.
+The other members of the top level object are decoded normally and kept, so an error response lacking the key can
+still be inspected.
+"""
+
+import codecs
+import json
+
+CHUNK_SIZE = 64 * 1024
+NUMBER_CHARACTERS = "0123456789+-.eE"
+WHITESPACE = " \t\n\r"
+
+
+class JSONArrayStream:
+    """Parses the top level object of a json document from text chunks, streaming the elements of one array."""
+
+    def __init__(self, chunks, key):
+        """
+        Instantiate a JSONArrayStream
+        :param chunks: iterable of text chunks of the document
+        :param key: top level key of the array to stream
+        :return: None
+        """
+        self.key = key
+        self.others = {}
+        self.error = None
+        self._chunks = iter(chunks)
+        self._buffer = ""
+        self._position = 0
+        self._decoder = json.JSONDecoder()
+
+    @classmethod
+    def from_response(cls, response, key, chunk_size=CHUNK_SIZE):
+        """
+        Create a stream over the body of a requests.Response made with stream=True.
+        :param response: requests.Response
+        :param key: top level key of the array to stream
+        :param chunk_size: bytes read from the connection at a time
+        :return: JSONArrayStream
+        """
+        decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(errors="replace")
+        chunks = (decoder.decode(chunk) for chunk in response.iter_content(chunk_size=chunk_size))
+        return cls(chunks=chunks, key=key)
+
+    def _fill(self):
+        """
+        Append the next chunk to the buffer, dropping the text already parsed.
+        :return: False when the document has no more chunks
+        """
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            return False
+        except Exception as e:
+            self.error = e
+            raise
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def _peek(self):
+        """
+        Skip whitespace and return the next character without consuming it.
+        :return: character, or None at the end of the document
+        """
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in WHITESPACE:
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                return None
+
+    def _fail(self, message):
+        """
+        Record and raise a decoding error at the current position.
+        :param message: description of the problem
+        :return: None
+        """
+        self.error = json.JSONDecodeError(message, self._buffer, self._position)
+        raise self.error
+
+    def _expect(self, characters):
+        """
+        Consume the next character, which must be one of the given characters.
+        :param characters: string of acceptable characters
+        :return: the character consumed
+        """
+        character = self._peek()
+        if character is None or character not in characters:
+            self._fail(f"Expecting one of '{characters}'")
+        self._position += 1
+        return character
+
+    def _decode_value(self):
+        """
+        Decode the next complete json value, reading more chunks until it is whole.
+        :return: decoded value
+        """
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError as jde:
+                if not self._fill():
+                    self.error = jde
+                    raise
+                continue
+            if self._may_continue(value=value, end=end) and self._fill():
+                continue
+            self._position = end
+            return value
+
+    def _may_continue(self, value, end):
+        """
+        Decide whether a decoded value could be cut short by the end of the buffer. A number split across chunks,
+        like '4.5' followed by 'e10', decodes without error, so any number running up to the end of the buffer,
+        even through a trailing '.', 'e', or sign, is read again with more text.
+        :param value: decoded value
+        :param end: buffer position after the value
+        :return: boolean
+        """
+        if end == len(self._buffer):
+            return True
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return False
+        return all(character in NUMBER_CHARACTERS for character in self._buffer[end:])
+
+    def find_key(self):
+        """
+        Parse the top level object up to the start of the array under the key, keeping the other members.
+        :return: True when positioned at the first element of the array, False when the document has no such array
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self._position += 1
+            return False
+        while True:
+            name = self._decode_value()
+            if not isinstance(name, str):
+                self._fail("Expecting property name")
+            self._expect(":")
+            if name == self.key and self._peek() == "[":
+                self._position += 1
+                return True
+            self.others[name] = self._decode_value()
+            if self._expect(",}") == "}":
+                return False
+
+    def items(self):
+        """
+        Yield the elements of the array one at a time as they are parsed. Call after find_key returns True.
+        :return: iterator of decoded elements
+        """
+        if self._peek() == "]":
+            self._position += 1
+            return
+        while True:
+            yield self._decode_value()
+            if self._expect(",]") == "]":
+                return
+
+    def finish(self):
+        """
+        Parse the rest of the top level object after the array, keeping the other members.
+        :return: None
+        """
+        while self._expect(",}") == ",":
+            name = self._decode_value()
+            self._expect(":")
+            self.others[name] = self._decode_value()
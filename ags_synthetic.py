@@ -0,0 +1,101 @@
+"""
+Synthetic ArcGIS Server catalogs for scale testing the report processing.
+
+Produces admin folder 'report' payloads shaped like those of a real server: a mix of MapServer, ImageServer, the
+grouped utility types, and types not written to the output, with KmlServer, WMSServer, WFSServer, FeatureServer and
+other extensions, STARTED and STOPPED states, map caches, and instance statistics. The layers of a map service are
+generated on request, with counts varying from none to many. The same seed always produces the same catalog.
+"""
+
+import random
+
+from ags_reports import GROUPED_TYPES_LIST
+
+EXTENSION_TYPES = ("KmlServer", "WMSServer", "WFSServer", "FeatureServer", "WCSServer", "WMTSServer", "MobileServer",
+                   "NAServer", "SchematicsServer")
+# Relative frequency of each service type, roughly that of the production catalog
+SERVICE_TYPE_WEIGHTS = dict([("MapServer", 60), ("ImageServer", 10), ("SceneServer", 3), ("StreamServer", 1)]
+                            + [(service_type, 4) for service_type in GROUPED_TYPES_LIST])
+WORDS = ("Parcels", "Roads", "Hydrology", "Boundaries", "Imagery", "Elevation", "Wetlands", "Transportation",
+         "Schools", "Census", "Zoning", "Floodplain", "Geology", "Soils", "Landcover", "Addresses", "Bridges",
+         "Trails", "Parks", "Utilities")
+
+
+def create_report(rng, folder, index):
+    """
+    Create one service report.
+    :param rng: random.Random drawing the report's values
+    :param folder: folder of the service
+    :param index: position of the service in the folder, keeping service names unique
+    :return: dictionary shaped like an entry of the admin report's 'reports' list
+    """
+    service_type = rng.choices(list(SERVICE_TYPE_WEIGHTS), weights=list(SERVICE_TYPE_WEIGHTS.values()))[0]
+    service_name = f"{rng.choice(WORDS)}_{rng.choice(WORDS)}_{index}"
+    real_time_state = "STOPPED" if rng.random() < 0.15 else "STARTED"
+    extension_count = rng.choice((0, 1, 2, 3, 3, 4, 4, 5, 6))
+    extensions = [{"typeName": type_name,
+                   "capabilities": "Query,Map",
+                   "enabled": rng.choice(("true", "true", "false")),
+                   "maxUploadFileSize": 0,
+                   "allowedUploadFileTypes": "",
+                   "properties": {"title": service_name, "onlineResource": f"https://geodata.md.gov/{service_name}"}}
+                  for type_name in rng.sample(EXTENSION_TYPES, extension_count)]
+    busy = rng.randint(0, 3)
+    return {"folderName": folder,
+            "serviceName": service_name,
+            "type": service_type,
+            "description": f"{service_name.replace('_', ' ')} for the state of Maryland",
+            "isDefault": False,
+            "isPrivate": False,
+            "hasManifest": True,
+            "status": {"configuredState": real_time_state, "realTimeState": real_time_state},
+            "instances": {"folderName": folder, "serviceName": service_name, "type": service_type,
+                          "max": 2, "busy": busy, "free": 2 - min(busy, 2), "initializing": 0, "notCreated": 0,
+                          "transactions": rng.randint(0, 100000), "totalBusyTime": rng.randint(0, 10 ** 7),
+                          "isStatisticsAvailable": True},
+            "properties": {"isCached": rng.choice(("true", "false", "false")),
+                           "maxRecordCount": "1000",
+                           "maxImageHeight": "4096",
+                           "maxImageWidth": "4096"},
+            "extensions": extensions,
+            "iteminfo": {"description": "", "summary": service_name, "tags": [folder, service_type]},
+            "permissions": [{"principal": "esriEveryone", "permission": {"isAllowed": True}}]}
+
+
+def generate_folder_reports(service_count, services_per_folder=50, seed=0):
+    """
+    Generate the report payloads of a catalog, folder by folder, without holding the whole catalog.
+    :param service_count: number of services in the catalog
+    :param services_per_folder: number of services in each full folder
+    :param seed: seed of the catalog
+    :return: iterator of (folder name, list of service reports)
+    """
+    rng = random.Random(seed)
+    folder_number = 0
+    remaining = service_count
+    while remaining > 0:
+        folder_number += 1
+        count = min(services_per_folder, remaining)
+        folder = f"{rng.choice(WORDS)}{folder_number}"
+        yield folder, [create_report(rng=rng, folder=folder, index=index) for index in range(count)]
+        remaining -= count
+
+
+def generate_layers(report, seed=0):
+    """
+    Generate the layers a map service's rest endpoint returns. The count is skewed, most services having a few layers
+    and some having very many. The same report and seed always produce the same layers.
+    :param report: report of the map service
+    :param seed: seed of the catalog
+    :return: list of layer dictionaries
+    """
+    rng = random.Random(f"{seed}/{report['folderName']}/{report['serviceName']}")
+    layer_count = min(int(rng.expovariate(1 / 6)), 200)
+    return [{"id": layer_id,
+             "name": f"{rng.choice(WORDS)} {layer_id}",
+             "parentLayerId": -1,
+             "defaultVisibility": True,
+             "subLayerIds": None,
+             "minScale": 0,
+             "maxScale": 0}
+            for layer_id in range(layer_count)]
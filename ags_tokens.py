@@ -0,0 +1,225 @@
+"""
+Token cache for the ArcGIS Server machines.
+
+Tokens are generated once per machine and reused until shortly before the 'expires' time returned by generateToken.
+They can optionally be kept in a small json file, readable only by the owner, so that frequent scheduled runs reuse a
+token from a previous run instead of authenticating every time. When a machine rejects a token (the Client Mismatch
+case, or an invalid/expired token) the caller asks for a refresh and a new token is generated right away. Each machine
+has its own lock around generating its token, so threads wait on a slow generateToken only for that machine's token.
+A generateToken request that fails on the network or is answered with something other than json is retried under the
+crawl's retry policy, like the other admin requests. A response without a token, e.g. for bad credentials, is not.
+The reused count is the number of tokens from an earlier run or daemon cycle handed out again, each counted once.
+
+Settings are read from the optional [crawl_settings] section of Docs/credentials.cfg:
+    token_cache_path        json file for tokens shared across runs, relative to the project (default none)
+    token_refresh_margin    seconds before expiry at which a token is replaced (default 120)
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class TokenException(Exception):
+    """Raised when a machine does not return a token from generateToken"""
+    def __init__(self, message, error_class=None):
+        """
+        Instantiate a TokenException
+        :param message: description of the failure
+        :param error_class: retry class of the failed generateToken request, e.g. 'network', None when unknown
+        """
+        super().__init__(message)
+        self.error_class = error_class
+
+
+class TokenManager:
+    """Generates, caches, and refreshes tokens per machine."""
+    CONFIG_SECTION = "crawl_settings"
+    DEFAULT_LIFETIME_SECONDS = 3600     # ArcGIS Server default when 'expires' is absent from the response
+    GENERATE_TOKEN_PATH = "arcgis/admin/generateToken"
+    REJECTED_TOKEN_CODES = (498, 499)   # Invalid token, token required
+    # Lowercase phrases of the messages ArcGIS Server sends with a token it did not accept. Other errors may mention
+    #   a token, e.g. a permissions error, without a new token being of any help
+    REJECTED_TOKEN_PHRASES = ("invalid token", "token expired", "token has expired", "mismatch")
+
+    def __init__(self, client, username, password, cache_path=None, refresh_margin=120.0, profiler=None,
+                 retry_policy=None):
+        """
+        Instantiate a TokenManager
+        :param client: AGSClient used to make the generateToken requests
+        :param username: ags server admin username
+        :param password: ags server admin password
+        :param cache_path: path of the json file for tokens shared across runs, None to keep tokens in memory only
+        :param refresh_margin: seconds before expiry at which a cached token is no longer handed out
+        :param profiler: RequestProfiler timing the generateToken requests, None to skip timing
+        :param retry_policy: RetryPolicy for the generateToken requests, None for the default policy
+        """
+        self.client = client
+        self.username = username
+        self.password = password
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.profiler = profiler
+        self.retry_policy = retry_policy
+        self.generated_count = 0
+        self.reused_count = 0
+        self._tokens = {}
+        self._handed_out_tokens = set()
+        self._machine_locks = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @classmethod
+    def from_config(cls, config, client, root_path, profiler=None, retry_policy=None):
+        """
+        Create a token manager using the credentials and [crawl_settings] values of a config.
+        :param config: configparser.ConfigParser that has read the credentials file
+        :param client: AGSClient used to make the generateToken requests
+        :param root_path: project folder against which a relative token_cache_path is resolved
+        :param profiler: RequestProfiler timing the generateToken requests, None to skip timing
+        :param retry_policy: RetryPolicy for the generateToken requests, None for the default policy
+        :return: TokenManager
+        """
+        section = cls.CONFIG_SECTION
+        cache_path = config.get(section, "token_cache_path", fallback="")
+        if cache_path:
+            cache_path = os.path.join(root_path, cache_path)
+        return cls(client=client,
+                   username=config['ags_server_credentials']["username"],
+                   password=config['ags_server_credentials']["password"],
+                   cache_path=cache_path or None,
+                   refresh_margin=config.getfloat(section, "token_refresh_margin", fallback=120.0),
+                   profiler=profiler,
+                   retry_policy=retry_policy)
+
+    @staticmethod
+    def is_token_rejected(response_json):
+        """
+        Inspect a response for signs that the machine did not accept the token that was sent.
+        :param response_json: decoded json of a response lacking the expected key
+        :return: boolean
+        """
+        if not isinstance(response_json, dict) or response_json.get("status") != "error":
+            return False
+        if response_json.get("code") in TokenManager.REJECTED_TOKEN_CODES:
+            return True
+        messages = " ".join(str(message) for message in response_json.get("messages", [])).lower()
+        return any(phrase in messages for phrase in TokenManager.REJECTED_TOKEN_PHRASES)
+
+    def get_token(self, root_url):
+        """
+        Return a token for a machine, generating a new one only when none is cached or it is about to expire.
+        :param root_url: root url of the machine, e.g. 'https://machine.mdgov.maryland.gov:6443'
+        :return: token string
+        """
+        with self._machine_lock(root_url=root_url):
+            with self._lock:
+                cached = self._tokens.get(root_url)
+                if cached is not None and cached["expires"] / 1000 - self.refresh_margin > time.time():
+                    if cached["token"] not in self._handed_out_tokens:
+                        # Counted once per run, for a token generated by an earlier run or daemon cycle
+                        self._handed_out_tokens.add(cached["token"])
+                        self.reused_count += 1
+                    return cached["token"]
+            return self._generate(root_url=root_url)
+
+    def refresh(self, root_url, rejected_token=None):
+        """
+        Replace a machine's token after it was rejected. When another thread already replaced the rejected token the
+        newer token is returned instead of generating yet another one.
+        :param root_url: root url of the machine
+        :param rejected_token: the token the machine did not accept
+        :return: token string
+        """
+        with self._machine_lock(root_url=root_url):
+            with self._lock:
+                cached = self._tokens.get(root_url)
+                if cached is not None and rejected_token is not None and cached["token"] != rejected_token:
+                    return cached["token"]
+            return self._generate(root_url=root_url)
+
+    def reset_counts(self):
+        """
+        Restart the generated and reused counts, as at the start of each daemon cycle. A cached token handed out
+        again in the new cycle counts as reused.
+        :return: None
+        """
+        with self._lock:
+            self.generated_count = 0
+            self.reused_count = 0
+            self._handed_out_tokens.clear()
+
+    def _machine_lock(self, root_url):
+        """
+        Lock held while a machine's cached token is checked and, when needed, replaced.
+        :param root_url: root url of the machine
+        :return: threading.Lock
+        """
+        with self._lock:
+            return self._machine_locks.setdefault(root_url, threading.Lock())
+
+    def _generate(self, root_url):
+        """
+        Request a new token from a machine and cache it. Caller must hold the machine's lock, and not the shared lock,
+        which is only taken once the token has arrived.
+        :param root_url: root url of the machine
+        :return: token string
+        """
+        # ags_retry imports this module, so it is imported here rather than at the top
+        from ags_retry import NETWORK, NOT_JSON, RequestFailedException, RetryPolicy, fetch_json_value
+
+        url = f"{root_url}/{TokenManager.GENERATE_TOKEN_PATH}"
+        params = {'username': self.username, 'password': self.password, 'client': 'requestip', 'f': 'json'}
+        retry_policy = (self.retry_policy or RetryPolicy()).limited_to(error_classes=(NETWORK, NOT_JSON))
+        if self.profiler is None:
+            measurement = contextlib.nullcontext()
+        else:
+            measurement = self.profiler.measure(kind="token", machine=root_url)
+        try:
+            with measurement:
+                response_json = fetch_json_value(client=self.client, url=url, params=params, search_key="token",
+                                                 retry_policy=retry_policy, full_response=True)
+        except RequestFailedException as rfe:
+            raise TokenException(str(rfe), error_class=rfe.error_class)
+        token = response_json["token"]
+        expires = response_json.get("expires", (time.time() + TokenManager.DEFAULT_LIFETIME_SECONDS) * 1000)
+        with self._lock:
+            self._tokens[root_url] = {"token": token, "expires": int(expires)}
+            self._handed_out_tokens.add(token)
+            self.generated_count += 1
+            self._save()
+        return token
+
+    def _load(self):
+        """
+        Read tokens left by a previous run, ignoring a missing or unreadable cache file.
+        :return: None
+        """
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as cache_file_handler:
+                self._tokens = json.load(cache_file_handler)
+        except (OSError, ValueError) as e:
+            print(f"Token cache ignored, unable to read {self.cache_path}: {e}")
+            self._tokens = {}
+
+    def _save(self):
+        """
+        Write the cached tokens so only the owner can read them. The file is replaced atomically. Caller must hold
+        the lock.
+        :return: None
+        """
+        if self.cache_path is None:
+            return
+        temp_path = f"{self.cache_path}.tmp"
+        try:
+            file_descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(file_descriptor, 'w') as cache_file_handler:
+                json.dump(self._tokens, cache_file_handler)
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            print(f"Token cache not saved to {self.cache_path}: {e}")
@@ -7,6 +7,10 @@ A request is made to a machine first for a token and then for information on ser
 is used to write an output json file that is later used by the status dashboard web page to display performance for
 the services.
 
+The requests themselves are made by the crawl engine in ags_crawler. Run without options for the full run that writes
+the output files, or with --list-folders to print the folders, or --one-folder to print one folder's records as
+NDJSON without writing any files.
+
 Name:        AGS Directory to list of started/not with stats
 Purpose:     Use for status dashboard within DoIT
 Author: JCahoon
@@ -17,419 +21,428 @@ Revised: 20180821, CJuice, Redesigned to be object oriented, and addressed Clien
 Revised:
 """
 
-
-def main():
-
-    import configparser
+import sys
+
+
+def main(credentials_path=None, argv=None):
+    """
+    Run the crawl and write the output files, or run one of the light commands.
+    :param credentials_path: path of the config file (default=None, Docs/credentials.cfg in the project folder)
+    :param argv: list of command line arguments (default=None, none given)
+    :return: None
+    """
+
+    import argparse
+    import contextlib
+
+    parser = argparse.ArgumentParser(description="Interrogate the status of the ArcGIS Server services.")
+    parser.add_argument("--config", default=credentials_path,
+                        help="config file (default Docs/credentials.cfg in the project folder)")
+    parser.add_argument("--list-folders", action="store_true", help="print the folders of a machine and exit")
+    parser.add_argument("--one-folder", metavar="FOLDER",
+                        help="print the records of one folder as NDJSON, without writing any files")
+    # Any of the filters makes the run a partial crawl, merged into the existing output. Folders, service names,
+    #   types, and statuses are all matched without regard to case.
+    parser.add_argument("--folder", action="append", help="crawl only this folder, may be repeated")
+    parser.add_argument("--service", action="append", metavar="PATTERN",
+                        help="crawl only services whose name matches this pattern, e.g. 'Transportation_*', "
+                             "may be repeated")
+    parser.add_argument("--type", action="append",
+                        help="crawl only services of this type, e.g. MapServer or GPServer, may be repeated")
+    parser.add_argument("--status", action="append",
+                        help="crawl only services in this state, STARTED or STOPPED, may be repeated")
+    args = parser.parse_args(argv or [])
+    if args.one_folder is not None and args.folder:
+        parser.error("--folder cannot be combined with --one-folder, which names its folder itself")
+
+    # The crawl engine, and whatever it needs, is only imported once the arguments are known to be good
+    from ags_crawler import PROJECT_ROOT, Crawler, ServiceFilter, apply_probe_results, collect, load_config, \
+        merge_records
+    from ags_retry import RequestFailedException
+    from ags_tokens import TokenException
+
+    config = load_config(credentials_path=args.config)
+    if args.one_folder is not None or args.folder or args.service or args.type or args.status:
+        try:
+            service_filter = ServiceFilter(folders=[args.one_folder] if args.one_folder is not None else args.folder,
+                                           service_patterns=args.service,
+                                           types=args.type,
+                                           statuses=args.status)
+        except ValueError as ve:
+            parser.error(str(ve))
+    else:
+        service_filter = None
+
+    #   The light commands print their results to stdout, with the crawl's progress messages moved to stderr
+    if args.list_folders:
+        crawler = Crawler(config=config)
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                machine_object = crawler.connect()
+        except (TokenException, RequestFailedException) as e:
+            print(f"Folders unavailable: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            crawler.close()
+        for folder in machine_object.folders_list:
+            if folder not in ("", "/"):
+                print(folder)
+        return
+    if args.one_folder is not None:
+        import json
+        output = sys.stdout
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                for record in collect(config=config, service_filter=service_filter):
+                    print(json.dumps(record), file=output)
+        except (TokenException, RequestFailedException, ValueError) as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        return
+
+    import io
     import json
     import os
-    import random
-    import requests
-    # urllib3 is included in requests but to manage the InsecureRequestWarning it was also imported directly
-    import urllib3
-    from urllib3.exceptions import InsecureRequestWarning
+    import time
 
-    # Without disabled warnings, every request would print a red warning. This is because we have chosen
-    #   'verify=False' when making requests to secure services.
-    urllib3.disable_warnings(InsecureRequestWarning)
+    from ags_daemon import FolderSchedule, Snapshot, SnapshotServer, create_status
+    from ags_history import HistoryStore, HistoryWriter, print_events
+    from ags_output import JSONArrayWriter, NDJSONWriter, atomic_output_file
+    from ags_probe import create_probe_rollup, print_probe_summary, write_probe_rollup
 
     # VARIABLES
-    _ROOT_PROJECT_PATH = os.path.dirname(__file__)
-    CREDENTIALS_PATH = os.path.join(_ROOT_PROJECT_PATH, "Docs/credentials.cfg")
-    config = configparser.ConfigParser()    # Need sensitive information from config file
-    config.read(filenames=CREDENTIALS_PATH)
-
-    GEODATA_ALIAS = "Geodata Data"
-    GROUPED_TYPES_LIST = ("GeometryServer", "SearchServer", "GlobeServer", "GPServer", "GeocodeServer", "GeoDataServer")
-    PASSWORD = config['ags_server_credentials']["password"]
+    NDJSON_RESULT_FILE = "GeodataServices.ndjson"
     RESULT_FILE = "GeodataServices.json"
-    SERVER_MACHINE_NAMES = {0: config['ags_prod_machine_names']["machine1"],
-                            1: config['ags_prod_machine_names']["machine2"],
-                            2: config['ags_prod_machine_names']["machine3"],
-                            3: config['ags_prod_machine_names']["machine4"]}
-    SERVER_PORT_SECURE = config['ags_prod_machine_names']["secureport"]
-    SERVER_ROOT_URL = "https://{machine_name}.mdgov.maryland.gov:{port}"
-    SERVER_URL_ADMIN_SERVICES = "arcgis/admin/services"
-    SERVER_URL_GENERATE_TOKEN = "arcgis/admin/generateToken"
-    USERNAME = config['ags_server_credentials']["username"]
-
-    # CLASSES
-    class ReportObject:
-        """Reports are summaries of services within folders."""
-        GEODATA_ROOT = "https://geodata.md.gov/imap/rest/services"
-        REST_URL_BEGINNING = "https://{machine_name}.mdgov.maryland.gov:{port}/arcgis/rest/services"
-        REST_URL_END = "{folder}/{service_name}/{type}"
-
-        def __init__(self, report, folder, machine_name):
-            """
-            Instantiate an ReportObject
-            :param report: json object with information about the services
-            :param folder: the folder in the services directory
-            :param machine_name: the name of the ags server machine currently being interrogated for information
-            """
-            self.folder = folder
-            self.type = report["type"]
-            self.service_name = report["serviceName"]
-            self.rest_service_url_machine = machine_name
-            self.rest_service_url_geodata = None
-            self.real_time_status = report["status"]["realTimeState"]
-            self.cached = "NA"
-            self.feature_service = "NA"
-            self.kml = "NA"
-            self.wms = "NA"
-            self.wfs = "NA"
-            self.layers = "NA"
-            self.extensions = report["extensions"]
-
-        def create_base_dictionary(self):
-            """
-            Creates a dictionary of attributes for json.dumps() consumption.
-            This base dictionary is common to all service types.
-            :return:
-            """
-            data = {"ServiceName": self.service_name,
-                    "Server": GEODATA_ALIAS,
-                    "Folder": self.folder,
-                    "URL": self.rest_service_url_geodata,
-                    "Type": self.type,
-                    "Status": self.real_time_status,
-                    "Cached": self.cached,
-                    "FeatureService": self.feature_service,
-                    "kml": self.kml,
-                    "wms": self.wms,
-                    "wfs": self.wfs}
-            return data
-
-        @property
-        def folder(self):
-            return self.__folder
-
-        @folder.setter
-        def folder(self, value):
-            self.__folder = value.replace("/", "")
-
-        @property
-        def rest_service_url_geodata(self):
-            return self.__rest_service_url_geodata
-
-        @rest_service_url_geodata.setter
-        def rest_service_url_geodata(self, value):
-            """
-            Creates the url for a service with geodata.md.gov rather than the machine name
-            :param value: Not used, no initial assignment value
-            :return: None
-            """
-            ending = ReportObject.REST_URL_END.format(folder=self.folder, service_name=self.service_name, type=self.type)
-            self.__rest_service_url_geodata = f"{ReportObject.GEODATA_ROOT}/{ending}"
-
-        @property
-        def rest_service_url_machine(self):
-            return self.__rest_service_url_machine
-
-        @rest_service_url_machine.setter
-        def rest_service_url_machine(self, value):
-            """
-            Creates the url for a service with the machine name for use from a web server to bypass the web adaptor
-            :param value: Initial assignment value is the machine name only
-            :return: None
-            """
-            beginning = ReportObject.REST_URL_BEGINNING.format(machine_name=value, port=SERVER_PORT_SECURE)
-            ending = ReportObject.REST_URL_END.format(folder=self.folder, service_name=self.service_name, type=self.type)
-            self.__rest_service_url_machine = f"{beginning}/{ending}"
-
-        def create_json_string(self, data, indent=4):
-            """
-            Create and return a json string from a dictionary.
-            Intended to accept the base dictionary.
-            :param data: a dictionary; designed to accept the base dictionary
-            :param indent: json output pretty indent dimension (default=4)
-            :return: json
-            """
-            return json.dumps(obj=data, indent=indent)
-
-        def create_json_string_mapserver(self, data, indent=4):
-            """
-            Add a key/value pair to a dictionary and then create and return a json string from that dictionary.
-            Intended to accept the base dictionary and then add a key/value specific to MapServer type services.
-            :param data: a dictionary; designed to accept the base dictionary
-            :param indent: json output pretty indent dimension (default=4)
-            :return: json
-            """
-            data["layers"] = self.layers
-            return json.dumps(obj=data, indent=indent)
-
-    class MachineObject:
-        """Created to store machine properties and values."""
-        def __init__(self, machine_name, root_url, admin_services_url, token, folders):
-            """
-            Instantiate the machine objects
-            :param machine_name: name of the server machine
-            :param root_url: root url for machine
-            :param admin_services_url: root url for machine plus /arcgis/admin/services
-            :param token: the token generated by the machine for secure access
-            :param folders: list of folders discovered during inspection of the services
-            """
-            self.machine_name = machine_name
-            self.root_url = root_url
-            self.admin_services_url = admin_services_url
-            self.token = token
-            self.folders_list = folders
-        def __str__(self):
-            """
-            Overriding the __str__ builtin to control the appearance of the machine object print-out for readability.
-            :return: string
-            """
-            return f"{self.machine_name}-->\n\t{self.root_url}\n\t{self.admin_services_url}\n\t{self.token}\n\t{self.folders_list}"
-
-    class NotJSONException(Exception):
-        """Raised when the url for the request is malformed for our purposes and the server returns html, not json"""
-        def __init__(self):
-            pass
+    #   A partial crawl refreshes only the filtered services and merges them into the existing output. It is a single
+    #   run that leaves the incremental state and the history alone, as neither would be complete.
+    PARTIAL = service_filter is not None
+
+    # Optional tuning values live in a [crawl_settings] section. Fallbacks are used when the section is absent. The
+    #   settings of the requests themselves are read by the Crawler.
+    #   Incremental mode reuses the previous run's records for folders and services whose reports have not changed.
+    INCREMENTAL = config.getboolean("crawl_settings", "incremental", fallback=False) and not PARTIAL
+    INCREMENTAL_STATE_VERSION = 3
+    INCREMENTAL_STATE_FILE = config.get("crawl_settings", "incremental_state_file",
+                                        fallback="GeodataServices.state.json")
+    #   Compact output drops the pretty printing indent. NDJSON output is written alongside the json array file, and
+    #   a gzip copy of each output file can be published for the web server to serve without compressing it.
+    OUTPUT_COMPACT = config.getboolean("crawl_settings", "output_compact", fallback=False)
+    OUTPUT_GZIP = config.getboolean("crawl_settings", "output_gzip", fallback=False)
+    OUTPUT_NDJSON = config.getboolean("crawl_settings", "output_ndjson", fallback=False)
+    #   Every request is timed and the run profile written here, unless set empty.
+    PROFILE_FILE = config.get("crawl_settings", "profile_file", fallback="GeodataServices.profile.json")
+    #   Output, state, and profile files are written to the output directory, the project folder by default.
+    OUTPUT_DIRECTORY = os.path.join(PROJECT_ROOT, config.get("crawl_settings", "output_directory", fallback=""))
+    #   The probe stage writes a per-folder rollup of the probes here, unless set empty.
+    PROBE_FILE = config.get("crawl_settings", "probe_file", fallback="GeodataServices.probe.json")
+    #   Daemon mode stays resident and refreshes each folder on its own schedule, serving the latest snapshot over
+    #   http from memory. The previous cycle's records are kept in memory and reused as the incremental state is.
+    DAEMON = config.getboolean("crawl_settings", "daemon", fallback=False) and not PARTIAL
+    DAEMON_HOST = config.get("crawl_settings", "daemon_host", fallback="127.0.0.1")
+    DAEMON_PORT = config.getint("crawl_settings", "daemon_port", fallback=8085)
+
+    # The pooled client, tokens, profiler, retry policy, and failures of the crawl
+    crawler = Crawler(config=config, service_filter=service_filter)
+    # Refresh interval of each folder in daemon mode, and when each folder's report was last retrieved.
+    schedule = FolderSchedule.from_config(config=config)
+    # Each run's service statuses and the change events since the previous run are appended to the history, if kept.
+    if PARTIAL:
+        history = None
+    else:
+        history = HistoryStore.from_config(config=config, output_directory=OUTPUT_DIRECTORY)
 
     # FUNCTIONS
-    def create_params_for_request(token_action=None):
-        """
-        Create parameters to be submitted with the request.
-        :param token_action: route to be taken when creating the parameters
-        :return: dictionary of parameters
-        """
-        if token_action == None:
-            values = {'f': 'json'}
-        elif token_action == "getToken":
-            values = {'username': USERNAME, 'password': PASSWORD, 'client': 'requestip', 'f': 'json'}
-        else:
-            values = {'token': token_action, 'f': 'json'}
-        return values
-
-    def get_value_from_response(url, params, search_key):
+    def load_incremental_state(path):
         """
-        Submit a request with parameters to a url and inspect the response json for the specified key of interest.
-        :param url: url to which to make a request
-        :param params: parameters to accompany the request
-        :param search_key: the key of interest in the response json
-        :return: content of json if key present in response
+        Read the fingerprints and records left by the previous run.
+        :param path: path of the incremental state file
+        :return: dictionary of folder name to folder state, empty when no usable state exists
         """
-        # To deal with mixed path characters between url syntax and os.path.join use of "\"
-        url = clean_url_slashes(url)
-
-        # FROM ORIGINAL DESIGN HANDLING CLIENT MISMATCH ERROR CONCERNING TOKEN RECOGNITION
-        # To deal with the client mismatch error we were encountering, we used the following 'While' to make repeated
-        #   requests as a bypass. If the error is no longer encountered because the machine name is now used to bypass
-        #   the web adapter, which seemed to be connected to the issue with token mismatches, then the process will run
-        #   the first time so the 'While' is removed but may be of value if similar errors arise in the future.
-        # while True:
-
+        if not os.path.exists(path):
+            return {}
         try:
-            # Jessie discovered "verify" option and set to False to bypass the ssl issue
-            response = requests.post(url=url, data=params, verify=False)
-        except Exception as e:
-            print("Error in response from requests: {}".format(e))
-            exit()
-        else:
-            try:
-                if "html" in response.headers["Content-Type"]:
-                    raise NotJSONException
-                response_json = response.json()
-            except json.decoder.JSONDecodeError as jde:
-                print("Error decoding response to json: {}".format(jde))
-                print(response)
-                exit()
-            except NotJSONException as NJE:
-                print("Appears to be html, not json. Problem lies with ...")
-                print(response.url)
-                print(response.headers)
-                print(response.text)
-                exit()
-            try:
-                value = response_json[search_key]
-            except KeyError as ke:
-                print("KeyError: {}".format(ke))
-                # continue      # for While loop usage
-                exit()
-            except TypeError as te:
-                print("TypeError: {}".format(te))
-                print(response_json)
-                # continue       # for While loop usage
-                exit()
-            else:
-                return value
-
-    def clean_url_slashes(url):
-        """
-        Standardize the slashes when use of os.path.join() with forward slashes in url's.
-        os.path.join() uses back slashes '\' while http uses forward slashes '/'
-        :param url: url to be examined
-        :return: standardized url string
-        """
-        url = url.replace("\\", "/")
-        return url
-
-    def create_random_int(upper_integer):
+            with open(path, 'r') as state_file_handler:
+                state = json.load(state_file_handler)
+        except (OSError, ValueError) as e:
+            print(f"Incremental state ignored, unable to read {path}: {e}")
+            return {}
+        if state.get("version") != INCREMENTAL_STATE_VERSION:
+            print(f"Incremental state ignored, written by an older version: {path}")
+            return {}
+        return state["folders"]
+
+    def save_incremental_state(path, folders_state):
         """
-        Create and return a random integer from 0 to one less than the upper range value.
-        :param upper_integer: upper integer of range to be used
-        :return: integer
+        Write the fingerprints and records of this run for use by the next run.
+        :param path: path of the incremental state file
+        :param folders_state: dictionary of folder name to folder state
+        :return: None
         """
-        options = upper_integer - 1
-        spot = random.randint(0, options)
-        return spot
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as state_file_handler:
+            json.dump({"version": INCREMENTAL_STATE_VERSION, "folders": folders_state}, state_file_handler)
+        os.replace(temp_path, path)
 
-    def extract_extension_properties(extensions_dict, name_check, extensions="extensions", type_name="typeName"):
+    def wait_for_next_cycle(cycle_started, folders, error=None):
         """
-        Create and return a list of extensions values for a service based on the service type
-        :param extensions_dict: extensions dictionary to be inspected
-        :param name_check: name to check the type against
-        :param extensions: default use was 'extensions' per Jessie's design but could be other values too
-        :param type_name: default use was 'typeName' per Jessie's design but could be other values too
-        :return: list
+        Sleep in daemon mode until the next folder is due for a refresh. A cycle that ended without output is retried
+        after the shortest folder interval. An interrupt stops the daemon.
+        :param cycle_started: start time of the cycle just run
+        :param folders: list of folders listed by the cycle, empty when the listing failed
+        :param error: message when the cycle ended without output (default=None)
+        :return: None
         """
-        return [entity for entity in extensions_dict[extensions] if entity[type_name] == name_check]
+        if error is None:
+            next_cycle_time = schedule.next_due(folders=folders, cycle_started=cycle_started)
+        else:
+            next_cycle_time = cycle_started + schedule.shortest_interval()
+            snapshot.set_status(create_status(cycle_count=cycle_count,
+                                              cycle_started=cycle_started,
+                                              cycle_seconds=time.time() - cycle_started,
+                                              refreshed_folders=[],
+                                              folder_count=len(previous_state),
+                                              next_cycle=next_cycle_time,
+                                              failures=list(crawler.failures),
+                                              error=error))
+        wait_seconds = max(next_cycle_time - time.time(), 1.0)
+        print(f"\nDAEMON: next cycle in {wait_seconds:.0f}s")
+        try:
+            time.sleep(wait_seconds)
+        except KeyboardInterrupt:
+            print("DAEMON: stopped")
+            if snapshot_server is not None:
+                snapshot_server.stop()
+            if history is not None:
+                history.close()
+            crawler.close()
+            sys.exit()
 
     # FUNCTIONALITY
-    #   Select a machine at random to which to make a request.
-    machine = SERVER_MACHINE_NAMES[create_random_int(upper_integer=len(SERVER_MACHINE_NAMES))]
-    print(f"MACHINE: {machine}")
-
-    #   Get a token
-    root_server_url = SERVER_ROOT_URL.format(machine_name=machine, port=SERVER_PORT_SECURE)
-    generate_token_url = os.path.join(root_server_url, SERVER_URL_GENERATE_TOKEN)
-    token_params = create_params_for_request(token_action="getToken")
-    token = get_value_from_response(url=generate_token_url, params=token_params, search_key="token")
-
-    #   Make a request for secure services using the token
-    request_params_result = create_params_for_request(token_action=token)
-    admin_services_full_url = clean_url_slashes(os.path.join(root_server_url, SERVER_URL_ADMIN_SERVICES))
-    folders = get_value_from_response(url=admin_services_full_url,
-                                      params=request_params_result,
-                                      search_key="folders")
-
-    #   Remove certain folders (System and Utilities per Jessie), and append entry for root folder
-    remove_folders = ["System", "Utilities"]
-    folders = list(set(folders) - set(remove_folders))
-    folders.append("")
-    folders.sort()
-
-    #   Create a machine object for the selected ArcGIS Server machine.
-    machine_object = MachineObject(machine_name=machine,
-                                    root_url=root_server_url,
-                                    admin_services_url=admin_services_full_url,
-                                    token=token,
-                                    folders=folders)
-
-    #   Initiate the output file
-    machine_result_file = f"{RESULT_FILE}"
-    service_results_file_handler = open(os.path.join(_ROOT_PROJECT_PATH, machine_result_file), 'w')
-    service_results_file_handler.write("[")
-
-    #   Loop on the found folders, discover the services, and write the services information
-    folder_iteration_count = 0
-    for folder in machine_object.folders_list:
-        print(f"\nFOLDER: {folder} - {folder_iteration_count + 1} of {len(machine_object.folders_list)}")
-
-        # Determine if the current iteration is examining the root folder. If is, do nothing
-        folder_iteration_count += 1
-        if folder == "" or folder == "/":   # Unclear why Jessie included 'folder == "/"' but am preserving
+    #   In incremental mode the previous run's fingerprints decide which folders and services need rebuilding
+    incremental_state_path = os.path.join(OUTPUT_DIRECTORY, INCREMENTAL_STATE_FILE)
+    if INCREMENTAL:
+        previous_state = load_incremental_state(path=incremental_state_path)
+    else:
+        previous_state = {}
+
+    #   A partial crawl is merged into the records of an earlier full run
+    if PARTIAL:
+        try:
+            with open(os.path.join(OUTPUT_DIRECTORY, RESULT_FILE), 'r') as result_file_handler:
+                existing_records = json.load(result_file_handler)
+        except (OSError, ValueError) as e:
+            print(f"A partial crawl needs the output of a full run to merge into: {e}")
+            crawler.close()
+            sys.exit(1)
+        service_filter.use_existing_records(records=existing_records)
+
+    #   In daemon mode the crawl repeats in cycles, serving the latest snapshot from memory. Otherwise it runs once.
+    snapshot = Snapshot()
+    if DAEMON and DAEMON_PORT:
+        snapshot_server = SnapshotServer(snapshot=snapshot, host=DAEMON_HOST, port=DAEMON_PORT)
+        snapshot_server.start()
+        print(f"DAEMON: serving the snapshot at http://{DAEMON_HOST}:{snapshot_server.port}/")
+    else:
+        snapshot_server = None
+    cycle_count = 0
+    while True:
+        cycle_count += 1
+        run_start_time = time.time()
+        if DAEMON:
+            print(f"\nCYCLE: {cycle_count} started "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run_start_time))}")
+            crawler.profiler.reset()
+            crawler.failures.clear()
+            if crawler.layer_cache is not None:
+                crawler.layer_cache.reset()
+            crawler.rate_limiter.reset_counts()
+            crawler.token_manager.reset_counts()
+
+        #   Select a machine at random, get its token, and list its folders
+        try:
+            machine_object = crawler.connect()
+        except TokenException as te:
+            print("Error generating token: {}".format(te))
+            if not DAEMON:
+                crawler.close()
+                sys.exit(1)
+            wait_for_next_cycle(cycle_started=run_start_time, folders=[], error=f"Error generating token: {te}")
+            continue
+        except RequestFailedException as rfe:
+            print(f"Folders unavailable: {rfe}")
+            if not DAEMON:
+                crawler.close()
+                sys.exit(1)
+            wait_for_next_cycle(cycle_started=run_start_time, folders=[], error=f"Folders unavailable: {rfe}")
             continue
-        else:
 
-            # Build the URL for the current folder
-            folder += "/"
-            report_url = os.path.join(machine_object.admin_services_url, folder, "report")
-            report_request_params = create_params_for_request(token_action=machine_object.token)
-            reports = get_value_from_response(url=report_url, params=report_request_params, search_key="reports")
-
-            # Inspect service reports
-            report_iteration_count = 0
-            for report in reports:
-                line = ""
-                if folder == "":
-                    folder_name = "Root"
-                else:
-                    folder_name = folder
-
-                report_object = ReportObject(report=report, folder=folder_name, machine_name=machine)
-                if report_object.type in GROUPED_TYPES_LIST:
-                    line = report_object.create_json_string(data=report_object.create_base_dictionary())
-                elif report_object.type == "MapServer":
-
-                    # Check for Map Cache
-                    report_object.cached = report["properties"]["isCached"]
-
-                    if len(report_object.extensions) > 0:
-
-                        # Extract the KML, WMS, WFS, and FeatureServer properties from the response
-                        # Current design makes a list containing one dictionary. It then accesses the dictionary by
-                        #   specifying the zero index of the list to get the dict and then requests the 'enabled' key.
-                        #   TODO: Improvement - redesign for use of report object and simplify
-                        kml_properties = extract_extension_properties(extensions_dict=report, name_check="KmlServer")
-                        wms_properties = extract_extension_properties(extensions_dict=report, name_check="WMSServer")
-                        wfs_properties = extract_extension_properties(extensions_dict=report, name_check="WFSServer")
-                        feature_server_properties = extract_extension_properties(extensions_dict=report,
-                                                                                 name_check="FeatureServer")
-                        if len(feature_server_properties) > 0:
-                            report_object.feature_service = str(feature_server_properties[0]["enabled"])
-                        if len(kml_properties) > 0:
-                            report_object.kml = str(kml_properties[0]["enabled"])
-                        if len(wms_properties) > 0:
-                            report_object.wms = str(wms_properties[0]["enabled"])
-                        if len(wfs_properties) > 0:
-                            report_object.wfs = str(wfs_properties[0]["enabled"])
-
-                    # Handle map server layers. Functionality unique to Map Server.
-                    layer_iteration_count = 0
-                    layers_string = "["
-                    if report_object.real_time_status == "STARTED":
-                        layer_request_params = create_params_for_request()
-                        layers = get_value_from_response(url=report_object.rest_service_url_machine,
-                                                         params=layer_request_params,
-                                                         search_key="layers")
-                        try:
-                            for layer in layers:
-                                if layer_iteration_count == 0:
-                                    pass
-                                else:
-                                    layers_string += ","
-                                layer_data_dict = {"id": str(layer["id"]), "name": layer["name"]}
-                                layers_string += json.dumps(layer_data_dict)
-                                layer_iteration_count += 1
-                        except Exception as e:
-                            print(f'No layers. {e}')
-                    layers_string += "]"
-                    report_object.layers = layers_string
-                    line = report_object.create_json_string_mapserver(data=report_object.create_base_dictionary())
-                elif report["type"] == "ImageServer":
-                    wms_properties = extract_extension_properties(extensions_dict=report, name_check="WMSServer")
-                    if len(wms_properties) > 0:
-                        report_object.wms = str(wms_properties[0]["enabled"])
-                    line = report_object.create_json_string(data=report_object.create_base_dictionary())
-                else:
-                    # line would still be == "" if this else is accessed
-                    pass
-
-                # Insert a comma before all lines except for the first service report or where the line is empty.
-                if report_iteration_count == 0 or line == "":
-                    pass
-                else:
-                    line = f",{line}"
-
-                # Write the results to the file, unless the line is empty
-                if line == "":
-                    pass
-                else:
-                    service_results_file_handler.write(line)
-                    report_iteration_count += 1
-
-            # Insert a comma after all of a folders services have been processed
-            #   ***Except after the last folder of the entire output.
-            if folder_iteration_count < (len(folders)) and report_iteration_count > 0:
-                comma = ","
-                service_results_file_handler.write(comma)
+        #   In daemon mode only the folders due for a refresh are requested, the others keep their previous records
+        report_folders = [folder for folder in machine_object.folders_list if folder not in ("", "/")]
+        if PARTIAL:
+            try:
+                report_folders = service_filter.select_folders(folders=report_folders)
+            except ValueError as ve:
+                print(ve)
+                crawler.close()
+                sys.exit(1)
+        if DAEMON:
+            due_folders = [folder for folder in report_folders if schedule.is_due(folder=folder, now=run_start_time)]
+            print(f"DUE: {len(due_folders)} of {len(report_folders)} folders")
+        else:
+            due_folders = report_folders
+
+        #   Build a report object for each service of interest in every due folder and request the layers of started
+        #   map services.
+        folder_results = crawler.crawl(machine_object=machine_object,
+                                       folders=due_folders,
+                                       previous_state=previous_state,
+                                       refreshed_time=run_start_time)
+
+        #   Folders not due for a refresh carry their previous state forward. A folder waiting to retry a report that
+        #   has never been retrieved has none, and is left out of the output until it is.
+        for folder in set(report_folders) - set(due_folders):
+            if folder in previous_state:
+                folder_results[folder] = (None, [], 0)
+
+        #   Folders reused unchanged carry their previous state forward, the rest are written from their entries
+        folder_entries = {}
+        current_state = {}
+        layers_fetched_count = 0
+        layers_reused_count = 0
+        for folder, (entries, layers_pending, folder_layers_reused_count) in folder_results.items():
+            if entries is None:
+                current_state[folder] = previous_state[folder]
             else:
-                pass
+                folder_entries[folder] = entries
+            layers_fetched_count += len(layers_pending)
+            layers_reused_count += folder_layers_reused_count
+
+        #   Folders whose reports were retrieved this run, as opposed to carried forward
+        refreshed_folders = [folder for folder in due_folders
+                             if crawler.folder_refreshed.get(folder) == run_start_time]
+        for folder in refreshed_folders:
+            schedule.mark_refreshed(folder=folder, refreshed_time=run_start_time)
+        #   Folders whose report failed are retried with a backoff, rather than as soon as the next cycle starts
+        for folder in set(due_folders) - set(refreshed_folders):
+            schedule.mark_failed(folder=folder, failed_time=time.time())
+
+        #   Probe the started services of the refreshed folders. Their records take the probe fields when written.
+        if crawler.probe:
+            probe_targets = crawler.create_probe_targets(folders=refreshed_folders, folder_entries=folder_entries,
+                                                         folders_state=current_state)
+            probe_results = crawler.probe_all_services(targets=probe_targets, workers=crawler.probe_workers)
+        else:
+            probe_results = {}
 
-    service_results_file_handler.write("]")
-    service_results_file_handler.close()
+        #   Initiate the output files. They are written to temporary files and only replace the published files
+        #   once complete, so the dashboard never reads a partial file and an exit partway through leaves the old one
+        #   in place.
+        if OUTPUT_COMPACT:
+            indent = None
+        else:
+            indent = 4
+        with contextlib.ExitStack() as output_stack:
+            service_results_file_handler = output_stack.enter_context(
+                atomic_output_file(path=os.path.join(OUTPUT_DIRECTORY, RESULT_FILE), gzip_copy=OUTPUT_GZIP))
+            writers = [JSONArrayWriter(file_handler=service_results_file_handler, indent=indent)]
+            if OUTPUT_NDJSON:
+                ndjson_file_handler = output_stack.enter_context(
+                    atomic_output_file(path=os.path.join(OUTPUT_DIRECTORY, NDJSON_RESULT_FILE),
+                                       gzip_copy=OUTPUT_GZIP))
+                writers.append(NDJSONWriter(file_handler=ndjson_file_handler))
+            #   The daemon also keeps a copy of the json array in memory for the snapshot endpoint
+            if DAEMON:
+                snapshot_buffer = output_stack.enter_context(io.StringIO())
+                writers.append(JSONArrayWriter(file_handler=snapshot_buffer, indent=indent))
+            #   The history observes the records of the refreshed folders as they are written. It is not one of the
+            #   output files and is only recorded once they are published, so it cannot hold back the output.
+            if history is not None:
+                history_writer = HistoryWriter(store=history, started=run_start_time,
+                                               observed_folders=refreshed_folders)
+                record_writers = writers + [history_writer]
+            else:
+                record_writers = writers
+
+            #   Stream the services information, folder by folder in sorted order. Records of rebuilt folders are
+            #   created as they are written, and their fingerprints remembered for the next run.
+            reused_folder_count = len(current_state)
+            layers_changed_count = 0
+            new_records = []
+            for folder in machine_object.folders_list:
+                if folder in folder_entries:
+                    current_state[folder], folder_layers_changed_count = crawler.create_folder_state(
+                        entries=folder_entries[folder], previous_folder_state=previous_state.get(folder, {}))
+                    layers_changed_count += folder_layers_changed_count
+                elif folder not in current_state:
+                    continue
+                for service_state in current_state[folder]["services"].values():
+                    if service_state["record"] is not None:
+                        apply_probe_results(record=service_state["record"], probe_results=probe_results)
+                        if PARTIAL:
+                            new_records.append(service_state["record"])
+                            continue
+                        for writer in record_writers:
+                            writer.write(record=service_state["record"])
+
+            #   The records of a partial crawl take the place of the matching records of the earlier run
+            if PARTIAL:
+                merged_records, replaced_count, added_count, removed_count = merge_records(
+                    existing_records=existing_records,
+                    new_records=new_records,
+                    service_filter=service_filter,
+                    reported_keys={folder: {entry["key"] for entry in entries}
+                                   for folder, entries in folder_entries.items()})
+                for record in merged_records:
+                    for writer in record_writers:
+                        writer.write(record=record)
+
+            for writer in writers:
+                writer.close()
+            if DAEMON:
+                snapshot_body = snapshot_buffer.getvalue().encode("utf-8")
+
+        if INCREMENTAL:
+            print(f"\nINCREMENTAL: {reused_folder_count} of {len(current_state)} folders reused, "
+                  f"{layers_reused_count} layer lists reused, {layers_fetched_count} fetched "
+                  f"({layers_changed_count} changed)")
+            save_incremental_state(path=incremental_state_path, folders_state=current_state)
+
+        if PARTIAL:
+            print(f"\nMERGED: {replaced_count} replaced, {added_count} added, {removed_count} removed, "
+                  f"{len(merged_records) - replaced_count - added_count} kept from {RESULT_FILE}")
+        if history is not None:
+            history_writer.close()
+            if history_writer.events is not None:
+                print_events(events=history_writer.events)
+        if crawler.probe:
+            probe_rollup = create_probe_rollup(probe_results=probe_results)
+            print_probe_summary(rollup=probe_rollup)
+            if PROBE_FILE:
+                write_probe_rollup(path=os.path.join(OUTPUT_DIRECTORY, PROBE_FILE), rollup=probe_rollup,
+                                   started=run_start_time)
+        crawler.print_summary(profile_path=os.path.join(OUTPUT_DIRECTORY, PROFILE_FILE) if PROFILE_FILE else None)
+        if not DAEMON:
+            break
+
+        #   The next cycle keeps this cycle's records in memory as its previous state
+        previous_state = current_state
+        snapshot.update(body=snapshot_body,
+                        status=create_status(cycle_count=cycle_count,
+                                             cycle_started=run_start_time,
+                                             cycle_seconds=time.time() - run_start_time,
+                                             refreshed_folders=refreshed_folders,
+                                             folder_count=len(current_state),
+                                             next_cycle=schedule.next_due(folders=report_folders,
+                                                                          cycle_started=run_start_time),
+                                             failures=list(crawler.failures)))
+        del snapshot_body
+        wait_for_next_cycle(cycle_started=run_start_time, folders=report_folders)
+    if snapshot_server is not None:
+        snapshot_server.stop()
+    if history is not None:
+        history.close()
+    crawler.close()
 
 
 if __name__ == "__main__":
-    main()
+    main(argv=sys.argv[1:])
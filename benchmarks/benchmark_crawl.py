@@ -0,0 +1,175 @@
+"""
+End to end benchmark of archiveDataToJSON_MOD against recorded ArcGIS Server responses, without the network.
+
+A ReplayServer answers from a directory of recordings (see ags_replay), scaled to each catalog size by serving
+copies of the recorded folders. For every catalog size and crawl mode the crawler is run in its own process against
+the replay server, and its wall-clock time and throughput are reported. Modes:
+    serial      synchronous engine, one folder report and one layer request at a time
+    concurrent  synchronous engine with thread pool stages
+    async       asyncio engine
+
+Results can be written to a json report and compared with a previous report. The run fails when any mode and size
+is slower than the baseline by more than the allowed regression, so the suite can guard performance in CI.
+
+Usage:
+    python benchmarks/benchmark_crawl.py --sizes 10,100,1000,5000 --latency 0.005 --report bench.json
+    python benchmarks/benchmark_crawl.py --baseline bench.json --max-regression 0.25
+"""
+
+import argparse
+import configparser
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_replay import ReplayCatalog, ReplayServer  # noqa: E402
+
+MODES = {"serial": {"engine": "sync", "folder_report_workers": "1", "layer_workers": "1"},
+         "concurrent": {"engine": "sync", "folder_report_workers": "8", "layer_workers": "8"},
+         "async": {"engine": "async", "async_workers": "16"}}
+RECORDINGS_DIRECTORY = os.path.join(_ROOT_PROJECT_PATH, "benchmarks", "recordings")
+
+
+def write_config(path, port, output_directory, mode):
+    """
+    Write a credentials file pointing the crawler at the replay server.
+    :param path: path of the config file
+    :param port: port of the replay server
+    :param output_directory: directory for the crawl's output files
+    :param mode: name of the crawl mode
+    :return: None
+    """
+    config = configparser.ConfigParser()
+    config["ags_server_credentials"] = {"username": "benchmark", "password": "benchmark"}
+    config["ags_prod_machine_names"] = {"machine1": "replay1", "machine2": "replay2", "machine3": "replay3",
+                                        "machine4": "replay4", "secureport": str(port)}
+    # The replay server is local, so the rate ceiling meant to spare the production machines is lifted. The limits
+    #   still adapt, so their cost is measured.
+    config["crawl_settings"] = dict(MODES[mode],
+                                    server_root_url="http://127.0.0.1:{port}",
+                                    output_directory=output_directory,
+                                    retry_base_delay="0.05",
+                                    host_rate_limit="10000")
+    with open(path, 'w') as config_file_handler:
+        config.write(config_file_handler)
+
+
+def run_crawl(port, mode, log_path):
+    """
+    Run the crawler in its own process against the replay server.
+    :param port: port of the replay server
+    :param mode: name of the crawl mode
+    :param log_path: file that receives the crawler's printed output
+    :return: dictionary of the measurements
+    """
+    with tempfile.TemporaryDirectory() as output_directory:
+        config_path = os.path.join(output_directory, "credentials.cfg")
+        write_config(path=config_path, port=port, output_directory=output_directory, mode=mode)
+        command = [sys.executable, "-c",
+                   "import sys; sys.path.insert(0, sys.argv[1]); import archiveDataToJSON_MOD; "
+                   "archiveDataToJSON_MOD.main(credentials_path=sys.argv[2])",
+                   _ROOT_PROJECT_PATH, config_path]
+        start = time.perf_counter()
+        with open(log_path, 'a') as log_file_handler:
+            completed = subprocess.run(command, stdout=log_file_handler, stderr=subprocess.STDOUT)
+        seconds = time.perf_counter() - start
+
+        records = None
+        requests = None
+        result_path = os.path.join(output_directory, "GeodataServices.json")
+        profile_path = os.path.join(output_directory, "GeodataServices.profile.json")
+        if completed.returncode == 0 and os.path.exists(result_path):
+            with open(result_path, 'r') as result_file_handler:
+                records = len(json.load(result_file_handler))
+        if os.path.exists(profile_path):
+            with open(profile_path, 'r') as profile_file_handler:
+                requests = len(json.load(profile_file_handler)["samples"])
+    return {"returncode": completed.returncode, "seconds": seconds, "records": records, "requests": requests}
+
+
+def compare_with_baseline(results, baseline_path, max_regression):
+    """
+    Find the results slower than the baseline by more than the allowed regression.
+    :param results: list of result dictionaries from this run
+    :param baseline_path: path of a report from a previous run
+    :param max_regression: allowed slowdown as a fraction, e.g. 0.25
+    :return: list of messages describing regressions
+    """
+    with open(baseline_path, 'r') as baseline_file_handler:
+        baseline_results = json.load(baseline_file_handler)["results"]
+    baseline = {(result["mode"], result["services"]): result for result in baseline_results}
+    regressions = []
+    for result in results:
+        previous = baseline.get((result["mode"], result["services"]))
+        if previous is None:
+            continue
+        limit = previous["seconds"] * (1 + max_regression)
+        if result["seconds"] > limit:
+            regressions.append(f"{result['mode']} {result['services']} services: {result['seconds']:.2f}s, "
+                               f"baseline {previous['seconds']:.2f}s")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crawler against recorded responses.")
+    parser.add_argument("--recordings", default=RECORDINGS_DIRECTORY, help="directory of recordings")
+    parser.add_argument("--sizes", default="10,100,1000,5000", help="comma separated catalog sizes, in services")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated crawl modes")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds added to every response")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="random seconds added on top")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of html error responses")
+    parser.add_argument("--mismatch-rate", type=float, default=0.0, help="fraction of token rejections")
+    parser.add_argument("--report", default="", help="json file for the results")
+    parser.add_argument("--baseline", default="", help="json report of a previous run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.25, help="allowed slowdown against the baseline")
+    parser.add_argument("--log", default=os.devnull, help="file for the crawler's printed output")
+    args = parser.parse_args()
+
+    modes = [mode for mode in args.modes.split(",") if mode]
+    unknown_modes = set(modes) - set(MODES)
+    if unknown_modes:
+        parser.error(f"unknown modes {sorted(unknown_modes)}, expected some of {list(MODES)}")
+
+    catalog = ReplayCatalog.load(directory=args.recordings)
+    results = []
+    print(f"{'mode':<12}{'services':>10}{'records':>10}{'requests':>10}{'seconds':>10}{'services/s':>12}")
+    for size in (int(size) for size in args.sizes.split(",") if size):
+        service_count = catalog.scale(service_count=size)
+        with ReplayServer(catalog=catalog, latency=args.latency, latency_jitter=args.latency_jitter,
+                          error_rate=args.error_rate, mismatch_rate=args.mismatch_rate, seed=size) as server:
+            for mode in modes:
+                measurement = run_crawl(port=server.port, mode=mode, log_path=args.log)
+                result = dict(measurement, mode=mode, services=service_count,
+                              services_per_second=service_count / measurement["seconds"])
+                results.append(result)
+                if result["returncode"] != 0:
+                    print(f"{mode:<12}{service_count:>10}  crawl failed with exit code {result['returncode']}")
+                    continue
+                print(f"{mode:<12}{service_count:>10}{result['records']!s:>10}{result['requests']!s:>10}"
+                      f"{result['seconds']:>10.2f}{result['services_per_second']:>12.1f}")
+
+    if args.report:
+        with open(args.report, 'w') as report_file_handler:
+            json.dump({"created": time.time(), "latency": args.latency, "error_rate": args.error_rate,
+                       "mismatch_rate": args.mismatch_rate, "results": results}, report_file_handler, indent=4)
+        print(f"\nReport written to {args.report}")
+
+    failed = [result for result in results if result["returncode"] != 0]
+    regressions = []
+    if args.baseline:
+        regressions = compare_with_baseline(results=results, baseline_path=args.baseline,
+                                            max_regression=args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Micro-benchmark of extension flag extraction on synthetic service reports.
+
+Compares the per-report cost of the earlier approach, one linear scan of report["extensions"] for each of the
+KmlServer, WMSServer, WFSServer, and FeatureServer flags, with the single pass typeName index that ReportObject now
+builds and uses to fill every flag, including WCS and WMTS. The cost of constructing a whole ReportObject is shown
+for scale.
+
+Usage:
+    python benchmarks/benchmark_extensions.py --reports 20000 --repeat 5
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_reports import ReportObject  # noqa: E402
+from ags_synthetic import generate_folder_reports  # noqa: E402
+
+
+def extract_flags_by_scans(report):
+    """
+    The earlier extraction, kept here for comparison: a list comprehension over the extensions for every flag.
+    :param report: service report
+    :return: dictionary of flag attribute to value
+    """
+    flags = {}
+    for type_name in ("KmlServer", "WMSServer", "WFSServer", "FeatureServer"):
+        properties = [entity for entity in report["extensions"] if entity["typeName"] == type_name]
+        if len(properties) > 0:
+            flags[ReportObject.EXTENSION_FLAGS[type_name]] = str(properties[0]["enabled"])
+    return flags
+
+
+def extract_flags_by_index(report):
+    """
+    The current extraction: index the extensions once, then look up every flag.
+    :param report: service report
+    :return: dictionary of flag attribute to value
+    """
+    index = ReportObject.create_extension_index(extensions=report["extensions"])
+    flags = {}
+    for type_name, attribute in ReportObject.EXTENSION_FLAGS.items():
+        extension = index.get(type_name)
+        if extension is not None:
+            flags[attribute] = str(extension["enabled"])
+    return flags
+
+
+def construct_report_object(report):
+    """
+    Construct a complete ReportObject, including the extension flags.
+    :param report: service report
+    :return: ReportObject
+    """
+    return ReportObject(report=report, folder=f"{report['folderName']}/", machine_name="synthetic", port="6443")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark extension flag extraction per report.")
+    parser.add_argument("--reports", type=int, default=20000, help="number of synthetic reports")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repetitions, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic catalog")
+    args = parser.parse_args()
+
+    reports = [report
+               for _, folder_reports in generate_folder_reports(service_count=args.reports, seed=args.seed)
+               for report in folder_reports]
+    extension_count = sum(len(report["extensions"]) for report in reports)
+    print(f"{len(reports)} reports, {extension_count / len(reports):.1f} extensions per report on average")
+
+    # The index covers more flags than the scans did, so compare on the flags both produce
+    for report in reports:
+        scanned = extract_flags_by_scans(report=report)
+        indexed = extract_flags_by_index(report=report)
+        if any(indexed.get(attribute) != value for attribute, value in scanned.items()):
+            raise AssertionError(f"Extraction differs for {report['serviceName']}: {scanned} {indexed}")
+
+    for name, function in (("four scans", extract_flags_by_scans),
+                           ("single pass index", extract_flags_by_index),
+                           ("ReportObject", construct_report_object)):
+        seconds = min(timeit.repeat(lambda: [function(report) for report in reports], number=1, repeat=args.repeat))
+        print(f"\t{name:<20}{seconds / len(reports) * 1e6:>8.2f} µs per report")
+
+
+if __name__ == "__main__":
+    main()
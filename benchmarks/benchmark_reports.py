@@ -0,0 +1,171 @@
+"""
+Scale benchmark of the report processing on synthetic catalogs, without a server.
+
+Synthetic folder reports (see ags_synthetic) are fed straight into the processing path of archiveDataToJSON_MOD:
+Crawler.build_folder_entries, which fingerprints each service and builds its ReportObject with extension extraction
+through create_report_objects, layer lists for the started map services it leaves pending, and the streaming json
+writer. As in the crawler, the folder entries of the whole catalog are held until they are written. For each catalog
+size the benchmark reports records per second for building and writing, and memory held by the report payloads and
+by the report objects, measured in a separate pass with tracemalloc. Optionally the build and write are profiled to
+show the CPU hot spots.
+
+Usage:
+    python benchmarks/benchmark_reports.py --sizes 10000,100000
+    python benchmarks/benchmark_reports.py --sizes 10000 --cprofile 15
+"""
+
+import argparse
+import configparser
+import cProfile
+import gc
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_crawler import Crawler  # noqa: E402
+from ags_output import JSONArrayWriter  # noqa: E402
+from ags_reports import create_layers_list  # noqa: E402
+from ags_synthetic import generate_folder_reports, generate_layers  # noqa: E402
+
+MEBIBYTE = 1024 * 1024
+
+
+def generate_catalog(service_count, seed):
+    """
+    Generate a catalog's folder reports and the layers of its started map services.
+    :param service_count: number of services
+    :param seed: seed of the catalog
+    :return: list of (folder, reports, dictionary of service name to layers)
+    """
+    catalog = []
+    for folder, reports in generate_folder_reports(service_count=service_count, seed=seed):
+        layers = {report["serviceName"]: generate_layers(report=report, seed=seed)
+                  for report in reports
+                  if report["type"] == "MapServer" and report["status"]["realTimeState"] == "STARTED"}
+        catalog.append((folder, reports, layers))
+    return catalog
+
+
+def create_crawler():
+    """
+    Create a Crawler for its processing alone. No request is made.
+    :return: Crawler
+    """
+    config = configparser.ConfigParser()
+    config["ags_server_credentials"] = {"username": "benchmark", "password": "benchmark"}
+    config["ags_prod_machine_names"] = {"machine1": "synthetic", "machine2": "synthetic", "machine3": "synthetic",
+                                        "machine4": "synthetic", "secureport": "6443"}
+    return Crawler(config=config)
+
+
+def build_report_objects(crawler, catalog):
+    """
+    Run the crawler's processing on every folder report: build the folder entries, with their report objects, and
+    the layer lists of the services left pending.
+    :param crawler: Crawler returned by create_crawler
+    :param catalog: list returned by generate_catalog
+    :return: list of ReportObjects
+    """
+    report_objects = []
+    for folder, reports, layers in catalog:
+        entries, layers_pending, _ = crawler.build_folder_entries(folder=folder, reports=reports,
+                                                                  previous_folder_state={}, machine_name="synthetic",
+                                                                  refreshed_time=0.0)
+        for report_object in layers_pending:
+            report_object.layers = create_layers_list(layers=layers[report_object.service_name])
+        report_objects.extend(entry["report_object"] for entry in entries if entry["report_object"] is not None)
+    return report_objects
+
+
+def write_records(report_objects):
+    """
+    Stream the records of the report objects through the json writer, discarding the output.
+    :param report_objects: list of ReportObjects
+    :return: number of records written
+    """
+    with open(os.devnull, 'w') as output_file_handler:
+        writer = JSONArrayWriter(file_handler=output_file_handler, indent=4)
+        for report_object in report_objects:
+            writer.write(record=report_object.create_record())
+        writer.close()
+    return writer.record_count
+
+
+def measure_speed(crawler, catalog):
+    """
+    Time building and writing a catalog.
+    :param crawler: Crawler returned by create_crawler
+    :param catalog: list returned by generate_catalog
+    :return: dictionary of record count and seconds per stage
+    """
+    gc.collect()
+    start = time.perf_counter()
+    report_objects = build_report_objects(crawler=crawler, catalog=catalog)
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    record_count = write_records(report_objects=report_objects)
+    write_seconds = time.perf_counter() - start
+    return {"records": record_count, "build_seconds": build_seconds, "write_seconds": write_seconds}
+
+
+def measure_memory(crawler, service_count, seed):
+    """
+    Measure the memory held by a catalog's report payloads and by its report objects.
+    :param crawler: Crawler returned by create_crawler
+    :param service_count: number of services
+    :param seed: seed of the catalog
+    :return: dictionary of bytes for the payloads, the report objects, and the peak
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        catalog = generate_catalog(service_count=service_count, seed=seed)
+        payload_bytes, _ = tracemalloc.get_traced_memory()
+        report_objects = build_report_objects(crawler=crawler, catalog=catalog)
+        total_bytes, _ = tracemalloc.get_traced_memory()
+        write_records(report_objects=report_objects)
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"payload_bytes": payload_bytes, "object_bytes": total_bytes - payload_bytes, "peak_bytes": peak_bytes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the report processing on synthetic catalogs.")
+    parser.add_argument("--sizes", default="10000,100000", help="comma separated catalog sizes, in services")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic catalogs")
+    parser.add_argument("--cprofile", type=int, default=0, help="print this many functions by own time")
+    args = parser.parse_args()
+
+    print(f"{'services':>10}{'records':>10}{'build/s':>12}{'write/s':>12}{'records/s':>12}"
+          f"{'payload MiB':>13}{'objects MiB':>13}{'bytes/obj':>11}{'peak MiB':>10}")
+    crawler = create_crawler()
+    for size in (int(size) for size in args.sizes.split(",") if size):
+        catalog = generate_catalog(service_count=size, seed=args.seed)
+        speed = measure_speed(crawler=crawler, catalog=catalog)
+        if args.cprofile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            write_records(report_objects=build_report_objects(crawler=crawler, catalog=catalog))
+            profiler.disable()
+        del catalog
+        memory = measure_memory(crawler=crawler, service_count=size, seed=args.seed)
+
+        records = speed["records"]
+        print(f"{size:>10}{records:>10}{records / speed['build_seconds']:>12.0f}"
+              f"{records / speed['write_seconds']:>12.0f}"
+              f"{records / (speed['build_seconds'] + speed['write_seconds']):>12.0f}"
+              f"{memory['payload_bytes'] / MEBIBYTE:>13.1f}{memory['object_bytes'] / MEBIBYTE:>13.1f}"
+              f"{memory['object_bytes'] / max(records, 1):>11.0f}{memory['peak_bytes'] / MEBIBYTE:>10.1f}")
+        if args.cprofile:
+            pstats.Stats(profiler, stream=sys.stdout).sort_stats("tottime").print_stats(args.cprofile)
+    crawler.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark of streaming versus whole decoding of a folder report response.
+
+A synthetic folder report of each size is serialized once, then turned into report objects two ways: decoding the
+whole body with json.loads before processing, as fetch_json_value does, and parsing the 'reports' array one service
+at a time from 64 KiB chunks with JSONArrayStream, as fetch_json_items does. For each the peak memory allocated while
+parsing and processing is measured with tracemalloc, along with the time until the first report object exists and the
+total time. The serialized body itself, standing in for the server, is not counted.
+
+Usage:
+    python benchmarks/benchmark_stream.py --sizes 1000,10000,50000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_reports import create_report_objects  # noqa: E402
+from ags_stream import CHUNK_SIZE, JSONArrayStream  # noqa: E402
+from ags_synthetic import generate_folder_reports  # noqa: E402
+
+MEBIBYTE = 1024 * 1024
+
+
+def process(reports, timings):
+    """
+    Create the report objects of a folder, noting when the first one exists.
+    :param reports: iterable of service reports
+    :param timings: dictionary receiving 'first', the perf_counter time of the first report object
+    :return: list of ReportObjects
+    """
+    report_objects = []
+    for _, report_object in create_report_objects(reports=reports, folder="Synthetic", machine_name="synthetic",
+                                                  port="6443"):
+        if "first" not in timings:
+            timings["first"] = time.perf_counter()
+        if report_object is not None:
+            report_objects.append(report_object)
+    return report_objects
+
+
+def decode_whole(body, timings):
+    """
+    Decode the whole body, then process the reports.
+    :param body: bytes of the response body
+    :param timings: dictionary receiving the time of the first report object
+    :return: list of ReportObjects
+    """
+    return process(reports=json.loads(body.decode("utf-8"))["reports"], timings=timings)
+
+
+def decode_streamed(body, timings):
+    """
+    Parse and process the reports one at a time from chunks of the body.
+    :param body: bytes of the response body
+    :param timings: dictionary receiving the time of the first report object
+    :return: list of ReportObjects
+    """
+    chunks = (body[start:start + CHUNK_SIZE].decode("utf-8") for start in range(0, len(body), CHUNK_SIZE))
+    stream = JSONArrayStream(chunks=chunks, key="reports")
+    if not stream.find_key():
+        raise KeyError("reports")
+    report_objects = process(reports=stream.items(), timings=timings)
+    stream.finish()
+    return report_objects
+
+
+def measure(decode, body):
+    """
+    Measure one way of decoding a body.
+    :param decode: decode_whole or decode_streamed
+    :param body: bytes of the response body
+    :return: dictionary of peak bytes, seconds to the first report object, and total seconds
+    """
+    timings = {}
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        report_objects = decode(body=body, timings=timings)
+        seconds = time.perf_counter() - start
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"objects": len(report_objects), "peak_bytes": peak_bytes, "first_seconds": timings["first"] - start,
+            "seconds": seconds}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark streaming versus whole decoding of folder reports.")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="comma separated folder sizes, in services")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic folders")
+    args = parser.parse_args()
+
+    print(f"{'services':>10}{'body MiB':>10}{'mode':>10}{'peak MiB':>10}{'first ms':>10}{'seconds':>10}")
+    for size in (int(size) for size in args.sizes.split(",") if size):
+        _, reports = next(generate_folder_reports(service_count=size, services_per_folder=size, seed=args.seed))
+        body = json.dumps({"reports": reports}).encode("utf-8")
+        del reports
+        for mode, decode in (("whole", decode_whole), ("streamed", decode_streamed)):
+            result = measure(decode=decode, body=body)
+            print(f"{size:>10}{len(body) / MEBIBYTE:>10.1f}{mode:>10}{result['peak_bytes'] / MEBIBYTE:>10.1f}"
+                  f"{result['first_seconds'] * 1000:>10.1f}{result['seconds']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Replay servers standing in for the ArcGIS Server machines, for the tests that run the crawler end to end.
+
+Each machine is a ReplayServer on its own port answering from the recordings of benchmarks/recordings, and the
+crawler is pointed at them with server_root_url = http://{machine_name}, the machine names being host:port.
+"""
+
+import configparser
+import contextlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from ags_replay import ReplayCatalog, ReplayServer
+
+RECORDINGS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks",
+                                    "recordings")
+
+
+def start_machines(test, count=1, **server_settings):
+    """
+    Start replay machines answering from the recordings, stopped when the test ends.
+    :param test: unittest.TestCase the machines are for
+    :param count: number of machines
+    :param server_settings: keyword arguments of ReplayServer, e.g. error_rate
+    :return: list of ReplayServers
+    """
+    catalog = ReplayCatalog.load(directory=RECORDINGS_DIRECTORY)
+    machines = [ReplayServer(catalog=catalog, **server_settings) for _ in range(count)]
+    for machine in machines:
+        machine.start()
+
+    def stop_machines():
+        # Each server takes up to its poll interval to stop, so they are stopped together
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            list(executor.map(ReplayServer.stop, machines))
+
+    test.addCleanup(stop_machines)
+    return machines
+
+
+def record_paths(machine):
+    """
+    Record the path of every request a replay machine answers.
+    :param machine: ReplayServer
+    :return: list, appended to with the path of each request
+    """
+    paths = []
+    respond = machine.respond
+
+    def recording_respond(path, params):
+        paths.append(path.strip("/"))
+        return respond(path=path, params=params)
+
+    machine.respond = recording_respond
+    return paths
+
+
+def create_config(machines, **settings):
+    """
+    Create the config of a crawl of replay machines. The four configured machine names cycle through the machines.
+    :param machines: list of ReplayServers
+    :param settings: [crawl_settings] values, added to those keeping the tests fast and free of output files
+    :return: configparser.ConfigParser
+    """
+    config = configparser.ConfigParser()
+    config["ags_server_credentials"] = {"username": "test", "password": "test"}
+    config["ags_prod_machine_names"] = {f"machine{number}": f"127.0.0.1:{machines[(number - 1) % len(machines)].port}"
+                                        for number in range(1, 5)}
+    config["ags_prod_machine_names"]["secureport"] = "6443"
+    config["crawl_settings"] = dict({"server_root_url": "http://{machine_name}",
+                                     "retry_base_delay": "0.01",
+                                     "retry_jitter": "0",
+                                     "host_rate_limit": "10000",
+                                     "profile_file": ""},
+                                    **{name: str(value) for name, value in settings.items()})
+    return config
+
+
+def root_url(machine):
+    """
+    Root url the crawler uses for a replay machine.
+    :param machine: ReplayServer
+    :return: string
+    """
+    return f"http://127.0.0.1:{machine.port}"
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discard what the crawl prints."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
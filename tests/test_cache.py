@@ -0,0 +1,200 @@
+"""
+Tests of the on-disk cache of the layer lists: hits, revalidation, ttl, eviction, coalescing, and a cache directory
+that cannot be written.
+
+Usage:
+    python -m pytest tests
+"""
+
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_cache import ResponseCache  # noqa: E402
+
+
+class FakeRequest:
+    """Stands in for a layer request, answering with a value and validators and recording the validators sent."""
+
+    def __init__(self, value, validators=None, not_modified=False):
+        self.value = value
+        self.validators = validators or {}
+        self.not_modified = not_modified
+        self.calls = []
+
+    def __call__(self, validators):
+        self.calls.append(validators)
+        if self.not_modified and validators:
+            return None, self.validators
+        return self.value, self.validators
+
+
+def create_layers(count):
+    return [{"id": layer_id, "name": f"layer {layer_id}"} for layer_id in range(count)]
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def create_cache(self, **kwargs):
+        return ResponseCache(directory=self.directory.name, **kwargs)
+
+    def test_value_is_served_from_the_cache_within_a_run_and_across_runs(self):
+        cache = self.create_cache()
+        request = FakeRequest(value=create_layers(2))
+        self.assertEqual(create_layers(2), cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual(create_layers(2), cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual([{}], request.calls)
+        self.assertEqual((1, 1), (cache.miss_count, cache.hit_count))
+        cache.save()
+
+        # Cached without validators, the value is served without a request until it is older than the ttl
+        reloaded_cache = self.create_cache()
+        self.assertEqual(create_layers(2), reloaded_cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual(1, len(request.calls))
+        expired_cache = self.create_cache(ttl=0.0)
+        self.assertEqual(create_layers(2), expired_cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual([{}, {}], request.calls)
+
+    def test_value_with_validators_is_revalidated_by_a_conditional_request(self):
+        cache = self.create_cache()
+        validators = {"etag": '"v1"', "last_modified": None}
+        cache.fetch(key="Alpha/svc0/MapServer", request=FakeRequest(value=create_layers(3), validators=validators))
+        cache.save()
+
+        cache = self.create_cache()
+        request = FakeRequest(value=None, validators={"etag": None, "last_modified": None}, not_modified=True)
+        self.assertEqual(create_layers(3), cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual([validators], request.calls)
+        self.assertEqual(1, cache.revalidated_count)
+        # Revalidated once, the value is served without a request for the rest of the run
+        self.assertEqual(create_layers(3), cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual(1, len(request.calls))
+
+        # A changed value replaces the cached one
+        cache.reset()
+        request = FakeRequest(value=create_layers(4), validators={"etag": '"v2"', "last_modified": None},
+                              not_modified=True)
+        request.not_modified = False
+        self.assertEqual(create_layers(4), cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual(1, cache.miss_count)
+
+    def test_least_recently_used_keys_are_evicted_over_the_size_limit(self):
+        # Each value is 104 bytes of json, so two fit
+        cache = self.create_cache(max_bytes=250)
+        cache.fetch(key="Alpha/svc0/MapServer", request=FakeRequest(value=["a" * 100]))
+        cache.fetch(key="Alpha/svc1/MapServer", request=FakeRequest(value=["b" * 100]))
+        cache.fetch(key="Alpha/svc0/MapServer", request=FakeRequest(value=None))
+        cache.fetch(key="Alpha/svc2/MapServer", request=FakeRequest(value=["c" * 100]))
+        self.assertEqual(1, cache.evicted_count)
+        self.assertEqual(208, cache._total_bytes)
+
+        request = FakeRequest(value=["b" * 100])
+        self.assertEqual(["a" * 100], cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual(["b" * 100], cache.fetch(key="Alpha/svc1/MapServer", request=request))
+        self.assertEqual(1, len(request.calls))
+        self.assertEqual(sum(cache._object_sizes.values()), cache._total_bytes)
+        object_files = os.listdir(os.path.join(self.directory.name, "objects"))
+        self.assertEqual(sorted(f"{digest}.json" for digest in cache._object_sizes), sorted(object_files))
+
+    def test_key_evicted_during_its_revalidation_is_stored_again(self):
+        cache = self.create_cache()
+        validators = {"etag": '"v1"', "last_modified": None}
+        cache.fetch(key="Alpha/svc0/MapServer", request=FakeRequest(value=create_layers(2), validators=validators))
+        cache.fetch(key="Alpha/svc1/MapServer", request=FakeRequest(value=create_layers(2)))
+        cache.reset()
+
+        def request(sent_validators):
+            # Another key's store evicts svc0 meanwhile. Its object is kept, as svc1 still points at it
+            with cache._lock:
+                cache._release(entry=cache._entries.pop("Alpha/svc0/MapServer"))
+            return None, {"etag": '"v2"', "last_modified": None}
+
+        self.assertEqual(create_layers(2), cache.fetch(key="Alpha/svc0/MapServer", request=request))
+        self.assertEqual('"v2"', cache._entries["Alpha/svc0/MapServer"]["etag"])
+        self.assertEqual(1, cache.revalidated_count)
+
+    def test_services_sharing_a_value_share_its_object(self):
+        cache = self.create_cache(ttl=0.0)
+        cache.fetch(key="Alpha/svc0/MapServer", request=FakeRequest(value=create_layers(2)))
+        cache.fetch(key="Alpha/svc1/MapServer", request=FakeRequest(value=create_layers(2)))
+        cache.reset()
+        cache.fetch(key="Alpha/svc0/MapServer", request=FakeRequest(value=create_layers(5)))
+        self.assertEqual(2, len(os.listdir(os.path.join(self.directory.name, "objects"))))
+        # The object svc1 still points at is kept when svc0 moves off it
+        self.assertEqual(create_layers(2),
+                         cache._read_object(digest=cache._entries["Alpha/svc1/MapServer"]["digest"]))
+
+    def test_concurrent_lookups_of_a_key_share_one_request(self):
+        cache = self.create_cache()
+        release = threading.Event()
+        calls = []
+
+        def request(validators):
+            calls.append(validators)
+            release.wait(timeout=5)
+            return create_layers(2), {}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.fetch(key="Alpha/svc0/MapServer",
+                                                                              request=request)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        while cache.coalesced_count < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(calls))
+        self.assertEqual([create_layers(2)] * 4, results)
+
+    def test_temporary_files_of_another_process_are_left_alone(self):
+        self.create_cache()
+        temp_path = os.path.join(self.directory.name, "objects", ".0123abcd.xyz.tmp")
+        with open(temp_path, 'w') as temp_file_handler:
+            temp_file_handler.write("[]")
+        stray_path = os.path.join(self.directory.name, "objects", "0123abcd.json")
+        with open(stray_path, 'w') as stray_file_handler:
+            stray_file_handler.write("[]")
+        self.create_cache()
+        self.assertTrue(os.path.exists(temp_path))
+        self.assertFalse(os.path.exists(stray_path))
+
+    def test_values_are_served_uncached_when_the_directory_cannot_be_written(self):
+        cache = self.create_cache()
+        # A file in place of the objects directory, and a directory in place of the index, cannot be written to even
+        #   by a privileged user
+        objects_directory = os.path.join(self.directory.name, "objects")
+        shutil.rmtree(objects_directory)
+        with open(objects_directory, 'w') as objects_file_handler:
+            objects_file_handler.write("")
+        os.mkdir(cache.index_path)
+
+        request = FakeRequest(value=create_layers(2))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            for key in ("Alpha/svc0/MapServer", "Alpha/svc0/MapServer", "Alpha/svc1/MapServer"):
+                self.assertEqual(create_layers(2), cache.fetch(key=key, request=request))
+            cache.save()
+        # Each lookup is requested again, as nothing was cached, and the write failure is reported once
+        self.assertEqual(3, len(request.calls))
+        self.assertEqual(1, output.getvalue().count("Layer cache not written"))
+        self.assertIn("Layer cache index not saved", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
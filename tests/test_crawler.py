@@ -0,0 +1,210 @@
+"""
+Tests of the crawl against replay machines: sharded routing with failover past a failing machine, the layer timeout
+under a saturated rate limiter and the report of a failed layer lookup, probes of malformed services, and the asyncio
+engine against the synchronous one.
+
+Usage:
+    python -m pytest tests
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_crawler import Crawler, collect  # noqa: E402
+from replay_machines import create_config, quiet, root_url, start_machines  # noqa: E402
+
+LAYERS_PATH = "arcgis/rest/services/Alpha/Alpha_svc0/MapServer"
+REPORT_PATH = "arcgis/admin/services/Alpha/report"
+
+
+class ShardedFailoverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.healthy_machine, self.failing_machine, *self.other_machines = start_machines(test=self, count=4)
+        self.failing_machine.error_rate = 1.0
+        self.machines = [self.healthy_machine, self.failing_machine] + self.other_machines
+        self.config = create_config(machines=self.machines, sharded=True, failure_cooldown=60)
+
+    def connect(self):
+        crawler = Crawler(config=self.config)
+        self.addCleanup(crawler.close)
+        # The first machine is the one connected to, the others only answer the routed requests
+        with mock.patch.object(Crawler, "create_random_int", return_value=0), quiet():
+            crawler.connect()
+        return crawler
+
+    def test_records_are_unchanged_by_a_failing_machine(self):
+        with quiet():
+            expected_records = list(collect(config=create_config(machines=[self.healthy_machine])))
+        with mock.patch.object(Crawler, "create_random_int", return_value=0), quiet():
+            records = list(collect(config=self.config))
+        self.assertEqual(18, len(expected_records))
+        self.assertEqual(expected_records, records)
+        self.assertGreater(self.failing_machine.request_count, 0)
+
+    def test_failed_machine_is_skipped_and_cooled_down(self):
+        crawler = self.connect()
+        with quiet():
+            # The idle machines are chosen in turn: the healthy one, then the failing one, whose request fails over
+            for _ in range(2):
+                reports = crawler.get_value_from_machines(path=REPORT_PATH, search_key="reports", kind="report")
+                self.assertEqual(5, len(reports))
+            failing_request_count = self.failing_machine.request_count
+            self.assertGreater(failing_request_count, 0)
+            for _ in range(10):
+                crawler.get_value_from_machines(path=REPORT_PATH, search_key="reports", kind="report")
+        # Cooling down, the failing machine is left out of the following requests
+        self.assertEqual(failing_request_count, self.failing_machine.request_count)
+        machines = crawler.router._machines
+        self.assertEqual(1, machines[root_url(self.failing_machine)]["failures"])
+        self.assertEqual(12, sum(machine["requests"] - machine["failures"] for machine in machines.values()))
+
+    def test_request_raising_unexpectedly_is_not_left_in_flight(self):
+        crawler = self.connect()
+
+        def consume(reports):
+            for report in reports:
+                raise KeyError("serviceName")
+
+        with self.assertRaises(KeyError), quiet():
+            crawler.get_value_from_machines(path=REPORT_PATH, search_key="reports", kind="report", consume=consume)
+        self.assertEqual([0, 0, 0, 0], [machine["in_flight"] for machine in crawler.router._machines.values()])
+
+
+class LayerLookupTest(unittest.TestCase):
+
+    def test_time_queued_for_a_slot_does_not_time_out_a_layer_lookup(self):
+        # Five lookups queue for the machine's single slot, each answered well within the timeout, but the last ones
+        #   wait longer than the timeout for their turn
+        machines = start_machines(test=self, count=1, latency=0.2)
+        with quiet():
+            records = list(collect(config=create_config(machines=machines, host_concurrency=1, adaptive_limits=False,
+                                                        layer_workers=8, layer_request_timeout=0.5)))
+        layers = [record["layers"] for record in records if record["Type"] == "MapServer"]
+        self.assertEqual(9, len(layers))
+        self.assertNotIn("NA", layers)
+
+    def test_failed_layer_lookup_is_reported_once(self):
+        machines = start_machines(test=self, count=2)
+        crawler = Crawler(config=create_config(machines=machines, sharded=True))
+        self.addCleanup(crawler.close)
+        with mock.patch.object(Crawler, "create_random_int", return_value=0), quiet():
+            crawler.connect()
+        for machine in machines:
+            machine.error_rate = 1.0
+        report_object = SimpleNamespace(folder="Alpha", service_name="Alpha_svc0", layers=None,
+                                        rest_service_url_machine=f"{root_url(machines[0])}/{LAYERS_PATH}")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            crawler.fetch_layers(report_object=report_object)
+        self.assertEqual("NA", report_object.layers)
+        # Both machines were tried, and the failure is reported once, with the service it was for
+        self.assertTrue(all(machine.request_count > 1 for machine in machines))
+        lines = output.getvalue().splitlines()
+        self.assertEqual(1, len(lines))
+        self.assertTrue(lines[0].startswith("Layers unavailable for Alpha/Alpha_svc0"))
+
+
+class ProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.machine, = start_machines(test=self)
+        respond = self.machine.respond
+
+        def malformed_respond(path, params):
+            # The map services describe a full extent without its bounds
+            status, content_type, body = respond(path=path, params=params)
+            if path.strip("/").endswith("/MapServer") and status == 200:
+                body = json.dumps(dict(json.loads(body), fullExtent={"spatialReference": {"wkid": 26985}}))
+                body = body.encode("utf-8")
+            return status, content_type, body
+
+        self.machine.respond = malformed_respond
+        self.crawler = Crawler(config=create_config(machines=[self.machine], probe=True, probe_export=True))
+        self.addCleanup(self.crawler.close)
+        with quiet():
+            self.crawler.connect()
+        self.targets = [("Alpha", "Alpha_svc0", "MapServer"), ("Beta", "Beta_svc2", "MapServer")]
+
+    def test_malformed_service_info_is_recorded_as_a_probe_error(self):
+        with quiet():
+            probe_results = self.crawler.probe_all_services(targets=self.targets, workers=2)
+        for target in self.targets:
+            self.assertIsNotNone(probe_results[target]["ProbeSeconds"])
+            self.assertIn("KeyError", probe_results[target]["ProbeError"])
+        self.assertEqual([0], [machine["in_flight"] for machine in self.crawler.router._machines.values()])
+
+    def test_probe_raising_unexpectedly_is_not_left_in_flight(self):
+        with mock.patch.object(self.crawler.service_probe, "probe", side_effect=KeyboardInterrupt), \
+                self.assertRaises(KeyboardInterrupt), quiet():
+            self.crawler.probe_service(target=self.targets[0])
+        self.assertEqual([0], [machine["in_flight"] for machine in self.crawler.router._machines.values()])
+
+
+def track_concurrency(machine):
+    """
+    Count the requests a replay machine answers at one time.
+    :param machine: ReplayServer
+    :return: dictionary whose 'most' key holds the most requests answered at one time
+    """
+    counts = {"current": 0, "most": 0}
+    lock = threading.Lock()
+    respond = machine.respond
+
+    def counting_respond(path, params):
+        with lock:
+            counts["current"] += 1
+            counts["most"] = max(counts["most"], counts["current"])
+        try:
+            return respond(path=path, params=params)
+        finally:
+            with lock:
+                counts["current"] -= 1
+
+    machine.respond = counting_respond
+    return counts
+
+
+class AsyncEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.machines = start_machines(test=self, count=1, latency=0.02)
+
+    def collect(self, **settings):
+        with quiet():
+            return list(collect(config=create_config(machines=self.machines, **settings)))
+
+    def test_async_engine_collects_the_records_of_the_sync_engine(self):
+        for stream_reports in (False, True):
+            with self.subTest(stream_reports=stream_reports):
+                sync_records = self.collect(engine="sync", stream_reports=stream_reports)
+                self.assertEqual(18, len(sync_records))
+                self.assertEqual(sync_records, self.collect(engine="async", stream_reports=stream_reports))
+
+    def test_async_workers_bound_the_requests_in_flight(self):
+        counts = track_concurrency(machine=self.machines[0])
+        self.collect(engine="async", async_workers=2, host_concurrency=8, adaptive_limits=False)
+        self.assertEqual(2, counts["most"])
+
+    def test_host_concurrency_bounds_either_engine(self):
+        for engine in ("sync", "async"):
+            with self.subTest(engine=engine):
+                counts = track_concurrency(machine=self.machines[0])
+                self.collect(engine=engine, async_workers=16, folder_report_workers=8, layer_workers=8,
+                             host_concurrency=3, adaptive_limits=False)
+                self.assertEqual(3, counts["most"])
+                del self.machines[0].respond
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Tests of the refresh schedule of the folders in daemon mode, alone and in the cycles of a daemon crawling a replay
+machine.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_daemon import FolderSchedule  # noqa: E402
+from archiveDataToJSON_MOD import main  # noqa: E402
+from replay_machines import create_config, quiet, record_paths, start_machines  # noqa: E402
+
+FAILING_REPORT_PATH = "arcgis/admin/services/Beta/report"
+
+
+class FolderScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.schedule = FolderSchedule(default_interval=900.0, folder_intervals={"transportation": 300.0})
+
+    def test_refreshed_folder_is_due_after_its_interval(self):
+        self.schedule.mark_refreshed(folder="Transportation", refreshed_time=1000.0)
+        self.schedule.mark_refreshed(folder="Imagery", refreshed_time=1000.0)
+        self.assertFalse(self.schedule.is_due(folder="Transportation", now=1299.0))
+        self.assertTrue(self.schedule.is_due(folder="Transportation", now=1300.0))
+        self.assertFalse(self.schedule.is_due(folder="Imagery", now=1300.0))
+        self.assertEqual(1300.0, self.schedule.next_due(folders=["Transportation", "Imagery"], cycle_started=1000.0))
+
+    def test_failed_folder_is_retried_with_backoff(self):
+        self.schedule.mark_refreshed(folder="Imagery", refreshed_time=0.0)
+        # The folder was due at 900, so without a retry time the next cycle would be due in the past
+        self.schedule.mark_failed(folder="Imagery", failed_time=1000.0)
+        self.assertEqual(1300.0, self.schedule.next_due(folders=["Imagery"], cycle_started=1000.0))
+        self.assertFalse(self.schedule.is_due(folder="Imagery", now=1299.0))
+        self.assertTrue(self.schedule.is_due(folder="Imagery", now=1300.0))
+
+        # Every failure in a row doubles the wait, up to the folder's own interval
+        self.schedule.mark_failed(folder="Imagery", failed_time=1300.0)
+        self.assertEqual(1900.0, self.schedule.next_due(folders=["Imagery"], cycle_started=1300.0))
+        self.schedule.mark_failed(folder="Imagery", failed_time=1900.0)
+        self.assertEqual(2800.0, self.schedule.next_due(folders=["Imagery"], cycle_started=1900.0))
+
+        # A refresh ends the backoff
+        self.schedule.mark_refreshed(folder="Imagery", refreshed_time=2800.0)
+        self.schedule.mark_failed(folder="Imagery", failed_time=3700.0)
+        self.assertEqual(4000.0, self.schedule.next_due(folders=["Imagery"], cycle_started=3700.0))
+
+    def test_folder_never_refreshed_is_retried_after_a_failure(self):
+        self.assertTrue(self.schedule.is_due(folder="Imagery", now=0.0))
+        self.schedule.mark_failed(folder="Imagery", failed_time=1000.0)
+        self.assertFalse(self.schedule.is_due(folder="Imagery", now=1100.0))
+        self.assertEqual(1300.0, self.schedule.next_due(folders=["Imagery"], cycle_started=1000.0))
+
+
+class DaemonCycleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.machine, = start_machines(test=self)
+        respond = self.machine.respond
+
+        def failing_respond(path, params):
+            if path.strip("/") == FAILING_REPORT_PATH:
+                return 503, "text/html", b"<html><body>Injected error</body></html>"
+            return respond(path=path, params=params)
+
+        self.machine.respond = failing_respond
+        self.paths = record_paths(machine=self.machine)
+
+    def run_daemon(self, cycle_count):
+        """
+        Run daemon cycles on a clock that only moves forward while the daemon waits for its next cycle.
+        :param cycle_count: number of cycles to run before the daemon is interrupted
+        :return: list of the seconds after the first cycle started at which the failing folder's report was requested
+        """
+        config = create_config(machines=[self.machine], daemon=True, daemon_port=0, daemon_interval=900,
+                               retry_attempts_not_json=1, output_directory=self.directory.name)
+        # Alpha's short interval sets the pace of the cycles, and the start of the failing folder's backoff
+        config["daemon_folder_intervals"] = {"alpha": "60"}
+        config_path = os.path.join(self.directory.name, "credentials.cfg")
+        with open(config_path, 'w') as config_file_handler:
+            config.write(config_file_handler)
+
+        started = time.time()
+        clock = {"now": started, "cycles": 0}
+        failing_request_times = []
+        real_sleep = time.sleep
+
+        def sleep(seconds):
+            if seconds < 1.0:
+                # A pause between retries
+                real_sleep(seconds)
+                return
+            if FAILING_REPORT_PATH in self.paths:
+                failing_request_times.append(clock["now"] - started)
+            del self.paths[:]
+            clock["cycles"] += 1
+            if clock["cycles"] == cycle_count:
+                raise KeyboardInterrupt
+            clock["now"] += seconds
+
+        with mock.patch("time.time", side_effect=lambda: clock["now"]), mock.patch("time.sleep", side_effect=sleep):
+            with self.assertRaises(SystemExit), quiet():
+                main(credentials_path=config_path)
+        return failing_request_times
+
+    def test_folder_failing_from_the_start_is_retried_with_backoff(self):
+        # Cycles start every 60 seconds. The failing folder waits 60, 120, then 240 seconds between attempts.
+        self.assertEqual([0.0, 60.0, 180.0, 420.0], self.run_daemon(cycle_count=8))
+        with open(os.path.join(self.directory.name, "GeodataServices.json"), 'r') as result_file_handler:
+            self.assertNotIn('"Folder": "Beta"', result_file_handler.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
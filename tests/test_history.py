@@ -0,0 +1,95 @@
+"""
+Tests of the run history: change events, uptime, and a database locked by another connection.
+
+Usage:
+    python -m pytest tests
+"""
+
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_history import HistoryStore, HistoryWriter  # noqa: E402
+
+
+def create_record(service_name, status, folder="Alpha", layers=None):
+    record = {"ServiceName": service_name, "Folder": folder, "Type": "MapServer", "Status": status, "Cached": False,
+              "FeatureService": "NA", "kml": "NA", "wms": "NA", "wfs": "NA", "wcs": "NA", "wmts": "NA"}
+    if layers is not None:
+        record["layers"] = layers
+    return record
+
+
+class HistoryStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "history.sqlite")
+        self.store = HistoryStore(path=self.path, timeout=0.1)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_record_run_appends_change_events(self):
+        events = self.store.record_run(records=[create_record("svc0", "STARTED"), create_record("svc1", "STOPPED")],
+                                       started=1000.0, observed_folders=["Alpha/"])
+        self.assertEqual([("Alpha/svc0/MapServer", "added"), ("Alpha/svc1/MapServer", "added")],
+                         [(event["service_key"], event["event"]) for event in events])
+
+        events = self.store.record_run(records=[create_record("svc0", "STOPPED"), create_record("svc1", "STARTED"),
+                                                create_record("svc9", "STARTED", folder="Beta")],
+                                       started=2000.0, observed_folders=["Alpha/"])
+        self.assertEqual([("Alpha/svc0/MapServer", "stopped"), ("Alpha/svc1/MapServer", "started")],
+                         [(event["service_key"], event["event"]) for event in events])
+
+        # A service missing from an observed folder is removed, one in a folder not observed is left alone
+        events = self.store.record_run(records=[create_record("svc1", "STARTED")], started=3000.0,
+                                       observed_folders=["Alpha/"])
+        self.assertEqual([{"service_key": "Alpha/svc0/MapServer", "event": "removed", "previous_status": "STOPPED",
+                           "status": None}], events)
+        self.assertEqual([], self.store.record_run(records=[], started=4000.0, observed_folders=["Beta/"]))
+        self.assertEqual(4, self.store.run_count())
+
+    def test_uptime_is_weighted_by_time_between_events(self):
+        self.store.record_run(records=[create_record("svc0", "STARTED")], started=1000.0, observed_folders=["Alpha"])
+        self.store.record_run(records=[create_record("svc0", "STOPPED")], started=1300.0, observed_folders=["Alpha"])
+        self.store.record_run(records=[create_record("svc0", "STARTED")], started=1400.0, observed_folders=["Alpha"])
+
+        uptimes = self.store.uptime(start=1000.0, end=2000.0)
+        self.assertEqual(["Alpha/svc0/MapServer"], list(uptimes))
+        self.assertAlmostEqual(0.9, uptimes["Alpha/svc0/MapServer"]["uptime"])
+        self.assertAlmostEqual(1000.0, uptimes["Alpha/svc0/MapServer"]["observed_seconds"])
+        self.assertAlmostEqual(0.5, self.store.uptime(start=1200.0, end=1400.0)["Alpha/svc0/MapServer"]["uptime"])
+
+    def test_locked_database_leaves_the_run_unrecorded(self):
+        self.store.record_run(records=[create_record("svc0", "STARTED")], started=1000.0, observed_folders=["Alpha"])
+        locking_connection = sqlite3.connect(self.path)
+        locking_connection.execute("BEGIN EXCLUSIVE")
+        history_writer = HistoryWriter(store=self.store, started=2000.0, observed_folders=["Alpha"])
+        history_writer.write(record=create_record("svc0", "STOPPED"))
+        history_writer.write(record=create_record("svc1", "STARTED", layers=[]))
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            history_writer.close()
+        locking_connection.rollback()
+        locking_connection.close()
+        self.assertIsNone(history_writer.events)
+        self.assertIn("History not recorded", output.getvalue())
+
+        # The services added by the rolled back run are not taken to exist by the next run
+        events = self.store.record_run(records=[create_record("svc0", "STOPPED"), create_record("svc1", "STARTED")],
+                                       started=3000.0, observed_folders=["Alpha"])
+        self.assertEqual([("Alpha/svc0/MapServer", "stopped"), ("Alpha/svc1/MapServer", "added")],
+                         [(event["service_key"], event["event"]) for event in events])
+        self.assertEqual(2, self.store.run_count())
+
+
+if __name__ == "__main__":
+    unittest.main()
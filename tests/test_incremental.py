@@ -0,0 +1,116 @@
+"""
+Tests of the incremental refresh of a full run against a replay machine: which layer lists are reused from the
+previous run's state and which are requested again.
+
+Usage:
+    python -m pytest tests
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_replay import create_recording_key  # noqa: E402
+from archiveDataToJSON_MOD import main  # noqa: E402
+from replay_machines import create_config, quiet, record_paths, start_machines  # noqa: E402
+
+STARTED_MAP_SERVICES = ("Alpha/Alpha_svc0", "Alpha/Alpha_svc2", "Beta/Beta_svc2", "Beta/Beta_svc3", "Delta/Delta_svc6")
+
+
+def layers_path(service):
+    return f"arcgis/rest/services/{service}/MapServer"
+
+
+class IncrementalRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.machine, = start_machines(test=self)
+        self.paths = record_paths(machine=self.machine)
+        self.state_path = os.path.join(self.directory.name, "GeodataServices.state.json")
+
+    def run_crawl(self, **settings):
+        """
+        Run a full incremental crawl.
+        :param settings: [crawl_settings] values for the run
+        :return: tuple of (records written, set of the services whose layers were requested)
+        """
+        config = create_config(machines=[self.machine], incremental=True, output_directory=self.directory.name,
+                               **settings)
+        config_path = os.path.join(self.directory.name, "credentials.cfg")
+        with open(config_path, 'w') as config_file_handler:
+            config.write(config_file_handler)
+        del self.paths[:]
+        with quiet():
+            main(credentials_path=config_path)
+        with open(os.path.join(self.directory.name, "GeodataServices.json"), 'r') as result_file_handler:
+            records = json.load(result_file_handler)
+        requested = {service for service in STARTED_MAP_SERVICES + ("Alpha/Alpha_svc1",)
+                     if layers_path(service) in self.paths}
+        return records, requested
+
+    def find_record(self, records, service_name):
+        return next(record for record in records if record["ServiceName"] == service_name)
+
+    def test_unchanged_folders_are_reused(self):
+        records, requested = self.run_crawl()
+        self.assertEqual(set(STARTED_MAP_SERVICES), requested)
+        with open(self.state_path, 'r') as state_file_handler:
+            self.assertEqual(3, json.load(state_file_handler)["version"])
+
+        reused_records, requested = self.run_crawl()
+        self.assertEqual(set(), requested)
+        self.assertEqual(records, reused_records)
+
+    def test_state_of_an_older_version_is_ignored(self):
+        records, _ = self.run_crawl()
+        with open(self.state_path, 'r') as state_file_handler:
+            state = json.load(state_file_handler)
+        state["version"] = 2
+        with open(self.state_path, 'w') as state_file_handler:
+            json.dump(state, state_file_handler)
+
+        rebuilt_records, requested = self.run_crawl()
+        self.assertEqual(set(STARTED_MAP_SERVICES), requested)
+        self.assertEqual(records, rebuilt_records)
+
+    def test_service_started_since_the_previous_run_is_requested_again(self):
+        self.run_crawl()
+        report_key = create_recording_key(path="arcgis/admin/services/Alpha/report", params=[("f", "json")])
+        recording = self.machine.catalog.recordings[report_key]
+        report = json.loads(recording["body"])
+        service = next(service for service in report["reports"] if service["serviceName"] == "Alpha_svc1")
+        service["status"]["realTimeState"] = "STARTED"
+        recording["body"] = json.dumps(report)
+
+        records, requested = self.run_crawl()
+        self.assertEqual({"Alpha/Alpha_svc1"}, requested)
+        self.assertEqual("STARTED", self.find_record(records, "Alpha_svc1")["Status"])
+
+    def test_unavailable_layers_are_requested_again(self):
+        layers_key = create_recording_key(path=layers_path("Beta/Beta_svc3"), params=[("f", "json")])
+        layers_recording = self.machine.catalog.recordings.pop(layers_key)
+        records, _ = self.run_crawl()
+        self.assertEqual("NA", self.find_record(records, "Beta_svc3")["layers"])
+
+        self.machine.catalog.recordings[layers_key] = layers_recording
+        records, requested = self.run_crawl()
+        self.assertEqual({"Beta/Beta_svc3"}, requested)
+        self.assertNotEqual("NA", self.find_record(records, "Beta_svc3")["layers"])
+
+    def test_layers_older_than_the_max_age_are_requested_again(self):
+        self.run_crawl()
+        _, requested = self.run_crawl(incremental_max_age_hours=24)
+        self.assertEqual(set(), requested)
+        _, requested = self.run_crawl(incremental_max_age_hours=0)
+        self.assertEqual(set(STARTED_MAP_SERVICES), requested)
+
+
+if __name__ == "__main__":
+    unittest.main()
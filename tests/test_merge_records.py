@@ -0,0 +1,100 @@
+"""
+Tests of the selection of a partial crawl and its merging into the output of an earlier run.
+
+Usage:
+    python -m pytest tests
+"""
+
+import contextlib
+import io
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_crawler import ServiceFilter, merge_records  # noqa: E402
+from archiveDataToJSON_MOD import main  # noqa: E402
+
+
+def create_record(service_name, status, layers="NA", folder="Alpha", service_type="MapServer"):
+    return {"ServiceName": service_name, "Folder": folder, "Type": service_type, "Status": status, "Layers": layers}
+
+
+def create_report_object(service_name, status, folder="Alpha", service_type="MapServer"):
+    return SimpleNamespace(service_name=service_name, folder=folder, type=service_type, real_time_status=status)
+
+
+class MergeRecordsTest(unittest.TestCase):
+
+    def test_status_filter_refreshes_service_whose_status_changed(self):
+        existing_records = [create_record(service_name="Alpha_svc0", status="STARTED", layers=["roads"]),
+                            create_record(service_name="Alpha_svc1", status="STARTED", layers=["rivers"]),
+                            create_record(service_name="Alpha_svc2", status="STOPPED")]
+        service_filter = ServiceFilter(folders=["Alpha"], statuses=["STARTED"])
+        service_filter.use_existing_records(records=existing_records)
+
+        # Alpha_svc1 was stopped since the earlier run, and is still selected by its recorded status
+        self.assertTrue(service_filter.matches(report_object=create_report_object("Alpha_svc1", "STOPPED")))
+        self.assertFalse(service_filter.matches(report_object=create_report_object("Alpha_svc2", "STOPPED")))
+        # A service the earlier run did not record is selected by its current status
+        self.assertTrue(service_filter.matches(report_object=create_report_object("Alpha_svc3", "STARTED")))
+        self.assertFalse(service_filter.matches(report_object=create_report_object("Alpha_svc4", "STOPPED")))
+
+        new_records = [create_record(service_name="Alpha_svc0", status="STARTED", layers=["roads"]),
+                       create_record(service_name="Alpha_svc1", status="STOPPED")]
+        merged_records, replaced_count, added_count, removed_count = merge_records(
+            existing_records=existing_records,
+            new_records=new_records,
+            service_filter=service_filter,
+            reported_keys={"Alpha": {"Alpha_svc0.MapServer", "Alpha_svc1.MapServer", "Alpha_svc2.MapServer"}})
+
+        self.assertEqual([create_record(service_name="Alpha_svc0", status="STARTED", layers=["roads"]),
+                          create_record(service_name="Alpha_svc1", status="STOPPED"),
+                          create_record(service_name="Alpha_svc2", status="STOPPED")], merged_records)
+        self.assertEqual((2, 0, 0), (replaced_count, added_count, removed_count))
+
+    def test_selected_service_missing_from_report_is_removed(self):
+        existing_records = [create_record(service_name="Alpha_svc0", status="STARTED"),
+                            create_record(service_name="Alpha_svc1", status="STOPPED"),
+                            create_record(service_name="Beta_svc0", status="STARTED", folder="Beta")]
+        service_filter = ServiceFilter(folders=["Alpha"], statuses=["STARTED"])
+        service_filter.use_existing_records(records=existing_records)
+
+        merged_records, replaced_count, added_count, removed_count = merge_records(
+            existing_records=existing_records,
+            new_records=[],
+            service_filter=service_filter,
+            reported_keys={"Alpha": set()})
+
+        # The stopped service was not selected, and the folder not crawled is left as it was
+        self.assertEqual([create_record(service_name="Alpha_svc1", status="STOPPED"),
+                          create_record(service_name="Beta_svc0", status="STARTED", folder="Beta")], merged_records)
+        self.assertEqual((0, 0, 1), (replaced_count, added_count, removed_count))
+
+
+class ServiceFilterTest(unittest.TestCase):
+
+    def test_every_criterion_is_matched_without_regard_to_case(self):
+        service_filter = ServiceFilter(folders=["alpha"], service_patterns=["ALPHA_svc*"], types=["mapserver"],
+                                       statuses=["started"])
+        self.assertEqual(["Alpha"], service_filter.select_folders(folders=["Alpha", "Beta"]))
+        self.assertTrue(service_filter.matches(report_object=create_report_object("Alpha_svc0", "STARTED")))
+        self.assertFalse(service_filter.matches(report_object=create_report_object("Alpha_svc0", "STARTED",
+                                                                                   service_type="GPServer")))
+
+    def test_unknown_type_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ServiceFilter(types=["TileServer"])
+
+    def test_one_folder_cannot_be_combined_with_folder(self):
+        with self.assertRaises(SystemExit) as context, contextlib.redirect_stderr(io.StringIO()) as error_output:
+            main(argv=["--one-folder", "Alpha", "--folder", "Beta"])
+        self.assertEqual(2, context.exception.code)
+        self.assertIn("--folder cannot be combined with --one-folder", error_output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+"""
+Tests of the output writers and the atomic publication of the output files.
+
+Usage:
+    python -m pytest tests
+"""
+
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_output import JSONArrayWriter, NDJSONWriter, atomic_output_file  # noqa: E402
+
+
+class WritersTest(unittest.TestCase):
+
+    def test_json_array_is_valid_for_any_number_of_records(self):
+        for record_count in (0, 1, 3):
+            for indent in (None, 4):
+                with self.subTest(record_count=record_count, indent=indent):
+                    buffer = io.StringIO()
+                    writer = JSONArrayWriter(file_handler=buffer, indent=indent)
+                    for record_number in range(record_count):
+                        writer.write(record={"ServiceName": f"svc{record_number}"})
+                    writer.close()
+                    self.assertEqual([{"ServiceName": f"svc{record_number}"} for record_number in range(record_count)],
+                                     json.loads(buffer.getvalue()))
+
+    def test_ndjson_writes_one_record_per_line(self):
+        buffer = io.StringIO()
+        writer = NDJSONWriter(file_handler=buffer)
+        writer.write(record={"ServiceName": "svc0"})
+        writer.write(record={"ServiceName": "svc1"})
+        writer.close()
+        self.assertEqual('{"ServiceName":"svc0"}\n{"ServiceName":"svc1"}\n', buffer.getvalue())
+
+
+class AtomicOutputFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "GeodataServices.json")
+        with open(self.path, 'w') as published_file_handler:
+            published_file_handler.write("[]")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_completed_block_replaces_the_file_and_its_gzip_copy(self):
+        with atomic_output_file(path=self.path, gzip_copy=True) as output_file_handler:
+            output_file_handler.write('[{"ServiceName": "svc0"}]')
+            # The published file is untouched until the block completes
+            with open(self.path, 'r') as published_file_handler:
+                self.assertEqual("[]", published_file_handler.read())
+        with open(self.path, 'r') as published_file_handler:
+            self.assertEqual('[{"ServiceName": "svc0"}]', published_file_handler.read())
+        with gzip.open(f"{self.path}.gz", 'rt') as gzip_file_handler:
+            self.assertEqual('[{"ServiceName": "svc0"}]', gzip_file_handler.read())
+        self.assertEqual(["GeodataServices.json", "GeodataServices.json.gz"], sorted(os.listdir(self.directory.name)))
+
+    def test_exception_in_the_block_leaves_the_published_file_and_no_temporary_file(self):
+        with self.assertRaises(RuntimeError):
+            with atomic_output_file(path=self.path, gzip_copy=True) as output_file_handler:
+                output_file_handler.write('[{"ServiceName": ')
+                raise RuntimeError("crawl failed partway through")
+        with open(self.path, 'r') as published_file_handler:
+            self.assertEqual("[]", published_file_handler.read())
+        self.assertEqual(["GeodataServices.json"], os.listdir(self.directory.name))
+
+    def test_exit_in_the_block_leaves_no_temporary_file(self):
+        with self.assertRaises(SystemExit):
+            with atomic_output_file(path=self.path) as output_file_handler:
+                output_file_handler.write("[")
+                sys.exit(1)
+        self.assertEqual(["GeodataServices.json"], os.listdir(self.directory.name))
+
+
+if __name__ == "__main__":
+    unittest.main()
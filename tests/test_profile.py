@@ -0,0 +1,85 @@
+"""
+Tests of the bytes on the wire credited to the profiled requests, for compressed, streamed, and chunked responses.
+
+Usage:
+    python -m pytest tests
+"""
+
+import gzip
+import os
+import sys
+import threading
+import unittest
+from http.server import ThreadingHTTPServer
+
+import requests
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_http import KeepAliveRequestHandler  # noqa: E402
+from ags_profile import RequestProfiler  # noqa: E402
+
+BODY = b'{"reports": [' + b", ".join(b'{"serviceName": "svc%d"}' % number for number in range(2000)) + b"]}"
+COMPRESSED_BODY = gzip.compress(BODY)
+
+
+class GzipRequestHandler(KeepAliveRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Encoding", "gzip")
+        if self.path == "/chunked":
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for start in range(0, len(COMPRESSED_BODY), 1000):
+                chunk = COMPRESSED_BODY[start:start + 1000]
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\n\r\n")
+        else:
+            self.send_header("Content-Length", str(len(COMPRESSED_BODY)))
+            self.end_headers()
+            self.wfile.write(COMPRESSED_BODY)
+
+
+class RequestProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), GzipRequestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        self.profiler = RequestProfiler()
+        self.session = requests.Session()
+        self.session.hooks["response"].append(self.profiler.response_hook)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_compressed_response_counts_its_size_on_the_wire(self):
+        with self.profiler.measure(kind="report", machine=self.url) as sample:
+            response = self.session.get(f"{self.url}/report")
+        self.assertEqual(BODY, response.content)
+        self.assertEqual(len(COMPRESSED_BODY), sample["wire_bytes"])
+        self.assertLess(sample["wire_bytes"], len(BODY))
+
+    def test_streamed_response_counts_what_was_read(self):
+        with self.profiler.measure(kind="report", machine=self.url) as sample:
+            with self.session.get(f"{self.url}/report", stream=True) as response:
+                self.assertEqual(BODY, b"".join(response.iter_content(chunk_size=1024)))
+        self.assertEqual(len(COMPRESSED_BODY), sample["wire_bytes"])
+
+    def test_chunked_response_is_unmeasured(self):
+        with self.profiler.measure(kind="report", machine=self.url) as sample:
+            response = self.session.get(f"{self.url}/chunked")
+        self.assertEqual(BODY, response.content)
+        self.assertEqual((0, 1), (sample["wire_bytes"], sample["unmeasured"]))
+        summary = self.profiler.create_summary()
+        self.assertEqual(1, summary["kinds"]["report"]["unmeasured"])
+
+
+if __name__ == "__main__":
+    unittest.main()
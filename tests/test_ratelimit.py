@@ -0,0 +1,140 @@
+"""
+Tests of the adaptive limits on the requests sent to each machine.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_ratelimit import MachineLimiter, RateLimiter  # noqa: E402
+
+
+class MachineLimiterTest(unittest.TestCase):
+
+    def test_slow_start_grows_the_concurrency_limit_by_one_per_response(self):
+        limiter = MachineLimiter(max_concurrency=8, max_rate=50.0)
+        self.assertEqual(1.0, limiter.concurrency_limit)
+        for response_count in range(1, 4):
+            limiter.observe(kind="report", path="a/report", seconds=0.05)
+            self.assertEqual(1.0 + response_count, limiter.concurrency_limit)
+        for _ in range(10):
+            limiter.observe(kind="report", path="a/report", seconds=0.05)
+        self.assertEqual(8.0, limiter.concurrency_limit)
+
+    def test_congestion_multiplies_the_limits_by_the_backoff(self):
+        limiter = MachineLimiter(max_concurrency=8, max_rate=40.0, min_rate=15.0, backoff=0.5)
+        for _ in range(7):
+            limiter.observe(kind="report", path="a/report", seconds=0.05)
+        limiter.observe(kind="report", congested=True)
+        self.assertEqual((4.0, 20.0), (limiter.concurrency_limit, limiter.rate))
+        # The rate is not backed off below its floor, nor the concurrency limit below one
+        for _ in range(5):
+            limiter.observe(kind="report", congested=True)
+        self.assertEqual((1.0, 15.0), (limiter.concurrency_limit, limiter.rate))
+        self.assertEqual(6, limiter.backoff_count)
+        self.assertEqual(6, limiter.error_count)
+
+    def test_rate_is_never_backed_off_to_zero(self):
+        limiter = MachineLimiter(max_concurrency=1, max_rate=40.0, min_rate=0.0, backoff=0.0)
+        limiter.observe(kind="report", congested=True)
+        self.assertEqual(MachineLimiter.RATE_FLOOR, limiter.rate)
+        # The bucket is empty, and the wait for the next token is finite rather than a division by zero
+        limiter._tokens = 0.0
+        acquired = threading.Thread(target=limiter.acquire, daemon=True)
+        acquired.start()
+        time.sleep(0.05)
+        limiter._tokens = 1.0
+        with limiter._condition:
+            limiter._condition.notify_all()
+        acquired.join(timeout=5)
+        self.assertFalse(acquired.is_alive())
+
+    def test_after_congestion_the_concurrency_limit_grows_by_one_per_round(self):
+        limiter = MachineLimiter(max_concurrency=8)
+        for _ in range(7):
+            limiter.observe(kind="report", path="a/report", seconds=0.05)
+        limiter.observe(kind="report", congested=True)
+        self.assertFalse(limiter.slow_start)
+        for _ in range(4):
+            limiter.observe(kind="report", path="a/report", seconds=0.05)
+        self.assertAlmostEqual(5.0, limiter.concurrency_limit, delta=0.1)
+
+    def test_limits_are_cut_once_per_response_time(self):
+        limiter = MachineLimiter(max_concurrency=8)
+        for _ in range(7):
+            limiter.observe(kind="report", path="a/report", seconds=0.05)
+        # Requests already in flight when the limits were cut do not cut them again
+        limiter.observe(kind="report", path="a/report", seconds=30.0, congested=True)
+        limiter.observe(kind="report", path="b/report", seconds=30.0, congested=True)
+        self.assertEqual(4.0, limiter.concurrency_limit)
+        self.assertEqual(1, limiter.backoff_count)
+
+    def test_response_much_slower_than_its_url_usually_is_congestion(self):
+        limiter = MachineLimiter(max_concurrency=8, latency_tolerance=4.0)
+        for _ in range(7):
+            limiter.observe(kind="report", path="a/report", seconds=0.1)
+        limiter.observe(kind="report", path="a/report", seconds=0.35)
+        self.assertEqual(0, limiter.slow_count)
+        limiter.observe(kind="report", path="a/report", seconds=0.5)
+        self.assertEqual(1, limiter.slow_count)
+        self.assertEqual(1, limiter.backoff_count)
+
+    def test_report_slower_than_other_urls_is_not_congestion_on_its_first_request(self):
+        limiter = MachineLimiter(max_concurrency=8, latency_tolerance=4.0)
+        for folder_number in range(10):
+            limiter.observe(kind="report", path=f"folder{folder_number}/report", seconds=0.1 + folder_number * 0.05)
+        limiter.observe(kind="report", path="large/report", seconds=0.5)
+        self.assertEqual(0, limiter.slow_count)
+
+    def test_fixed_limits_stay_at_the_ceilings(self):
+        limiter = MachineLimiter(max_concurrency=4, max_rate=10.0, adaptive=False)
+        limiter.observe(kind="report", congested=True)
+        self.assertEqual((4.0, 10.0), (limiter.concurrency_limit, limiter.rate))
+        self.assertEqual(1, limiter.error_count)
+
+    def test_acquire_waits_for_a_slot_under_the_concurrency_limit(self):
+        limiter = MachineLimiter(max_concurrency=1, max_rate=1000.0)
+        limiter.acquire()
+        acquired = threading.Event()
+        waiter = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+        waiter.start()
+        self.assertFalse(acquired.wait(timeout=0.1))
+        limiter.release()
+        self.assertTrue(acquired.wait(timeout=5))
+        waiter.join()
+        limiter.release()
+        self.assertEqual((0, 2, 1), (limiter.in_flight, limiter.requests, limiter.waited_count))
+
+    def test_token_bucket_spaces_the_requests_at_the_rate(self):
+        limiter = MachineLimiter(max_concurrency=1, max_rate=20.0, adaptive=False)
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release()
+        # The first request takes the bucket's token, the next two wait 1/20 s each
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_unanswered_request_backs_off_its_machine_only(self):
+        rate_limiter = RateLimiter(max_concurrency=8, adaptive=False)
+        with rate_limiter.slot(root_url="https://m1", kind="layers") as outcome:
+            outcome["unanswered"] = True
+        with rate_limiter.slot(root_url="https://m2", kind="layers"):
+            pass
+        self.assertEqual(1, rate_limiter.machine(root_url="https://m1").error_count)
+        self.assertEqual(0, rate_limiter.machine(root_url="https://m2").error_count)
+        self.assertEqual(0, rate_limiter.machine(root_url="https://m1").in_flight)
+
+
+if __name__ == "__main__":
+    unittest.main()
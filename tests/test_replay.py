@@ -0,0 +1,72 @@
+"""
+Tests of recording responses and replaying them, for responses read whole and streamed.
+
+Usage:
+    python -m pytest tests
+"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import requests
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_replay import ReplayCatalog, ReplayServer, ResponseRecorder, create_recording_key  # noqa: E402
+
+REPORT_PATH = "arcgis/admin/services/Alpha/report"
+REPORT_BODY = json.dumps({"reports": [{"serviceName": f"svc{number}", "type": "MapServer"} for number in range(50)]})
+
+
+class ResponseRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        recording = {"path": REPORT_PATH, "params": [("f", "json")], "status": 200,
+                     "content_type": "application/json", "body": REPORT_BODY}
+        catalog = ReplayCatalog(recordings={create_recording_key(path=REPORT_PATH, params=[("f", "json")]): recording})
+        self.server = ReplayServer(catalog=catalog)
+        self.server.start()
+        self.recorder = ResponseRecorder(directory=os.path.join(self.directory.name, "recordings"))
+        self.session = requests.Session()
+        self.session.hooks["response"].append(self.recorder.response_hook)
+        self.url = f"http://127.0.0.1:{self.server.port}/{REPORT_PATH}"
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+        self.directory.cleanup()
+
+    def test_response_read_whole_is_recorded(self):
+        self.session.post(self.url, data={"f": "json", "token": "secret"})
+        self.assertEqual(1, self.recorder.recorded_count)
+        recording = ReplayCatalog.load(directory=self.recorder.directory).lookup(path=REPORT_PATH,
+                                                                                 params=[("f", "json")])
+        self.assertEqual(REPORT_BODY, recording["body"])
+        self.assertNotIn("secret", json.dumps(recording))
+
+    def test_streamed_response_is_recorded_once_read(self):
+        with self.session.post(self.url, data={"f": "json"}, stream=True) as response:
+            # The hook leaves the body to be read by the caller
+            self.assertFalse(response._content_consumed)
+            self.assertEqual(0, self.recorder.recorded_count)
+            body = b"".join(response.iter_content(chunk_size=64))
+        self.assertEqual(REPORT_BODY.encode("utf-8"), body)
+        self.assertEqual(1, self.recorder.recorded_count)
+        recording = ReplayCatalog.load(directory=self.recorder.directory).lookup(path=REPORT_PATH,
+                                                                                 params=[("f", "json")])
+        self.assertEqual(REPORT_BODY, recording["body"])
+
+    def test_streamed_response_abandoned_partway_is_not_recorded(self):
+        with self.session.post(self.url, data={"f": "json"}, stream=True) as response:
+            next(response.iter_content(chunk_size=64))
+        self.assertEqual(0, self.recorder.recorded_count)
+        self.assertEqual([], os.listdir(self.recorder.directory))
+
+
+if __name__ == "__main__":
+    unittest.main()
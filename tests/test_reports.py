@@ -0,0 +1,50 @@
+"""
+Tests of the report objects built from a folder's service reports.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import random
+import sys
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_reports import create_report_object, create_report_objects  # noqa: E402
+from ags_synthetic import create_report  # noqa: E402
+
+
+class CreateReportObjectsTest(unittest.TestCase):
+
+    def test_report_objects_match_those_built_one_at_a_time(self):
+        rng = random.Random(7)
+        reports = [create_report(rng=rng, folder="Alpha", index=index) for index in range(40)]
+        pairs = list(create_report_objects(reports=reports, folder="Alpha", machine_name="synthetic", port="6443"))
+        self.assertEqual(reports, [report for report, _ in pairs])
+        for report, report_object in pairs:
+            expected = create_report_object(report=report, folder="Alpha", machine_name="synthetic", port="6443")
+            if expected is None:
+                self.assertIsNone(report_object)
+            else:
+                self.assertEqual(expected.create_record(), report_object.create_record())
+
+    def test_reports_are_read_as_the_pairs_are_consumed(self):
+        rng = random.Random(7)
+        read = []
+
+        def reports():
+            for index in range(3):
+                read.append(index)
+                yield create_report(rng=rng, folder="Alpha", index=index)
+
+        pairs = create_report_objects(reports=reports(), folder="Alpha", machine_name="synthetic", port="6443")
+        self.assertEqual([], read)
+        next(pairs)
+        self.assertEqual([0], read)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+"""
+Tests of the bounded retry of requests to the machines.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import time
+import unittest
+from types import SimpleNamespace
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_retry import (MISSING_KEY, NETWORK, NOT_JSON, TOKEN_REJECTED, RequestFailedException,  # noqa: E402
+                       RetryPolicy, fetch_json_value)
+
+
+class FakeClient:
+    """Stands in for AGSClient, answering each post with the next of a list of responses or exceptions."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.timeouts = []
+        self.tokens = []
+
+    def post(self, url, data=None, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        self.tokens.append(data.get("token"))
+        answer = self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def create_response(response_json, content_type="application/json"):
+    return SimpleNamespace(headers={"Content-Type": content_type}, text=str(response_json),
+                           json=lambda: response_json)
+
+
+class FakeTokenManager:
+    """Stands in for TokenManager, replacing each rejected token with a numbered one."""
+
+    def __init__(self):
+        self.refreshed = []
+
+    def refresh(self, root_url, rejected_token=None):
+        self.refreshed.append((root_url, rejected_token))
+        return f"token{len(self.refreshed)}"
+
+
+def create_retry_policy():
+    return RetryPolicy(attempts={NETWORK: 3, NOT_JSON: 2, TOKEN_REJECTED: 3, MISSING_KEY: 1}, base_delay=0.0)
+
+
+def fetch(client, token_manager=None):
+    return fetch_json_value(client=client, url="https://machine:6443/arcgis/admin/services", search_key="folders",
+                            params={"token": "token0", "f": "json"}, retry_policy=create_retry_policy(),
+                            token_manager=token_manager)
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_attempts_are_limited_per_class_of_failure(self):
+        retry_policy = create_retry_policy()
+        self.assertTrue(retry_policy.should_retry(error_class=NETWORK, attempt=2))
+        self.assertFalse(retry_policy.should_retry(error_class=NETWORK, attempt=3))
+        self.assertFalse(retry_policy.should_retry(error_class=MISSING_KEY, attempt=1))
+        self.assertFalse(retry_policy.should_retry(error_class="unknown", attempt=1))
+
+    def test_delay_doubles_up_to_the_limit_with_jitter(self):
+        retry_policy = RetryPolicy(base_delay=0.5, max_delay=3.0, jitter=0.5)
+        for attempt, delay in ((1, 0.5), (2, 1.0), (3, 2.0), (4, 3.0), (10, 3.0)):
+            with self.subTest(attempt=attempt):
+                self.assertTrue(delay * 0.5 <= retry_policy.delay(attempt=attempt) <= delay)
+        self.assertEqual(1.0, RetryPolicy(base_delay=0.5, jitter=0.0).delay(attempt=2))
+
+    def test_network_failure_is_retried_until_answered(self):
+        client = FakeClient(answers=[ConnectionError("reset"), ConnectionError("reset"),
+                                     create_response({"folders": ["Alpha"]})])
+        self.assertEqual(["Alpha"], fetch(client=client))
+        self.assertEqual(3, len(client.timeouts))
+
+    def test_each_class_of_failure_ends_after_its_attempts(self):
+        cases = ((ConnectionError("refused"), NETWORK, 3),
+                 (create_response("<html></html>", content_type="text/html"), NOT_JSON, 2),
+                 (create_response({"status": "error", "messages": ["Client Mismatch"], "code": 498}),
+                  TOKEN_REJECTED, 3),
+                 (create_response({"status": "error", "messages": ["Folder not found"]}), MISSING_KEY, 1))
+        for answer, error_class, attempts in cases:
+            with self.subTest(error_class=error_class):
+                client = FakeClient(answers=[answer])
+                with self.assertRaises(RequestFailedException) as context:
+                    fetch(client=client)
+                self.assertEqual((error_class, attempts), (context.exception.error_class, context.exception.attempts))
+                self.assertEqual(attempts, len(client.timeouts))
+
+    def test_body_that_is_not_json_is_classified_not_json(self):
+        def raise_value_error():
+            raise ValueError("Expecting value")
+        response = SimpleNamespace(headers={"Content-Type": "text/plain"}, text="", json=raise_value_error)
+        with self.assertRaises(RequestFailedException) as context:
+            fetch(client=FakeClient(answers=[response]))
+        self.assertEqual(NOT_JSON, context.exception.error_class)
+
+    def test_rejected_token_is_refreshed_before_the_next_attempt(self):
+        rejection = create_response({"status": "error", "messages": ["Invalid token."], "code": 498})
+        client = FakeClient(answers=[rejection, rejection, create_response({"folders": []})])
+        token_manager = FakeTokenManager()
+        self.assertEqual([], fetch(client=client, token_manager=token_manager))
+        self.assertEqual(["token0", "token1", "token2"], client.tokens)
+        self.assertEqual([("https://machine:6443", "token0"), ("https://machine:6443", "token1")],
+                         token_manager.refreshed)
+
+
+class FetchDeadlineTest(unittest.TestCase):
+
+    def test_deadline_bounds_the_attempts_of_a_hung_request(self):
+        client = FakeClient(answers=[TimeoutError("read timed out")])
+        retry_policy = RetryPolicy(attempts={NETWORK: 10}, base_delay=0.05, max_delay=0.05, jitter=0.0)
+        start = time.monotonic()
+        with self.assertRaises(RequestFailedException) as context:
+            fetch_json_value(client=client, url="https://machine/arcgis/rest/services/Alpha/svc0/MapServer",
+                             params={"f": "json"}, search_key="layers", retry_policy=retry_policy, timeout=30.0,
+                             deadline=start + 0.2)
+        self.assertLess(time.monotonic() - start, 0.2)
+        self.assertLess(context.exception.attempts, 10)
+        self.assertEqual(NETWORK, context.exception.error_class)
+        # No attempt waits on the server past the deadline
+        self.assertTrue(all(timeout <= 0.2 for timeout in client.timeouts))
+
+
+if __name__ == "__main__":
+    unittest.main()
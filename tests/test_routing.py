@@ -0,0 +1,43 @@
+"""
+Tests of the routing of requests across the machines.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_routing import MachineRouter  # noqa: E402
+
+
+class MachineRouterTest(unittest.TestCase):
+
+    def test_chosen_machine_counts_as_loaded_before_its_request_starts(self):
+        router = MachineRouter(root_urls=["https://m1", "https://m2"])
+        # Neither request has started, as both wait on a rate limiter, yet they go to different machines
+        first = router.choose()
+        second = router.choose()
+        self.assertNotEqual(first, second)
+        third = router.choose()
+        router.cancel(root_url=third)
+        router.end(root_url=first, seconds=0.1, succeeded=True)
+        self.assertEqual(first, router.choose())
+
+    def test_failed_machine_is_avoided_while_another_is_left(self):
+        router = MachineRouter(root_urls=["https://m1", "https://m2"], failure_cooldown=60.0)
+        first = router.choose()
+        router.end(root_url=first, seconds=0.1, succeeded=False)
+        second = router.choose()
+        self.assertNotEqual(first, second)
+        router.end(root_url=second, seconds=0.1, succeeded=True)
+        self.assertEqual(second, router.choose())
+        self.assertEqual(first, router.choose(exclude={second}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+"""
+Tests of the streaming parse of the array under a key of a json document, at every chunk boundary.
+
+Usage:
+    python -m pytest tests
+"""
+
+import json
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_stream import JSONArrayStream  # noqa: E402
+
+DOCUMENT = ('{"status": "ok", "nested": {"a": [1, 2.5e-3]}, "reports": [{"serviceName": "Roads \\"East\\"", '
+            '"size": 12345.678e10, "flags": [true, false, null]}, -42, "caf\\u00e9 é", [], {}, 4.5, 100], '
+            '"count": 7, "done": true}')
+
+
+def split(text, *boundaries):
+    """
+    Cut a text into chunks at the given positions.
+    :param text: string
+    :param boundaries: increasing positions
+    :return: list of strings
+    """
+    positions = [0] + list(boundaries) + [len(text)]
+    return [text[start:end] for start, end in zip(positions, positions[1:])]
+
+
+def parse(chunks, key="reports"):
+    """
+    Stream a document's array, as fetch_json_items does.
+    :param chunks: list of text chunks
+    :param key: top level key of the array
+    :return: tuple of (list of the elements, or None when there is no such array, the other members)
+    """
+    stream = JSONArrayStream(chunks=chunks, key=key)
+    if not stream.find_key():
+        return None, stream.others
+    items = list(stream.items())
+    stream.finish()
+    return items, stream.others
+
+
+class JSONArrayStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        document = json.loads(DOCUMENT)
+        self.expected_items = document.pop("reports")
+        self.expected_others = document
+
+    def test_every_single_chunk_boundary(self):
+        for boundary in range(1, len(DOCUMENT)):
+            with self.subTest(boundary=boundary):
+                self.assertEqual((self.expected_items, self.expected_others), parse(split(DOCUMENT, boundary)))
+
+    def test_every_pair_of_chunk_boundaries(self):
+        for first in range(1, len(DOCUMENT), 3):
+            for second in range(first + 1, len(DOCUMENT), 5):
+                with self.subTest(first=first, second=second):
+                    self.assertEqual((self.expected_items, self.expected_others),
+                                     parse(split(DOCUMENT, first, second)))
+
+    def test_one_character_chunks(self):
+        self.assertEqual((self.expected_items, self.expected_others), parse(list(DOCUMENT)))
+
+    def test_number_split_after_its_exponent_marker(self):
+        document = '{"reports": [4.5e10, 12]}'
+        for boundary in range(len('{"reports": [4'), len('{"reports": [4.5e1') + 1):
+            with self.subTest(boundary=boundary):
+                self.assertEqual(([4.5e10, 12], {}), parse(split(document, boundary)))
+
+    def test_document_without_the_key_keeps_its_members(self):
+        error = {"status": "error", "messages": ["Client Mismatch"], "code": 498}
+        document = json.dumps(error)
+        for boundary in range(1, len(document)):
+            with self.subTest(boundary=boundary):
+                self.assertEqual((None, error), parse(split(document, boundary)))
+        self.assertEqual((None, {}), parse(["{}"]))
+        # A key whose value is not an array is kept with the other members
+        self.assertEqual((None, {"reports": 3, "count": 1}), parse(['{"reports": 3, "count": 1}']))
+
+    def test_empty_array(self):
+        self.assertEqual(([], {"count": 0}), parse(split('{"reports": [ ], "count": 0}', 13)))
+
+    def test_response_chunks_split_inside_a_character(self):
+        body = DOCUMENT.encode("utf-8")
+        boundary = body.index("é".encode("utf-8")) + 1
+        response = SimpleNamespace(encoding="utf-8",
+                                   iter_content=lambda chunk_size: iter([body[:boundary], body[boundary:]]))
+        stream = JSONArrayStream.from_response(response=response, key="reports")
+        self.assertTrue(stream.find_key())
+        self.assertEqual(self.expected_items, list(stream.items()))
+
+    def test_truncated_document_raises_and_records_the_error(self):
+        for end in (len(DOCUMENT) - 1, DOCUMENT.index("-42"), DOCUMENT.index('"count"')):
+            with self.subTest(end=end):
+                stream = JSONArrayStream(chunks=split(DOCUMENT[:end], end // 2), key="reports")
+                with self.assertRaises(ValueError) as context:
+                    stream.find_key()
+                    list(stream.items())
+                    stream.finish()
+                self.assertIs(stream.error, context.exception)
+
+
+if __name__ == "__main__":
+    unittest.main()
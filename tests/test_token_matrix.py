@@ -0,0 +1,122 @@
+"""
+Tests of the token matrix of MachineTests_TokenMismatchIssue against replay machines, one of which rejects the tokens
+generated by the others.
+
+Usage:
+    python -m pytest tests
+"""
+
+import csv
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_replay import GENERATE_TOKEN_PATH  # noqa: E402
+from MachineTests_TokenMismatchIssue import main  # noqa: E402
+from replay_machines import create_config, quiet, start_machines  # noqa: E402
+
+# The replay folders with a recorded report. The root folder's report is not recorded, so its cells are errors
+REPORTED_FOLDER_COUNT = 5
+REPETITIONS = 2
+
+
+def reject_foreign_tokens(machine):
+    """
+    Make a replay machine issue tokens of its own, and answer a token generated by another machine with a
+    Client Mismatch rejection, as the machine under investigation would.
+    :param machine: ReplayServer
+    :return: None
+    """
+    respond = machine.respond
+    prefix = f"{machine.port}-"
+
+    def rejecting_respond(path, params):
+        status, content_type, body = respond(path=path, params=params)
+        if path.strip("/") == GENERATE_TOKEN_PATH:
+            token = json.loads(body)
+            token["token"] = prefix + token["token"]
+            return status, content_type, json.dumps(token).encode("utf-8")
+        if status == 200 and not dict(params).get("token", "").startswith(prefix):
+            rejection = {"status": "error", "messages": ["Client Mismatch"], "code": 498}
+            return 200, "application/json", json.dumps(rejection).encode("utf-8")
+        return status, content_type, body
+
+    machine.respond = rejecting_respond
+
+
+class TokenMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.machines = start_machines(test=self, count=4)
+        self.rejecting_machine = self.machines[-1]
+        reject_foreign_tokens(machine=self.rejecting_machine)
+
+        self.report_path = os.path.join(directory.name, "TokenMatrixReport")
+        config = create_config(machines=self.machines)
+        config["token_matrix"] = {"server_root_url": "http://{machine_name}",
+                                  "repetitions": str(REPETITIONS),
+                                  "report": self.report_path,
+                                  "workers": "4"}
+        config_path = os.path.join(directory.name, "credentials.cfg")
+        with open(config_path, 'w') as config_file_handler:
+            config.write(config_file_handler)
+        with quiet():
+            main(credentials_path=config_path)
+
+    def machine_name(self, machine):
+        return f"127.0.0.1:{machine.port}"
+
+    def test_cells_are_classified_by_their_response(self):
+        with open(f"{self.report_path}.json", 'r') as json_file_handler:
+            cells = json.load(json_file_handler)["cells"]
+        self.assertEqual(len(self.machines) ** 2 * (REPORTED_FOLDER_COUNT + 1) * REPETITIONS, len(cells))
+        rejecting_name = self.machine_name(self.rejecting_machine)
+        for cell in cells:
+            with self.subTest(token_machine=cell["token_machine"], target_machine=cell["target_machine"],
+                              folder=cell["folder"]):
+                if cell["folder"] == "":
+                    expected_result = "error"
+                elif cell["target_machine"] == rejecting_name and cell["token_machine"] != rejecting_name:
+                    expected_result = "mismatch"
+                else:
+                    expected_result = "success"
+                self.assertEqual(expected_result, cell["result"])
+                if expected_result == "mismatch":
+                    self.assertIn("Client Mismatch", cell["message"])
+
+    def test_summary_counts_each_token_machine_and_target_machine_pair(self):
+        with open(f"{self.report_path}.json", 'r') as json_file_handler:
+            summary = json.load(json_file_handler)["summary"]
+        self.assertEqual(len(self.machines) ** 2, len(summary))
+        rejecting_name = self.machine_name(self.rejecting_machine)
+        for token_machine in self.machines:
+            for target_machine in self.machines:
+                pair = summary[f"{self.machine_name(token_machine)} -> {self.machine_name(target_machine)}"]
+                if self.machine_name(target_machine) == rejecting_name and token_machine is not target_machine:
+                    expected_counts = (0, REPORTED_FOLDER_COUNT * REPETITIONS, REPETITIONS)
+                else:
+                    expected_counts = (REPORTED_FOLDER_COUNT * REPETITIONS, 0, REPETITIONS)
+                self.assertEqual(expected_counts, (pair["success"], pair["mismatch"], pair["error"]))
+                self.assertLessEqual(pair["latency_median_seconds"], pair["latency_max_seconds"])
+
+    def test_csv_rows_end_in_a_single_line_terminator(self):
+        with open(f"{self.report_path}.csv", 'rb') as csv_file_handler:
+            content = csv_file_handler.read()
+        row_count = len(self.machines) ** 2 * (REPORTED_FOLDER_COUNT + 1) * REPETITIONS
+        self.assertEqual(row_count + 1, content.count(b"\r\n"))
+        self.assertNotIn(b"\r\r\n", content)
+        with open(f"{self.report_path}.csv", 'r', newline='') as csv_file_handler:
+            rows = list(csv.DictReader(csv_file_handler))
+        self.assertEqual(row_count, len(rows))
+        self.assertEqual({"success", "mismatch", "error"}, {row["result"] for row in rows})
+
+
+if __name__ == "__main__":
+    unittest.main()
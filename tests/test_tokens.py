@@ -0,0 +1,171 @@
+"""
+Tests of the token cache: reuse, refresh after a rejection, machines generating their tokens independently, and the
+retry of generateToken requests answered with an error by a replay machine.
+
+Usage:
+    python -m pytest tests
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+_ROOT_PROJECT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT_PROJECT_PATH)
+
+from ags_crawler import Crawler  # noqa: E402
+from ags_replay import GENERATE_TOKEN_PATH  # noqa: E402
+from ags_retry import NOT_JSON, RequestFailedException  # noqa: E402
+from ags_tokens import TokenException, TokenManager  # noqa: E402
+from replay_machines import create_config, quiet, root_url, start_machines  # noqa: E402
+
+SLOW_MACHINE = "https://slow:6443"
+FAST_MACHINE = "https://fast:6443"
+
+
+class FakeTokenClient:
+    """Stands in for AGSClient, answering generateToken with a numbered token, after a wait for the slow machine."""
+
+    def __init__(self):
+        self.slow_machine_released = threading.Event()
+        self.slow_machine_called = threading.Event()
+        self.posted_urls = []
+        self._lock = threading.Lock()
+
+    def post(self, url, data=None, timeout=None, **kwargs):
+        with self._lock:
+            self.posted_urls.append(url)
+            token = f"token{len(self.posted_urls)}"
+        if url.startswith(SLOW_MACHINE):
+            self.slow_machine_called.set()
+            self.slow_machine_released.wait(timeout=5.0)
+        response_json = {"token": token, "expires": int((time.time() + 3600) * 1000)}
+        return SimpleNamespace(headers={"Content-Type": "application/json"}, json=lambda: response_json)
+
+
+class TokenManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeTokenClient()
+        self.client.slow_machine_released.set()
+        self.token_manager = TokenManager(client=self.client, username="user", password="password")
+
+    def test_cached_token_is_reused_until_refreshed(self):
+        token = self.token_manager.get_token(root_url=FAST_MACHINE)
+        self.assertEqual(token, self.token_manager.get_token(root_url=FAST_MACHINE))
+        # A token generated in this run is not counted as reused
+        self.assertEqual((1, 0), (self.token_manager.generated_count, self.token_manager.reused_count))
+
+        refreshed_token = self.token_manager.refresh(root_url=FAST_MACHINE, rejected_token=token)
+        self.assertNotEqual(token, refreshed_token)
+        # A thread still holding the token rejected before is handed the replacement, not yet another token
+        self.assertEqual(refreshed_token, self.token_manager.refresh(root_url=FAST_MACHINE, rejected_token=token))
+        self.assertEqual(2, self.token_manager.generated_count)
+
+    def test_token_from_an_earlier_run_counts_as_reused_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_path = os.path.join(directory, "tokens.json")
+            TokenManager(client=self.client, username="user", password="password",
+                         cache_path=cache_path).get_token(root_url=FAST_MACHINE)
+            token_manager = TokenManager(client=self.client, username="user", password="password",
+                                         cache_path=cache_path)
+            for _ in range(3):
+                self.assertEqual("token1", token_manager.get_token(root_url=FAST_MACHINE))
+            self.assertEqual((0, 1), (token_manager.generated_count, token_manager.reused_count))
+
+            # The next daemon cycle counts the still cached token as reused again
+            token_manager.reset_counts()
+            token_manager.get_token(root_url=FAST_MACHINE)
+            self.assertEqual(1, token_manager.reused_count)
+
+    def test_only_token_errors_count_as_rejections(self):
+        for messages, code, rejected in ((["Client Mismatch"], None, True),
+                                         (["Invalid token."], None, True),
+                                         (["Token expired."], None, True),
+                                         (["Unauthorized access"], 498, True),
+                                         (["Token required to access folder X"], 403, False),
+                                         (["Folder not found"], None, False)):
+            with self.subTest(messages=messages):
+                response_json = {"status": "error", "messages": messages, "code": code}
+                self.assertEqual(rejected, TokenManager.is_token_rejected(response_json))
+
+    def test_slow_machine_does_not_hold_back_other_machines(self):
+        self.client.slow_machine_released.clear()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            slow_token = executor.submit(self.token_manager.get_token, root_url=SLOW_MACHINE)
+            self.assertTrue(self.client.slow_machine_called.wait(timeout=5.0))
+            fast_token = executor.submit(self.token_manager.get_token, root_url=FAST_MACHINE)
+            fast_token.result(timeout=1.0)
+            self.assertFalse(slow_token.done())
+            self.client.slow_machine_released.set()
+            slow_token.result(timeout=5.0)
+
+    def test_concurrent_requests_for_a_machine_generate_one_token(self):
+        self.client.slow_machine_released.clear()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            tokens = [executor.submit(self.token_manager.get_token, root_url=SLOW_MACHINE) for _ in range(8)]
+            self.assertTrue(self.client.slow_machine_called.wait(timeout=5.0))
+            self.client.slow_machine_released.set()
+            self.assertEqual({"token1"}, {token.result(timeout=5.0) for token in tokens})
+        self.assertEqual(1, self.token_manager.generated_count)
+
+
+class GenerateTokenRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.machine, = start_machines(test=self)
+        self.token_request_count = 0
+        respond = self.machine.respond
+
+        def failing_respond(path, params):
+            # The first generateToken requests are answered with the html error page of an injected error
+            if path.strip("/") == GENERATE_TOKEN_PATH:
+                self.token_request_count += 1
+                if self.token_request_count <= self.failed_token_requests:
+                    return 503, "text/html", b"<html><body>Injected error</body></html>"
+            return respond(path=path, params=params)
+
+        self.machine.respond = failing_respond
+
+    def create_crawler(self):
+        crawler = Crawler(config=create_config(machines=[self.machine], retry_attempts_not_json=3))
+        self.addCleanup(crawler.close)
+        return crawler
+
+    def test_token_request_answered_with_an_error_is_retried(self):
+        self.failed_token_requests = 2
+        crawler = self.create_crawler()
+        with quiet():
+            machine_object = crawler.connect()
+        self.assertTrue(machine_object.token.startswith("replay-"))
+        self.assertEqual(3, self.token_request_count)
+        self.assertEqual(1, crawler.token_manager.generated_count)
+
+    def test_token_request_failing_on_every_attempt_raises(self):
+        self.failed_token_requests = 10
+        crawler = self.create_crawler()
+        with self.assertRaises(TokenException) as context, quiet():
+            crawler.token_manager.get_token(root_url=root_url(self.machine))
+        self.assertEqual(3, self.token_request_count)
+        self.assertEqual(NOT_JSON, context.exception.error_class)
+
+    def test_request_without_a_token_fails_with_the_token_request_class(self):
+        self.failed_token_requests = 0
+        crawler = self.create_crawler()
+        with quiet():
+            crawler.connect()
+        self.failed_token_requests = 10
+        crawler.token_manager._tokens.clear()
+        with self.assertRaises(RequestFailedException) as context, quiet():
+            crawler.get_value_from_machines(path="arcgis/admin/services/Alpha/report", search_key="reports",
+                                            kind="report")
+        self.assertEqual(NOT_JSON, context.exception.error_class)
+
+
+if __name__ == "__main__":
+    unittest.main()